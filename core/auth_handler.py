@@ -5,10 +5,11 @@ import re
 
 # MODIFICACIÓN: Importar las funciones directamente desde el nuevo módulo 'db_quiz_loader'.
 from core.db_quiz_loader import (
-    conectar_db, 
+    conexion_db, 
     crear_usuario, 
     obtener_usuario_por_nombre, 
-    obtener_usuario_por_email
+    obtener_usuario_por_email,
+    DatabaseConnectionError
 )
 
 # --- Configuración de Passlib ---
@@ -62,39 +63,30 @@ def registrar_nuevo_usuario(nombre_usuario, contrasena, email, comunidad_autonom
     if not password_hash:
         return None, "Error de registro: Fallo al hashear la contraseña."
 
-    conn = None
     try:
-        conn = conectar_db()
-        if not conn:
-            return None, "Error de registro: No se pudo conectar a la base de datos."
-        
-        # MODIFICACIÓN: Llamar a la función importada directamente.
-        usuario_id = crear_usuario(conn, nombre_usuario, password_hash, email, comunidad_autonoma, especialidad)
+        with conexion_db() as conn:
+            # MODIFICACIÓN: Llamar a la función importada directamente.
+            usuario_id = crear_usuario(conn, nombre_usuario, password_hash, email, comunidad_autonoma, especialidad)
         
         if usuario_id:
             return usuario_id, None # Éxito
         else:
             return None, "Error al crear el usuario. El nombre de usuario o email podrían ya existir."
             
+    except DatabaseConnectionError:
+        return None, "Error de registro: No se pudo conectar a la base de datos."
     except Exception as e:
         return None, f"Error inesperado durante el registro: {e}"
-    finally:
-        if conn:
-            conn.close()
 
 def autenticar_usuario(email, contrasena_plana):
     """Autentica un usuario por su email y contraseña."""
     if not email or not contrasena_plana:
         return {'status': 'error', 'reason': 'empty_credentials'}
 
-    conn = None
     try:
-        conn = conectar_db()
-        if not conn:
-            return {'status': 'error', 'reason': 'db_connection_error'}
-
-        # MODIFICACIÓN: Llamar a la función importada directamente.
-        usuario_data = obtener_usuario_por_email(conn, email)
+        with conexion_db() as conn:
+            # MODIFICACIÓN: Llamar a la función importada directamente.
+            usuario_data = obtener_usuario_por_email(conn, email)
 
         if not usuario_data:
             return {'status': 'error', 'reason': 'email_not_found'}
@@ -115,8 +107,7 @@ def autenticar_usuario(email, contrasena_plana):
         else:
             return {'status': 'error', 'reason': 'incorrect_password'}
             
+    except DatabaseConnectionError:
+        return {'status': 'error', 'reason': 'db_connection_error'}
     except Exception as e:
         return {'status': 'error', 'reason': 'unexpected_error', 'message': str(e)}
-    finally:
-        if conn:
-            conn.close()
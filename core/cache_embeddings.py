@@ -0,0 +1,222 @@
+# core/cache_embeddings.py
+# Caché de embeddings de las preguntas del chat, en dos niveles:
+#   1. LRU + TTL en memoria del proceso (cachetools).
+#   2. Almacén persistente compartido: Redis si hay REDIS_URL; si no, una tabla de PostgreSQL.
+# La clave es sha256(modelo + texto normalizado), de modo que "¿Qué es el CEA?" y
+# "que es el cea" comparten entrada. Los vectores se guardan como float32 binario.
+import os
+import re
+import hashlib
+import threading
+import logging
+import unicodedata
+
+import numpy as np
+import psycopg2
+from cachetools import TTLCache
+
+from core.database import conexion_db
+from core.embeddings_binarios import codificar, decodificar
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración (sobrescribible por variables de entorno) ---
+CACHE_MEMORIA_MAX = int(os.environ.get('EMBEDDINGS_CACHE_MAX', 1024))
+CACHE_MEMORIA_TTL_S = float(os.environ.get('EMBEDDINGS_CACHE_TTL', 3600))
+CACHE_PERSISTENTE_MAX = int(os.environ.get('EMBEDDINGS_CACHE_PERSISTENTE_MAX', 50000))
+CACHE_PERSISTENTE_TTL_DIAS = int(os.environ.get('EMBEDDINGS_CACHE_PERSISTENTE_TTL_DIAS', 30))
+# Cada cuántas inserciones se purga el almacén persistente (caducados y exceso sobre el máximo).
+CACHE_PURGA_CADA = 200
+REDIS_URL = os.environ.get('REDIS_URL')
+
+DDL_CACHE_EMBEDDINGS = """
+    CREATE TABLE IF NOT EXISTS cache_embeddings_preguntas (
+        clave char(64) PRIMARY KEY,
+        modelo varchar(64) NOT NULL,
+        embedding bytea NOT NULL,
+        creado_en timestamptz NOT NULL DEFAULT now(),
+        ultimo_uso timestamptz NOT NULL DEFAULT now(),
+        usos integer NOT NULL DEFAULT 1
+    );
+    CREATE INDEX IF NOT EXISTS idx_cache_embeddings_ultimo_uso ON cache_embeddings_preguntas (ultimo_uso);
+"""
+
+_PUNTUACION_EXTREMOS = '¿?¡!.,;: '
+
+
+def normalizar_pregunta(texto):
+    """Forma canónica del texto: NFKC, minúsculas, sin tildes, espacios colapsados y sin signos en los extremos."""
+    texto = unicodedata.normalize('NFKC', str(texto)).casefold()
+    texto = ''.join(c for c in unicodedata.normalize('NFD', texto) if unicodedata.category(c) != 'Mn')
+    texto = re.sub(r'\s+', ' ', texto)
+    return texto.strip(_PUNTUACION_EXTREMOS)
+
+
+def clave_embedding(texto, modelo):
+    return hashlib.sha256(f"{modelo}\n{normalizar_pregunta(texto)}".encode('utf-8')).hexdigest()
+
+
+# --- Almacenes persistentes ---
+class _AlmacenPostgres:
+    def __init__(self):
+        self._esquema_ok = False
+        self._inserciones = 0
+
+    def _asegurar_esquema(self, conn):
+        if not self._esquema_ok:
+            with conn.cursor() as cursor:
+                cursor.execute(DDL_CACHE_EMBEDDINGS)
+            conn.commit()
+            self._esquema_ok = True
+
+    def leer(self, clave):
+        with conexion_db() as conn:
+            self._asegurar_esquema(conn)
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    UPDATE cache_embeddings_preguntas SET ultimo_uso = now(), usos = usos + 1
+                    WHERE clave = %s AND ultimo_uso > now() - make_interval(days => %s)
+                    RETURNING embedding
+                    """,
+                    (clave, CACHE_PERSISTENTE_TTL_DIAS),
+                )
+                fila = cursor.fetchone()
+            conn.commit()
+        return bytes(fila[0]) if fila else None
+
+    def escribir(self, clave, modelo, datos):
+        with conexion_db() as conn:
+            self._asegurar_esquema(conn)
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO cache_embeddings_preguntas (clave, modelo, embedding) VALUES (%s, %s, %s)
+                    ON CONFLICT (clave) DO UPDATE SET embedding = EXCLUDED.embedding, ultimo_uso = now()
+                    """,
+                    (clave, modelo, psycopg2.Binary(datos)),
+                )
+                self._inserciones += 1
+                if self._inserciones % CACHE_PURGA_CADA == 0:
+                    cursor.execute(
+                        "DELETE FROM cache_embeddings_preguntas WHERE ultimo_uso < now() - make_interval(days => %s)",
+                        (CACHE_PERSISTENTE_TTL_DIAS,),
+                    )
+                    cursor.execute(
+                        """
+                        DELETE FROM cache_embeddings_preguntas WHERE clave IN (
+                            SELECT clave FROM cache_embeddings_preguntas ORDER BY ultimo_uso DESC OFFSET %s
+                        )
+                        """,
+                        (CACHE_PERSISTENTE_MAX,),
+                    )
+            conn.commit()
+
+
+class _AlmacenRedis:
+    """Las entradas caducan con el TTL; el límite de tamaño lo impone la política maxmemory (allkeys-lru) de Redis."""
+
+    PREFIJO = 'mentoralab:emb:'
+
+    def __init__(self, url):
+        import redis
+        self._cliente = redis.Redis.from_url(url)
+
+    def leer(self, clave):
+        return self._cliente.getex(self.PREFIJO + clave, ex=CACHE_PERSISTENTE_TTL_DIAS * 86400)
+
+    def escribir(self, clave, modelo, datos):
+        self._cliente.set(self.PREFIJO + clave, datos, ex=CACHE_PERSISTENTE_TTL_DIAS * 86400)
+
+
+class CacheEmbeddings:
+    def __init__(self, almacen=None):
+        self._memoria = TTLCache(maxsize=CACHE_MEMORIA_MAX, ttl=CACHE_MEMORIA_TTL_S)
+        self._lock = threading.Lock()
+        self._almacen = almacen
+        self.estadisticas = {'aciertos_memoria': 0, 'aciertos_persistente': 0, 'fallos': 0, 'errores_persistente': 0}
+
+    def _contar(self, contador):
+        with self._lock:
+            self.estadisticas[contador] += 1
+
+    def obtener(self, texto, modelo, calcular):
+        """
+        Devuelve el embedding (np.float32) de 'texto'. Solo llama a calcular(texto) si no está en ningún nivel.
+        Los fallos del almacén persistente se registran pero nunca impiden responder.
+        """
+        clave = clave_embedding(texto, modelo)
+        with self._lock:
+            vector = self._memoria.get(clave)
+        if vector is not None:
+            self._contar('aciertos_memoria')
+            return vector
+
+        if self._almacen is not None:
+            try:
+                datos = self._almacen.leer(clave)
+            except Exception as e:
+                logger.warning(f"Caché persistente de embeddings no disponible (lectura): {e}")
+                self._contar('errores_persistente')
+                datos = None
+            if datos:
+                vector = decodificar(datos, 'float32')
+                vector.setflags(write=False)
+                with self._lock:
+                    self._memoria[clave] = vector
+                self._contar('aciertos_persistente')
+                return vector
+
+        self._contar('fallos')
+        vector = calcular(texto)
+        if vector is None:
+            return None
+        vector = np.array(vector, dtype=np.float32)
+        vector.setflags(write=False)  # El mismo array se comparte entre sesiones.
+        with self._lock:
+            self._memoria[clave] = vector
+        if self._almacen is not None:
+            try:
+                self._almacen.escribir(clave, modelo, codificar(vector, 'float32'))
+            except Exception as e:
+                logger.warning(f"No se pudo guardar el embedding en la caché persistente: {e}")
+                self._contar('errores_persistente')
+        return vector
+
+    def vaciar_memoria(self):
+        with self._lock:
+            self._memoria.clear()
+
+
+_cache_global = None
+_cache_lock = threading.Lock()
+
+
+def _crear_almacen():
+    if REDIS_URL:
+        try:
+            return _AlmacenRedis(REDIS_URL)
+        except ImportError:
+            logger.warning("REDIS_URL definido pero el paquete 'redis' no está instalado. Se usa PostgreSQL.")
+    return _AlmacenPostgres()
+
+
+def obtener_cache_embeddings():
+    global _cache_global
+    if _cache_global is None:
+        with _cache_lock:
+            if _cache_global is None:
+                _cache_global = CacheEmbeddings(_crear_almacen())
+    return _cache_global
+
+
+def obtener_embedding_cacheado(texto, modelo, calcular):
+    return obtener_cache_embeddings().obtener(texto, modelo, calcular)
+
+
+def estadisticas_cache_embeddings():
+    cache = obtener_cache_embeddings()
+    with cache._lock:
+        estadisticas = dict(cache.estadisticas)
+        estadisticas['entradas_memoria'] = len(cache._memoria)
+    return estadisticas
@@ -0,0 +1,92 @@
+# core/cache_huella.py
+# Objeto compartido por todo el proceso que se reconstruye desde la BD cuando cambia su "huella".
+#
+# Es el esquema común del índice de preguntas, el cierre de temas, el índice RAG, las métricas de
+# preguntas y el catálogo de temas:
+# - El primer acceso lo construye; después se devuelve sin tocar la BD durante ttl_s segundos.
+# - Pasado el TTL se lee la huella (una consulta barata) y solo si ha cambiado se reconstruye.
+# - Doble comprobación con lock: un único hilo consulta y construye, el resto espera o sigue con
+#   la versión anterior.
+# - Ante un error de BD se mantiene la versión anterior si la hay (y se relanza si no).
+# - invalidar() fuerza la reconstrucción en el próximo acceso (p. ej. tras una ingesta). Incrementa
+#   un contador de generación: una invalidación que llega durante una reconstrucción (que quizá ya
+#   leyó los datos viejos) no se pierde, porque esa reconstrucción queda marcada con la generación
+#   en la que empezó.
+import time
+import threading
+import logging
+
+import psycopg2
+
+from core.database import conexion_db
+
+logger = logging.getLogger(__name__)
+
+
+class CacheHuella:
+    """
+    nombre: para el log. huella(conn) -> valor comparable. construir(conn, huella) -> objeto.
+    vacio(): si se indica, objeto a usar mientras las tablas aún no existan (UndefinedTable).
+    """
+
+    def __init__(self, nombre, huella, construir, ttl_s, vacio=None):
+        self.nombre = nombre
+        self._huella = huella
+        self._construir = construir
+        self.ttl_s = ttl_s
+        self._vacio = vacio
+        self._actual = None
+        self._huella_actual = None
+        self._ultima_comprobacion = 0.0
+        self._generacion = 0
+        self._generacion_construida = 0
+        self._lock = threading.Lock()
+        self._lock_generacion = threading.Lock()
+
+    def _vigente(self, forzar):
+        return (self._actual is not None and not forzar and self._generacion_construida == self._generacion
+                and time.monotonic() - self._ultima_comprobacion < self.ttl_s)
+
+    def _refrescar(self, conn, forzar):
+        huella = self._huella(conn)
+        if forzar or self._actual is None or huella != self._huella_actual:
+            self._actual = self._construir(conn, huella)
+            self._huella_actual = huella
+
+    def obtener(self, conn=None, forzar=False):
+        """Objeto vigente. Sin 'conn' se usa una conexión del pool, y solo si hay que consultar."""
+        actual = self._actual
+        if self._vigente(forzar):
+            return actual
+
+        with self._lock:
+            if self._vigente(forzar):
+                return self._actual
+            generacion = self._generacion
+            forzar = forzar or generacion != self._generacion_construida
+            try:
+                if conn is not None:
+                    self._refrescar(conn, forzar)
+                else:
+                    with conexion_db() as conn_carga:
+                        self._refrescar(conn_carga, forzar)
+            except psycopg2.errors.UndefinedTable:
+                if conn is not None:
+                    conn.rollback()
+                if self._vacio is None:
+                    raise
+                self._actual, self._huella_actual = self._vacio(), None
+            except psycopg2.Error as e:
+                if conn is not None:
+                    conn.rollback()
+                if self._actual is None:
+                    raise
+                logger.error(f"No se pudo refrescar {self.nombre}; se mantiene la versión anterior: {e}", exc_info=True)
+                return self._actual
+            self._generacion_construida = generacion
+            self._ultima_comprobacion = time.monotonic()
+            return self._actual
+
+    def invalidar(self):
+        with self._lock_generacion:
+            self._generacion += 1
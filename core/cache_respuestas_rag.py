@@ -0,0 +1,221 @@
+# core/cache_respuestas_rag.py
+# Caché semántica de respuestas del chat RAG.
+# Una respuesta guardada se reutiliza si:
+#   - la pregunta nueva tiene similitud coseno >= RAG_CACHE_UMBRAL con la pregunta guardada, y
+#   - la recuperación ha devuelto exactamente el mismo conjunto de chunks.
+# Cada entrada lleva la versión del corpus (huella de manual_chunks, que cambia también con una
+# reingesta en el sitio): al reingestar el manual, las entradas de versiones anteriores dejan de
+# usarse y se borran. versiones_corpus_rag anota cuándo se vio cada versión por primera vez, para
+# que un proceso que aún no ha refrescado su huella no borre las entradas de una versión más nueva.
+import os
+import time
+import threading
+import logging
+
+import numpy as np
+import psycopg2
+
+from core.database import conexion_db
+from core.embeddings_binarios import codificar, decodificar_lote
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración (sobrescribible por variables de entorno) ---
+RAG_CACHE_UMBRAL = float(os.environ.get('RAG_CACHE_UMBRAL', 0.95))
+# Cada cuánto se recargan de la BD las entradas añadidas por otros procesos.
+RAG_CACHE_RECARGA_S = float(os.environ.get('RAG_CACHE_RECARGA', 120))
+# Espera mínima entre intentos de recarga tras un fallo de BD.
+RAG_CACHE_REINTENTO_S = float(os.environ.get('RAG_CACHE_REINTENTO', 30))
+
+DDL_CACHE_RESPUESTAS = """
+    CREATE TABLE IF NOT EXISTS cache_respuestas_rag (
+        id bigserial PRIMARY KEY,
+        version_corpus varchar(128) NOT NULL,
+        embedding bytea NOT NULL,
+        chunk_ids integer[] NOT NULL,
+        respuesta text NOT NULL,
+        creado_en timestamptz NOT NULL DEFAULT now(),
+        usos integer NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_cache_respuestas_rag_version ON cache_respuestas_rag (version_corpus);
+    CREATE TABLE IF NOT EXISTS versiones_corpus_rag (
+        version_corpus varchar(128) PRIMARY KEY,
+        vista_en timestamptz NOT NULL DEFAULT now()
+    );
+"""
+
+# Entradas de versiones vistas antes que la propia (o sin registrar, de antes de existir la tabla).
+SQL_PURGAR_VERSIONES_ANTERIORES = """
+    DELETE FROM cache_respuestas_rag c
+    WHERE c.version_corpus <> %(version)s
+      AND NOT EXISTS (
+          SELECT 1 FROM versiones_corpus_rag v, versiones_corpus_rag propia
+          WHERE propia.version_corpus = %(version)s
+            AND v.version_corpus = c.version_corpus
+            AND v.vista_en >= propia.vista_en
+      )
+"""
+
+
+def _normalizar(vector):
+    v = np.asarray(vector, dtype=np.float32).ravel()
+    norma = np.linalg.norm(v)
+    return v / norma if norma > 0 else v
+
+
+class CacheRespuestasRAG:
+    """Espejo en memoria de las entradas de la versión vigente: matriz de preguntas normalizadas + metadatos."""
+
+    def __init__(self, umbral=RAG_CACHE_UMBRAL):
+        self.umbral = umbral
+        self._lock = threading.Lock()
+        self._recarga_lock = threading.Lock()
+        self._esquema_ok = False
+        self._version = None
+        self._cargado_en = 0.0
+        self._fallo_en = -RAG_CACHE_REINTENTO_S
+        self._ids = []
+        self._matriz = np.zeros((0, 0), dtype=np.float32)
+        self._chunks = []
+        self._respuestas = []
+        self.estadisticas = {'aciertos': 0, 'fallos': 0}
+
+    def _asegurar_esquema(self, conn):
+        if not self._esquema_ok:
+            with conn.cursor() as cursor:
+                cursor.execute(DDL_CACHE_RESPUESTAS)
+            conn.commit()
+            self._esquema_ok = True
+
+    def _leer(self, conn, version):
+        """Lee las entradas de 'version' y purga las de versiones anteriores (nunca las más nuevas)."""
+        self._asegurar_esquema(conn)
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO versiones_corpus_rag (version_corpus) VALUES (%s) ON CONFLICT DO NOTHING", (version,)
+            )
+            cursor.execute(SQL_PURGAR_VERSIONES_ANTERIORES, {'version': version})
+            if cursor.rowcount:
+                logger.info(f"Caché de respuestas RAG: {cursor.rowcount} entradas de versiones anteriores eliminadas.")
+            cursor.execute(
+                "SELECT id, embedding, chunk_ids, respuesta FROM cache_respuestas_rag WHERE version_corpus = %s ORDER BY id",
+                (version,),
+            )
+            filas = cursor.fetchall()
+        conn.commit()
+        return (
+            [row[0] for row in filas],
+            decodificar_lote([row[1] for row in filas], 'float32'),
+            [frozenset(row[2]) for row in filas],
+            [row[3] for row in filas],
+        )
+
+    def _recargar_si_toca(self, conn, version):
+        """
+        Recarga si cambió la versión o pasó RAG_CACHE_RECARGA_S. La lectura se hace fuera de self._lock
+        (solo el intercambio de listas va dentro) y la hace un único hilo: el resto sigue con lo cargado.
+        Tras un fallo no se reintenta hasta pasados RAG_CACHE_REINTENTO_S.
+        """
+        ahora = time.monotonic()
+        if version == self._version and ahora - self._cargado_en <= RAG_CACHE_RECARGA_S:
+            return
+        if ahora - self._fallo_en < RAG_CACHE_REINTENTO_S or not self._recarga_lock.acquire(blocking=False):
+            return
+        try:
+            ids, matriz, chunks, respuestas = self._leer(conn, version)
+        except psycopg2.Error as e:
+            conn.rollback()
+            self._fallo_en = time.monotonic()
+            logger.warning(f"No se pudo recargar la caché de respuestas RAG: {e}")
+            return
+        finally:
+            self._recarga_lock.release()
+        with self._lock:
+            self._version = version
+            self._cargado_en = time.monotonic()
+            self._ids, self._matriz, self._chunks, self._respuestas = ids, matriz, chunks, respuestas
+
+    def buscar(self, conn, version, vector, chunk_ids):
+        """Devuelve la respuesta cacheada o None."""
+        if vector is None or not chunk_ids:
+            return None
+        q = _normalizar(vector)
+        self._recargar_si_toca(conn, version)
+        with self._lock:
+            # Sin las entradas de esta versión (primera carga en curso o fallida) no hay acierto posible.
+            if version != self._version:
+                self.estadisticas['fallos'] += 1
+                return None
+
+            respuesta, entrada_id = None, None
+            if len(self._ids) and self._matriz.shape[1] == len(q):
+                similitudes = self._matriz @ q
+                conjunto = frozenset(chunk_ids)
+                for pos in np.argsort(-similitudes):
+                    if similitudes[pos] < self.umbral:
+                        break
+                    if self._chunks[pos] == conjunto:
+                        respuesta, entrada_id = self._respuestas[pos], self._ids[pos]
+                        break
+            self.estadisticas['aciertos' if respuesta is not None else 'fallos'] += 1
+
+        if entrada_id is not None:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("UPDATE cache_respuestas_rag SET usos = usos + 1 WHERE id = %s", (entrada_id,))
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                logger.warning(f"No se pudo actualizar el uso de la respuesta cacheada {entrada_id}: {e}")
+        return respuesta
+
+    def guardar(self, version, vector, chunk_ids, respuesta):
+        """Guarda una respuesta completa. Abre su propia conexión: se llama después del streaming."""
+        if vector is None or not chunk_ids or not respuesta:
+            return
+        q = _normalizar(vector)
+        try:
+            with conexion_db() as conn:
+                self._asegurar_esquema(conn)
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        """
+                        INSERT INTO cache_respuestas_rag (version_corpus, embedding, chunk_ids, respuesta)
+                        VALUES (%s, %s, %s, %s) RETURNING id
+                        """,
+                        (version, psycopg2.Binary(codificar(q, 'float32')), list(chunk_ids), respuesta),
+                    )
+                    nuevo_id = cursor.fetchone()[0]
+                conn.commit()
+        except Exception as e:
+            logger.warning(f"No se pudo guardar la respuesta en la caché RAG: {e}")
+            return
+
+        with self._lock:
+            # Una recarga concurrente puede haberla leído ya de la BD.
+            if version == self._version and (self._matriz.shape[1] in (0, len(q))) and nuevo_id not in self._ids:
+                self._ids.append(nuevo_id)
+                self._matriz = np.vstack([self._matriz.reshape(-1, len(q)), q[None, :]])
+                self._chunks.append(frozenset(chunk_ids))
+                self._respuestas.append(respuesta)
+
+
+_cache_global = None
+_cache_lock = threading.Lock()
+
+
+def obtener_cache_respuestas():
+    global _cache_global
+    if _cache_global is None:
+        with _cache_lock:
+            if _cache_global is None:
+                _cache_global = CacheRespuestasRAG()
+    return _cache_global
+
+
+def reproducir_respuesta(texto, tamano_trozo=3):
+    """Generador para st.write_stream que emite la respuesta cacheada en trozos de unas pocas palabras."""
+    palabras = texto.split(' ')
+    for i in range(0, len(palabras), tamano_trozo):
+        trozo = ' '.join(palabras[i:i + tamano_trozo])
+        yield trozo if i + tamano_trozo >= len(palabras) else trozo + ' '
@@ -0,0 +1,91 @@
+# core/catalogo_temas.py
+# Catálogo de temas (temas_manual) y nodos del árbol de selección, compartidos por todo el proceso.
+#
+# Cada sesión usaba su propia copia de la lista de temas (~2.4k) y reconstruía el árbol con
+# format_topics_for_tree, ordenación natural incluida, en cada rerun de la pantalla Personalizado.
+# Aquí se cargan una vez (una consulta) y se guardan por especialidad (BQ o el resto) como objetos
+# inmutables que todas las sesiones comparten por referencia:
+# - temas: tupla de mappingproxy con id, codigo, nombre y original_id, en orden de código.
+# - arbol: tupla de nodos para streamlit-tree-select; 'children' también son tuplas. Son dicts
+#   porque el componente los serializa a JSON: no deben modificarse.
+# Se recarga (core/cache_huella.py) si cambia la huella de temas_manual, comprobada como mucho cada
+# CATALOGO_TEMAS_TTL_S, o tras invalidar_catalogo_temas(). Las páginas lo leen en cada uso en lugar
+# de guardarlo en la sesión, así que tras una recarga todas las sesiones ven la lista nueva.
+import os
+import types
+import logging
+
+from core.cache_huella import CacheHuella
+from core.db_quiz_loader import format_topics_for_tree, ID_MICROBIOLOGIA_INICIO, ESPECIALIDAD_BIOQUIMICA
+
+logger = logging.getLogger(__name__)
+
+CATALOGO_TEMAS_TTL_S = float(os.environ.get('CATALOGO_TEMAS_TTL', 300))
+
+SQL_TEMAS = """
+    SELECT id, codigo, nombre, original_id FROM temas_manual
+    WHERE codigo IS NOT NULL AND nombre IS NOT NULL AND nombre != ''
+    ORDER BY codigo
+"""
+
+# A diferencia de la huella del cierre, incluye los nombres: renombrar un tema cambia las etiquetas.
+SQL_HUELLA_CATALOGO = """
+    SELECT md5(COALESCE(string_agg(concat_ws(':', id, codigo, nombre, original_id), ',' ORDER BY id), ''))
+    FROM temas_manual
+"""
+
+
+def _congelar_arbol(nodos):
+    return tuple({**nodo, 'children': _congelar_arbol(nodo.get('children', ()))} for nodo in nodos)
+
+
+class CatalogoTemas:
+    """Temas de una especialidad y su árbol ya formateado (inmutables)."""
+
+    def __init__(self, temas, huella):
+        self.huella = huella
+        self.temas = tuple(types.MappingProxyType(tema) for tema in temas)
+        self.arbol = _congelar_arbol(format_topics_for_tree(temas))
+
+
+def _clave_especialidad(especialidad_usuario):
+    # obtener_temas_disponibles solo filtra para BQ.
+    return ESPECIALIDAD_BIOQUIMICA if especialidad_usuario == ESPECIALIDAD_BIOQUIMICA else None
+
+
+def _huella_catalogo(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(SQL_HUELLA_CATALOGO)
+        return cursor.fetchone()[0]
+
+
+def _cargar(conn, huella):
+    with conn.cursor() as cursor:
+        cursor.execute(SQL_TEMAS)
+        temas = [
+            {'id': int(row[0]), 'codigo': str(row[1]), 'nombre': row[2], 'original_id': int(row[3])}
+            for row in cursor.fetchall()
+        ]
+    conn.commit()
+    logger.info(f"Catálogo de temas cargado: {len(temas)} temas.")
+    return {
+        None: CatalogoTemas(temas, huella),
+        ESPECIALIDAD_BIOQUIMICA: CatalogoTemas([t for t in temas if t['id'] < ID_MICROBIOLOGIA_INICIO], huella),
+    }
+
+
+_cache_catalogo = CacheHuella("el catálogo de temas", _huella_catalogo, _cargar, CATALOGO_TEMAS_TTL_S)
+
+
+def obtener_catalogo_temas(especialidad_usuario=None, conn=None):
+    """
+    Catálogo vigente para la especialidad. Solo consulta la BD si no está cargado, tras invalidarlo
+    o cuando toca comprobar la huella; sin 'conn' se usa una conexión del pool solo en ese caso.
+    Ante un error se mantiene la versión anterior si la hay.
+    """
+    return _cache_catalogo.obtener(conn)[_clave_especialidad(especialidad_usuario)]
+
+
+def invalidar_catalogo_temas():
+    """Fuerza la recarga en el próximo acceso (p. ej. tras editar temas_manual)."""
+    _cache_catalogo.invalidar()
@@ -0,0 +1,119 @@
+# core/cierre_temas.py
+# Cierre precalculado de la jerarquía de temas (descendientes) y de los grupos de temas.
+# Los códigos se ordenan de forma natural ('1' < '1.2' < '1.10' < '2'); así los descendientes
+# de un tema ocupan un intervalo contiguo [inicio, fin) justo detrás de él, y expandir una
+# selección es una unión de rangos más una consulta a la tabla de compañeros de grupo.
+import os
+import time
+import logging
+
+from core.cache_huella import CacheHuella
+
+logger = logging.getLogger(__name__)
+
+# --- Constantes ---
+CIERRE_TTL_S = float(os.environ.get('CIERRE_TEMAS_TTL', 300))
+
+SQL_HUELLA_TEMAS = """
+    SELECT
+        (SELECT count(*) FROM temas_manual),
+        (SELECT COALESCE(sum(id::bigint * 31 + length(codigo)), 0) FROM temas_manual WHERE codigo IS NOT NULL),
+        (SELECT count(*) FROM tema_en_grupo),
+        (SELECT COALESCE(sum(grupo_id::bigint * 31 + tema_id), 0) FROM tema_en_grupo);
+"""
+
+
+def _clave_segmentos(codigo):
+    """
+    Clave de ordenación natural por segmentos. A diferencia de clave_ordenacion_natural,
+    no colapsa los códigos no numéricos, de modo que el orden sigue siendo un recorrido
+    en preorden del árbol y los descendientes de cada código quedan contiguos.
+    """
+    return tuple((0, int(p), p) if p.isdigit() else (1, 0, p) for p in str(codigo).split('.'))
+
+
+class CierreTemas:
+    """
+    Estructura inmutable con:
+    - ids_ordenados: ids de tema en orden natural de código.
+    - posicion_de: {tema_id: posición} y fin_de[posición]: fin (exclusivo) de su intervalo de descendientes.
+    - companeros_grupo: {tema_id: frozenset de temas que comparten algún grupo con él}.
+    """
+
+    def __init__(self, temas, filas_grupos, huella=None):
+        self.huella = huella
+        self.construido_en = time.monotonic()
+
+        temas = sorted(((t['id'], t['codigo']) for t in temas if t.get('codigo')), key=lambda t: _clave_segmentos(t[1]))
+        self.ids_ordenados = [tema_id for tema_id, _ in temas]
+        self.posicion_de = {tema_id: pos for pos, tema_id in enumerate(self.ids_ordenados)}
+
+        # Intervalo de descendientes: una pila con los ancestros abiertos en el recorrido en preorden.
+        claves = [_clave_segmentos(codigo) for _, codigo in temas]
+        self.fin_de = [len(claves)] * len(claves)
+        abiertos = []
+        for pos, clave in enumerate(claves):
+            while abiertos and clave[:len(claves[abiertos[-1]])] != claves[abiertos[-1]]:
+                self.fin_de[abiertos.pop()] = pos
+            abiertos.append(pos)
+
+        miembros_grupo = {}
+        for grupo_id, tema_id in filas_grupos:
+            miembros_grupo.setdefault(grupo_id, set()).add(tema_id)
+        companeros = {}
+        for miembros in miembros_grupo.values():
+            for tema_id in miembros:
+                companeros.setdefault(tema_id, set()).update(miembros)
+        self.companeros_grupo = {tema_id: frozenset(ids) for tema_id, ids in companeros.items()}
+
+        logger.info(f"Cierre de temas construido: {len(self.ids_ordenados)} temas, {len(miembros_grupo)} grupos.")
+
+    def descendientes(self, selected_ids, permitidos=None):
+        """Selección + todos sus descendientes (unión de intervalos), opcionalmente restringidos a 'permitidos'."""
+        expandidos = set(selected_ids)
+        for tema_id in selected_ids:
+            pos = self.posicion_de.get(tema_id)
+            if pos is not None:
+                expandidos.update(self.ids_ordenados[pos + 1:self.fin_de[pos]])
+        if permitidos is not None:
+            expandidos = {t for t in expandidos if t in permitidos or t in selected_ids}
+        return expandidos
+
+    def expandir(self, selected_ids, permitidos=None):
+        """Jerarquía + grupos: a los descendientes se añaden los temas que comparten grupo con alguno de ellos."""
+        selected_ids = set(selected_ids)
+        ids_finales = self.descendientes(selected_ids, permitidos)
+        for tema_id in list(ids_finales):
+            ids_finales.update(self.companeros_grupo.get(tema_id, ()))
+        return ids_finales
+
+
+def _huella_temas(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(SQL_HUELLA_TEMAS)
+        return tuple(int(v) for v in cursor.fetchone())
+
+
+def _construir_cierre(conn, huella):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT id, codigo FROM temas_manual WHERE codigo IS NOT NULL AND nombre IS NOT NULL AND nombre != ''")
+        temas = [{'id': int(row[0]), 'codigo': str(row[1])} for row in cursor.fetchall()]
+        cursor.execute("SELECT grupo_id, tema_id FROM tema_en_grupo")
+        filas_grupos = [(row[0], row[1]) for row in cursor.fetchall()]
+    return CierreTemas(temas, filas_grupos, huella)
+
+
+_cache_cierre = CacheHuella("el cierre de temas", _huella_temas, _construir_cierre, CIERRE_TTL_S)
+
+
+def obtener_cierre_temas(conn, forzar=False):
+    """
+    Devuelve el cierre vigente. Mismo esquema que obtener_indice_preguntas: solo consulta la BD
+    si no existe, si se fuerza o si ha cambiado la huella (comprobada como mucho cada CIERRE_TTL_S).
+    """
+    return _cache_cierre.obtener(conn, forzar)
+
+
+def invalidar_cierre_temas():
+    """Fuerza la reconstrucción en el próximo acceso (p. ej. tras editar temas o grupos)."""
+    _cache_cierre.invalidar()
@@ -0,0 +1,341 @@
+# core/cola_stats.py
+# Cola persistente para el procesamiento de estadísticas de los quizzes finalizados.
+#
+# Sustituye al hilo daemon que se lanzaba por cada quiz:
+# - Los envíos se escriben primero en un diario SQLite local (data/cache/cola_stats.sqlite3),
+#   así que sobreviven a un reinicio del proceso y se retoman al arrancar.
+# - Un número fijo de hilos trabajadores (COLA_STATS_WORKERS) los procesa contra PostgreSQL.
+# - Cada envío tiene como clave el intento_id del quiz: reenviar el mismo intento no lo encola dos
+#   veces, y stats_handler garantiza además en la BD que un intento solo se suma una vez, así que
+#   los reintentos y los trabajadores en paralelo son seguros.
+# - Los errores transitorios (conexión, interbloqueos...) se reintentan con backoff exponencial;
+#   los permanentes, o agotar COLA_STATS_MAX_INTENTOS, dejan el trabajo como 'fallido' en el diario.
+# - Cuando la cola se queda vacía tras procesar algo, un trabajador lanza los rollups incrementales
+#   (core/rollup_stats.py), agrupando en una sola pasada los quizzes llegados entretanto.
+# - Al salir del proceso se intenta vaciar la cola durante COLA_STATS_DRENAJE_S segundos.
+import os
+import json
+import time
+import random
+import atexit
+import sqlite3
+import uuid
+import hashlib
+import threading
+import logging
+
+import psycopg2
+
+from core.database import DatabaseConnectionError, conexion_db
+from core.rollup_stats import ejecutar_rollups
+from core.stats_handler import registrar_quiz_finalizado
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración (sobrescribible por variables de entorno) ---
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COLA_STATS_DB = os.environ.get('COLA_STATS_DB', os.path.join(project_root, 'data', 'cache', 'cola_stats.sqlite3'))
+COLA_STATS_WORKERS = int(os.environ.get('COLA_STATS_WORKERS', 2))
+COLA_STATS_MAX_INTENTOS = int(os.environ.get('COLA_STATS_MAX_INTENTOS', 8))
+COLA_STATS_BACKOFF_BASE_S = float(os.environ.get('COLA_STATS_BACKOFF_BASE', 2))
+COLA_STATS_BACKOFF_MAX_S = float(os.environ.get('COLA_STATS_BACKOFF_MAX', 300))
+# Un trabajo 'en_curso' cuyo arrendamiento ha caducado (proceso caído) vuelve a estar disponible.
+COLA_STATS_ARRIENDO_S = float(os.environ.get('COLA_STATS_ARRIENDO', 600))
+COLA_STATS_DRENAJE_S = float(os.environ.get('COLA_STATS_DRENAJE', 10))
+# Por encima de este número de pendientes se avisa en el log (la cola sigue aceptando trabajos).
+COLA_STATS_AVISO_PENDIENTES = int(os.environ.get('COLA_STATS_AVISO_PENDIENTES', 200))
+COLA_STATS_RETENCION_HECHOS_S = 7 * 86400
+# Espera de un trabajador tras un error del propio diario SQLite.
+COLA_STATS_ESPERA_ERROR_S = float(os.environ.get('COLA_STATS_ESPERA_ERROR', 5))
+
+ERRORES_TRANSITORIOS = (DatabaseConnectionError, psycopg2.OperationalError, psycopg2.InterfaceError)
+
+DDL_DIARIO = """
+    CREATE TABLE IF NOT EXISTS trabajos (
+        clave TEXT PRIMARY KEY,
+        usuario_id INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        estado TEXT NOT NULL DEFAULT 'pendiente',
+        intentos INTEGER NOT NULL DEFAULT 0,
+        proximo_intento REAL NOT NULL,
+        arriendo_hasta REAL,
+        ultimo_error TEXT,
+        creado_en REAL NOT NULL,
+        actualizado_en REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_trabajos_estado ON trabajos (estado, proximo_intento);
+"""
+
+
+def clave_idempotencia(usuario_id, respuestas):
+    """
+    intento_id determinista para envíos que no traen uno: el mismo quiz (usuario + respuestas
+    con su fecha) da siempre el mismo UUID.
+    """
+    canonico = json.dumps([usuario_id, sorted(respuestas, key=lambda r: (str(r.get('fecha_respuesta')), str(r.get('pregunta_id'))))],
+                          sort_keys=True, default=str)
+    return str(uuid.UUID(hashlib.sha256(canonico.encode('utf-8')).hexdigest()[:32]))
+
+
+def _intento_de_clave(clave):
+    """Las claves son intento_id; las de diarios anteriores (sha256 en hex) se convierten a UUID."""
+    try:
+        return str(uuid.UUID(clave))
+    except ValueError:
+        return str(uuid.UUID(hashlib.sha256(clave.encode('utf-8')).hexdigest()[:32]))
+
+
+class ColaStats:
+    def __init__(self, ruta_db=COLA_STATS_DB, num_workers=COLA_STATS_WORKERS, procesar=registrar_quiz_finalizado,
+                 al_vaciar=None):
+        self.ruta_db = ruta_db
+        self.num_workers = max(1, num_workers)
+        self._procesar = procesar
+        self._al_vaciar = al_vaciar
+        self._hay_procesados = False
+        self._condicion = threading.Condition()
+        self._parar = False
+        self._hilos = []
+        self._en_curso = 0
+        self.metricas_proceso = {'encolados': 0, 'duplicados': 0, 'procesados': 0, 'reintentos': 0,
+                                 'fallidos': 0, 'segundos_proceso_total': 0.0}
+        os.makedirs(os.path.dirname(self.ruta_db), exist_ok=True)
+        with self._conexion() as db:
+            db.executescript(DDL_DIARIO)
+
+    def _conexion(self):
+        db = sqlite3.connect(self.ruta_db, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return _ConexionSQLite(db)
+
+    # --- Productor ---
+    def encolar(self, usuario_id, respuestas, intento_id=None):
+        """Persiste el envío y despierta a un trabajador. Devuelve la clave (intento_id); es idempotente por clave."""
+        clave = str(intento_id) if intento_id else clave_idempotencia(usuario_id, respuestas)
+        ahora = time.time()
+        with self._conexion() as db:
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO trabajos (clave, usuario_id, payload, proximo_intento, creado_en, actualizado_en) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (clave, usuario_id, json.dumps(respuestas, default=str), ahora, ahora, ahora),
+            )
+            nuevo = cursor.rowcount == 1
+            pendientes = db.execute("SELECT count(*) FROM trabajos WHERE estado = 'pendiente'").fetchone()[0]
+        with self._condicion:
+            self.metricas_proceso['encolados' if nuevo else 'duplicados'] += 1
+            self._condicion.notify()
+        if not nuevo:
+            logger.info(f"Envío de estadísticas duplicado ignorado (clave {clave[:12]}).")
+        if pendientes > COLA_STATS_AVISO_PENDIENTES:
+            logger.warning(f"Cola de estadísticas saturada: {pendientes} trabajos pendientes.")
+        self.iniciar()
+        return clave
+
+    # --- Trabajadores ---
+    def iniciar(self):
+        with self._condicion:
+            if self._hilos or self._parar:
+                return
+            for i in range(self.num_workers):
+                hilo = threading.Thread(target=self._bucle, name=f"cola-stats-{i}", daemon=True)
+                hilo.start()
+                self._hilos.append(hilo)
+        logger.info(f"Cola de estadísticas iniciada con {self.num_workers} trabajadores ({self.ruta_db}).")
+
+    def _reclamar(self, db):
+        """Toma el siguiente trabajo vencido (pendiente o con arrendamiento caducado). Devuelve fila o None."""
+        ahora = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            fila = db.execute(
+                """
+                SELECT clave, usuario_id, payload, intentos FROM trabajos
+                WHERE (estado = 'pendiente' AND proximo_intento <= ?) OR (estado = 'en_curso' AND arriendo_hasta < ?)
+                ORDER BY proximo_intento LIMIT 1
+                """,
+                (ahora, ahora),
+            ).fetchone()
+            if fila is not None:
+                db.execute(
+                    "UPDATE trabajos SET estado = 'en_curso', arriendo_hasta = ?, actualizado_en = ? WHERE clave = ?",
+                    (ahora + COLA_STATS_ARRIENDO_S, ahora, fila[0]),
+                )
+            db.execute("COMMIT")
+            return fila
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _siguiente_vencimiento(self, db):
+        fila = db.execute("SELECT min(proximo_intento) FROM trabajos WHERE estado = 'pendiente'").fetchone()
+        return fila[0] if fila and fila[0] is not None else None
+
+    def _bucle(self):
+        # Un error del diario (p. ej. "database is locked" con varios procesos en WAL) no puede terminar
+        # el hilo: iniciar() no lo repondría y la cola dejaría de vaciarse. Se reabre la conexión tras
+        # una espera; un trabajo que quedase 'en_curso' se retoma al caducar su arrendamiento.
+        ultima_purga = 0.0
+        while True:
+            try:
+                with self._conexion() as db:
+                    while True:
+                        with self._condicion:
+                            if self._parar:
+                                return
+                        fila = self._reclamar(db)
+
+                        if fila is None:
+                            self._tras_vaciar()
+                            vencimiento = self._siguiente_vencimiento(db)
+                            espera = 5.0 if vencimiento is None else min(5.0, max(0.05, vencimiento - time.time()))
+                            with self._condicion:
+                                if not self._parar:
+                                    self._condicion.wait(espera)
+                            if time.time() - ultima_purga > 3600:
+                                db.execute("DELETE FROM trabajos WHERE estado = 'hecho' AND actualizado_en < ?",
+                                           (time.time() - COLA_STATS_RETENCION_HECHOS_S,))
+                                ultima_purga = time.time()
+                            continue
+
+                        self._ejecutar(db, *fila)
+            except Exception as e:
+                logger.error(f"Error en el diario de la cola de estadísticas; se reintenta en "
+                             f"{COLA_STATS_ESPERA_ERROR_S:g}s: {e}", exc_info=True)
+                with self._condicion:
+                    if self._parar:
+                        return
+                    self._condicion.wait(COLA_STATS_ESPERA_ERROR_S * random.uniform(0.8, 1.2))
+
+    def _ejecutar(self, db, clave, usuario_id, payload, intentos):
+        with self._condicion:
+            self._en_curso += 1
+        inicio = time.monotonic()
+        try:
+            try:
+                self._procesar(usuario_id, json.loads(payload), _intento_de_clave(clave))
+            except Exception as e:
+                self._registrar_error(db, clave, usuario_id, intentos + 1, e)
+                return
+            # Fuera del try anterior: si falla el diario, las stats ya están en la BD y el trabajo no
+            # debe marcarse como fallido (al reintentarlo, stats_handler lo reconoce como ya sumado).
+            with self._condicion:
+                self._hay_procesados = True
+                self.metricas_proceso['procesados'] += 1
+                self.metricas_proceso['segundos_proceso_total'] += time.monotonic() - inicio
+            db.execute("UPDATE trabajos SET estado = 'hecho', intentos = ?, ultimo_error = NULL, actualizado_en = ? "
+                       "WHERE clave = ?", (intentos + 1, time.time(), clave))
+        finally:
+            with self._condicion:
+                self._en_curso -= 1
+                self._condicion.notify_all()
+
+    def _registrar_error(self, db, clave, usuario_id, intentos, e):
+        """Reprograma el trabajo con backoff si el error es transitorio; si no, lo deja como 'fallido'."""
+        if isinstance(e, ERRORES_TRANSITORIOS) and intentos < COLA_STATS_MAX_INTENTOS:
+            espera = min(COLA_STATS_BACKOFF_MAX_S, COLA_STATS_BACKOFF_BASE_S * 2 ** (intentos - 1))
+            espera *= random.uniform(0.8, 1.2)
+            db.execute("UPDATE trabajos SET estado = 'pendiente', intentos = ?, proximo_intento = ?, "
+                       "ultimo_error = ?, actualizado_en = ? WHERE clave = ?",
+                       (intentos, time.time() + espera, repr(e), time.time(), clave))
+            logger.warning(f"Stats del quiz {clave[:12]} fallaron (intento {intentos}); reintento en {espera:.0f}s: {e}")
+            with self._condicion:
+                self.metricas_proceso['reintentos'] += 1
+        else:
+            db.execute("UPDATE trabajos SET estado = 'fallido', intentos = ?, ultimo_error = ?, actualizado_en = ? "
+                       "WHERE clave = ?", (intentos, repr(e), time.time(), clave))
+            logger.critical(f"Stats del quiz {clave[:12]} (usuario {usuario_id}) descartadas tras {intentos} intentos: {e}",
+                            exc_info=True)
+            with self._condicion:
+                self.metricas_proceso['fallidos'] += 1
+
+    def _tras_vaciar(self):
+        with self._condicion:
+            ejecutar, self._hay_procesados = self._hay_procesados, False
+        if ejecutar and self._al_vaciar is not None:
+            try:
+                self._al_vaciar()
+            except Exception as e:
+                logger.warning(f"Error en la tarea de fin de lote de la cola de estadísticas: {e}", exc_info=True)
+
+    # --- Observabilidad y cierre ---
+    def metricas(self):
+        """Tamaño de la cola por estado, antigüedad del pendiente más viejo y contadores del proceso."""
+        with self._conexion() as db:
+            por_estado = dict(db.execute("SELECT estado, count(*) FROM trabajos GROUP BY estado").fetchall())
+            mas_antiguo = db.execute("SELECT min(creado_en) FROM trabajos WHERE estado = 'pendiente'").fetchone()[0]
+        with self._condicion:
+            metricas = dict(self.metricas_proceso)
+            metricas['en_curso_en_este_proceso'] = self._en_curso
+        metricas.update({f"cola_{estado}": por_estado.get(estado, 0) for estado in ('pendiente', 'en_curso', 'hecho', 'fallido')})
+        metricas['antiguedad_pendiente_s'] = round(time.time() - mas_antiguo, 1) if mas_antiguo else 0.0
+        if metricas['procesados']:
+            metricas['segundos_proceso_medio'] = metricas['segundos_proceso_total'] / metricas['procesados']
+        return metricas
+
+    def drenar(self, timeout=COLA_STATS_DRENAJE_S):
+        """Espera (hasta 'timeout') a que no queden trabajos vencidos ni en curso y detiene los trabajadores."""
+        limite = time.monotonic() + timeout
+        if self._hilos:
+            while time.monotonic() < limite:
+                with self._conexion() as db:
+                    vencidos = db.execute(
+                        "SELECT count(*) FROM trabajos WHERE estado = 'pendiente' AND proximo_intento <= ?", (time.time(),)
+                    ).fetchone()[0]
+                with self._condicion:
+                    if vencidos == 0 and self._en_curso == 0:
+                        break
+                    self._condicion.notify_all()
+                    self._condicion.wait(0.2)
+        with self._condicion:
+            self._parar = True
+            self._condicion.notify_all()
+        for hilo in self._hilos:
+            hilo.join(max(0.0, limite - time.monotonic()))
+        pendientes = self.metricas()['cola_pendiente']
+        if pendientes:
+            logger.warning(f"Cola de estadísticas detenida con {pendientes} trabajos pendientes; se retomarán al arrancar.")
+
+
+class _ConexionSQLite:
+    """Conexión SQLite usable como context manager que la cierra al salir."""
+
+    def __init__(self, db):
+        self._db = db
+
+    def __enter__(self):
+        return self._db
+
+    def __exit__(self, *exc):
+        self._db.close()
+        return False
+
+
+def _ejecutar_rollups():
+    with conexion_db() as conn:
+        ejecutar_rollups(conn)
+
+
+_cola_global = None
+_cola_lock = threading.Lock()
+
+
+def obtener_cola_stats():
+    """Cola del proceso. Al crearla arranca los trabajadores, que retoman lo pendiente del diario."""
+    global _cola_global
+    if _cola_global is None:
+        with _cola_lock:
+            if _cola_global is None:
+                cola = ColaStats(al_vaciar=_ejecutar_rollups)
+                cola.iniciar()
+                atexit.register(cola.drenar)
+                _cola_global = cola
+    return _cola_global
+
+
+def encolar_stats_quiz(usuario_id, respuestas, intento_id=None):
+    return obtener_cola_stats().encolar(usuario_id, respuestas, intento_id)
+
+
+def metricas_cola_stats():
+    return obtener_cola_stats().metricas()
@@ -1,40 +1,241 @@
 #database.py
-import streamlit as st
-import psycopg2
-import psycopg2.extras  # <-- IMPORTANTE: Añadir esta importación
 import os
+import time
+import atexit
+import threading
 import logging
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras  # <-- IMPORTANTE: Añadir esta importación
+
+try:
+    import streamlit as st
+except ImportError:
+    st = None
 
 logger = logging.getLogger(__name__)
 
-def conectar_db():
+# --- Configuración del Pool (sobrescribible por variables de entorno) ---
+POOL_MIN_CONEXIONES = int(os.environ.get('DB_POOL_MIN', 1))
+POOL_MAX_CONEXIONES = int(os.environ.get('DB_POOL_MAX', 10))
+POOL_TIMEOUT_ESPERA_S = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+# Segundos de inactividad a partir de los cuales se valida la conexión con un SELECT 1 al sacarla.
+POOL_VALIDAR_TRAS_S = float(os.environ.get('DB_POOL_VALIDAR_TRAS', 30))
+
+
+class DatabaseConnectionError(Exception):
+    """Excepción personalizada para problemas al conectar con la base de datos."""
+    pass
+
+
+def _parametros_conexion():
     """
-    ÚNICA función para conectarse a la BD.
-    Funciona en la nube (st.secrets) y en local (os.environ).
-    Ahora incluye DictCursor para devolver diccionarios.
+    Devuelve los parámetros de psycopg2.connect().
+    Usa st.secrets (nube) si existe 'db_connection_uri'; si no, las variables de entorno (local).
     """
-    try:
-        # Intenta usar los secretos de Streamlit (para la nube)
-        conn = psycopg2.connect(
-            st.secrets["db_connection_uri"],
-            cursor_factory=psycopg2.extras.DictCursor  # <-- AÑADIDO AQUÍ
-        )
-        logger.info("Conexión a la BD en la nube establecida con éxito.")
-        return conn
-    except Exception:
-        logger.warning("No se pudo conectar con st.secrets. Intentando con variables de entorno locales...")
+    if st is not None:
         try:
-            # Si falla, usa las variables de entorno (para desarrollo local)
-            conn = psycopg2.connect(
-                host=os.environ.get('DB_HOST'),
-                port=os.environ.get('DB_PORT'),
-                dbname=os.environ.get('DB_NAME'),
-                user=os.environ.get('DB_USER'),
-                password=os.environ.get('DB_PASSWORD'),
-                cursor_factory=psycopg2.extras.DictCursor  # <-- Y AÑADIDO AQUÍ
-            )
-            logger.info("Conexión a la BD local establecida con éxito.")
+            return {'dsn': st.secrets["db_connection_uri"]}
+        except Exception:
+            logger.debug("No hay 'db_connection_uri' en st.secrets. Usando variables de entorno locales.")
+    return {
+        'host': os.environ.get('DB_HOST'),
+        'port': os.environ.get('DB_PORT'),
+        'dbname': os.environ.get('DB_NAME'),
+        'user': os.environ.get('DB_USER'),
+        'password': os.environ.get('DB_PASSWORD'),
+    }
+
+
+class PoolConexiones:
+    """
+    Pool de conexiones PostgreSQL compartido por todo el proceso (thread-safe).
+    - Mantiene hasta 'max_conexiones' abiertas y reutiliza las ociosas (LIFO).
+    - Si el pool está agotado, espera hasta 'timeout_espera' segundos antes de fallar.
+    - Valida con SELECT 1 las conexiones que llevan más de 'validar_tras' segundos ociosas
+      y reconecta automáticamente si el servidor las ha cerrado.
+    """
+
+    def __init__(self, min_conexiones=POOL_MIN_CONEXIONES, max_conexiones=POOL_MAX_CONEXIONES,
+                 timeout_espera=POOL_TIMEOUT_ESPERA_S, validar_tras=POOL_VALIDAR_TRAS_S):
+        self.min_conexiones = max(0, min(min_conexiones, max_conexiones))
+        self.max_conexiones = max(1, max_conexiones)
+        self.timeout_espera = timeout_espera
+        self.validar_tras = validar_tras
+
+        self._lock = threading.Lock()
+        self._semaforo = threading.BoundedSemaphore(self.max_conexiones)
+        self._ociosas = []  # [(conn, instante_ultimo_uso)]
+        self._cerrado = False
+
+        for _ in range(self.min_conexiones):
+            try:
+                self._ociosas.append((self._nueva_conexion(), time.monotonic()))
+            except DatabaseConnectionError:
+                # No es fatal: se reintentará al pedir la primera conexión.
+                break
+
+    def _nueva_conexion(self):
+        try:
+            conn = psycopg2.connect(cursor_factory=psycopg2.extras.DictCursor, **_parametros_conexion())
+            logger.info("Nueva conexión física a la BD abierta para el pool.")
             return conn
-        except Exception as e_local:
-            logger.critical(f"Error fatal al conectar a la BD: {e_local}")
-            return None
\ No newline at end of file
+        except Exception as e:
+            msg = f"Error fatal al conectar a la BD: {e}"
+            logger.critical(msg, exc_info=True)
+            raise DatabaseConnectionError(msg) from e
+
+    def _es_valida(self, conn, ultimo_uso):
+        if conn.closed:
+            return False
+        if time.monotonic() - ultimo_uso < self.validar_tras:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logger.warning(f"Conexión del pool descartada al validarla: {e}")
+            return False
+
+    @staticmethod
+    def _cerrar_silenciosamente(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def obtener(self):
+        """Saca una conexión válida del pool. Lanza DatabaseConnectionError si no es posible."""
+        if self._cerrado:
+            raise DatabaseConnectionError("El pool de conexiones está cerrado.")
+        if not self._semaforo.acquire(timeout=self.timeout_espera):
+            raise DatabaseConnectionError(
+                f"Pool agotado: ninguna conexión libre tras {self.timeout_espera}s (máx. {self.max_conexiones})."
+            )
+        try:
+            while True:
+                with self._lock:
+                    candidata = self._ociosas.pop() if self._ociosas else None
+                if candidata is None:
+                    return self._nueva_conexion()
+                conn, ultimo_uso = candidata
+                if self._es_valida(conn, ultimo_uso):
+                    return conn
+                self._cerrar_silenciosamente(conn)
+        except BaseException:
+            self._semaforo.release()
+            raise
+
+    def devolver(self, conn, descartar=False):
+        """Devuelve una conexión al pool dejándola en estado limpio (sin transacción abierta)."""
+        try:
+            if not descartar and not conn.closed:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    descartar = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        descartar = True
+            if descartar or conn.closed or self._cerrado:
+                self._cerrar_silenciosamente(conn)
+            else:
+                with self._lock:
+                    self._ociosas.append((conn, time.monotonic()))
+        finally:
+            self._semaforo.release()
+
+    def cerrar(self):
+        """Cierra todas las conexiones ociosas. Las prestadas se cierran al devolverse."""
+        with self._lock:
+            self._cerrado = True
+            ociosas, self._ociosas = self._ociosas, []
+        for conn, _ in ociosas:
+            self._cerrar_silenciosamente(conn)
+        logger.info("Pool de conexiones cerrado.")
+
+
+class ConexionPooled:
+    """
+    Envoltorio de compatibilidad para el código que hace conn = conectar_db() ... conn.close().
+    Delega todo en la conexión real, salvo close(), que la devuelve al pool.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, nombre):
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            raise psycopg2.InterfaceError("La conexión ya fue devuelta al pool.")
+        return getattr(conn, nombre)
+
+    @property
+    def closed(self):
+        return 1 if self._conn is None else self._conn.closed
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.devolver(conn)
+
+
+_pool_global = None
+_pool_lock = threading.Lock()
+
+
+def obtener_pool():
+    """Devuelve el pool del proceso, creándolo (o recreándolo tras cerrar_pool) si hace falta."""
+    global _pool_global
+    if _pool_global is None or _pool_global._cerrado:
+        with _pool_lock:
+            if _pool_global is None or _pool_global._cerrado:
+                _pool_global = PoolConexiones()
+    return _pool_global
+
+
+def cerrar_pool():
+    global _pool_global
+    with _pool_lock:
+        if _pool_global is not None:
+            _pool_global.cerrar()
+            _pool_global = None
+
+
+atexit.register(cerrar_pool)
+
+
+@contextmanager
+def conexion_db():
+    """
+    API principal de acceso a la BD:
+
+        with conexion_db() as conn:
+            ...
+
+    La conexión vuelve al pool al salir del bloque; si queda una transacción sin
+    confirmar (o hubo una excepción) se hace ROLLBACK antes de devolverla.
+    """
+    pool = obtener_pool()
+    conn = pool.obtener()
+    try:
+        yield conn
+    finally:
+        pool.devolver(conn)
+
+
+def conectar_db():
+    """
+    ÚNICA función para conectarse a la BD.
+    Funciona en la nube (st.secrets) y en local (os.environ), con DictCursor.
+    Ahora saca la conexión del pool del proceso: conn.close() la devuelve al pool.
+    Preferir 'with conexion_db() as conn:' en código nuevo.
+    """
+    pool = obtener_pool()
+    return ConexionPooled(pool, pool.obtener())
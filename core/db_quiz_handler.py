@@ -6,9 +6,17 @@ from collections import defaultdict
 import sys
 import logging
 import math
+import itertools
+
+import numpy as np
 
 # --- Importaciones de módulos locales ---
 from core.db_quiz_loader import obtener_ids_completos, obtener_temas_disponibles
+from core.indice_preguntas import obtener_indice_preguntas
+from core.seleccion_adaptativa import seleccionar_ids_adaptativas
+from core.repaso import seleccionar_ids_repaso
+from core.preguntas_vistas import obtener_preguntas_vistas, VISTAS_DIAS_EXCLUSION
+from core.examenes_oficiales import obtener_examen_oficial
 
 # --- Configuración del Logger para este módulo ---
 logger = logging.getLogger(__name__)
@@ -17,6 +25,31 @@ logger = logging.getLogger(__name__)
 ID_MICROBIOLOGIA_INICIO = 1762
 ESPECIALIDAD_BIOQUIMICA = 'BQ'
 TAMAÑO_BLOQUE_PREGUNTAS_DB = 50
+TAMAÑOS_ALEATORIO = (20, 50, 100)
+# Bloques seguidos que no caben antes de pasar a completar con teóricas.
+MAX_FALLOS_BLOQUE = 32
+
+# Preguntas seleccionadas ya enriquecidas (examen y texto del caso), en el orden de la selección,
+# en una sola consulta: la selección se hace en memoria y esto sustituye a la lectura de preguntas
+# más las de enriquecimiento. Algunos modos hacen además una lectura previa propia: las preguntas
+# vistas (Aleatorio y Personalizado con usuario), el perfil (Adaptativo) o los repasos vencidos (Repaso).
+# Si una pregunta está en varios exámenes se toma el de menor examen_id (antes, la última fila que
+# devolviese el JOIN, sin orden definido).
+SQL_PREGUNTAS_ENRIQUECIDAS = """
+    SELECT P.*, ep.examen_id AS examen_oficial_id,
+           CASE WHEN eo.id IS NOT NULL THEN json_build_object(
+               'ano', eo.ano, 'comunidad_autonoma', eo.comunidad_autonoma, 'especialidad', eo.especialidad
+           ) END AS datos_examen_completos,
+           esc.texto_escenario AS texto_escenario_completo
+    FROM unnest(%s::int[]) WITH ORDINALITY AS sel(id, orden)
+    JOIN preguntas_contenido P ON P.id = sel.id
+    LEFT JOIN LATERAL (
+        SELECT examen_id FROM examen_pregunta WHERE pregunta_id = P.id ORDER BY examen_id LIMIT 1
+    ) ep ON true
+    LEFT JOIN examenes_oficiales eo ON eo.id = ep.examen_id
+    LEFT JOIN escenarios esc ON esc.id = P.escenario_id
+    ORDER BY sel.orden
+"""
 
 # --- Mock de Streamlit ---
 try:
@@ -61,47 +94,84 @@ def obtener_texto_escenario(conn, escenario_id):
         st.error("Error al obtener el caso práctico.")
         return None
 
+def obtener_datos_examenes(conn, examen_ids):
+    """Versión en bloque de obtener_datos_examen: devuelve {examen_id: datos} con una sola consulta."""
+    ids = list({int(e) for e in examen_ids if e is not None})
+    if not ids: return {}
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT id, ano, comunidad_autonoma, especialidad FROM examenes_oficiales WHERE id = ANY(%s)", (ids,))
+            return {
+                row['id']: {'ano': row['ano'], 'comunidad_autonoma': row['comunidad_autonoma'], 'especialidad': row['especialidad']}
+                for row in cursor.fetchall()
+            }
+    except psycopg2.Error as e:
+        logger.error(f"Error SQL obteniendo datos de {len(ids)} exámenes: {e}", exc_info=True)
+        st.error("Error al obtener los datos del examen.")
+        return {}
+
+def obtener_textos_escenarios(conn, escenario_ids):
+    """Versión en bloque de obtener_texto_escenario: devuelve {escenario_id: texto} con una sola consulta."""
+    ids = list({int(e) for e in escenario_ids if e is not None})
+    if not ids: return {}
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT id, texto_escenario FROM escenarios WHERE id = ANY(%s)", (ids,))
+            return {row['id']: row['texto_escenario'] for row in cursor.fetchall()}
+    except psycopg2.Error as e:
+        logger.error(f"Error SQL obteniendo {len(ids)} escenarios: {e}", exc_info=True)
+        st.error("Error al obtener el caso práctico.")
+        return {}
+
+def enriquecer_preguntas(conn, preguntas, incluir_datos_examen=True):
+    """
+    Devuelve copias de las preguntas con 'datos_examen_completos' y 'texto_escenario_completo'.
+    Resuelve todos los exámenes y escenarios del quiz en dos consultas, sea cual sea su tamaño.
+    """
+    examen_ids = [p.get('examen_oficial_id') for p in preguntas if p.get('examen_oficial_id')] if incluir_datos_examen else []
+    escenario_ids = [p.get('escenario_id') for p in preguntas if p.get('escenario_id')]
+
+    datos_examenes = obtener_datos_examenes(conn, examen_ids)
+    textos_escenarios = obtener_textos_escenarios(conn, escenario_ids)
+
+    enriquecidas = []
+    for preg_dict in preguntas:
+        enriched_preg = preg_dict.copy()
+        examen_id = preg_dict.get('examen_oficial_id')
+        escenario_id = preg_dict.get('escenario_id')
+        if incluir_datos_examen and examen_id:
+            enriched_preg['datos_examen_completos'] = datos_examenes.get(examen_id)
+        if escenario_id:
+            enriched_preg['texto_escenario_completo'] = textos_escenarios.get(escenario_id)
+        enriquecidas.append(enriched_preg)
+    return enriquecidas
+
 # --- Funciones de Selección de Preguntas ---
 
-def _seleccionar_ids_practicas_por_bloques(conn, n_objetivo, temas_lista=None, topic_ids=None, especialidad_usuario=None):
+def _seleccionar_ids_practicas_por_bloques(conn, n_objetivo, temas_lista=None, topic_ids=None, especialidad_usuario=None, ids_completos=None):
     if n_objetivo == 0: return []
-    
-    base_query = "FROM preguntas_contenido P"
-    joins = []
-    where_conditions = ["P.escenario_id IS NOT NULL"]
-    params = []
+
+    indice = obtener_indice_preguntas(conn)
+    mascara = ~indice.es_teorica
 
     if especialidad_usuario == ESPECIALIDAD_BIOQUIMICA:
         # El filtro se aplica directamente sobre el tema_id de pregunta_tema.
-        joins.append("JOIN pregunta_tema PT_esp ON P.id = PT_esp.pregunta_id")
-        where_conditions.append("PT_esp.tema_id < %s")
-        params.append(ID_MICROBIOLOGIA_INICIO)
+        mascara &= indice.es_bioquimica
 
     if topic_ids:
-        ids_completos = obtener_ids_completos(conn, topic_ids, temas_lista)
+        if ids_completos is None:
+            ids_completos = obtener_ids_completos(conn, topic_ids, temas_lista)
         if not ids_completos:
             return []
-        joins.append("JOIN pregunta_tema PT ON P.id = PT.pregunta_id")
-        where_conditions.append("PT.tema_id = ANY(%s)")
-        params.append(list(ids_completos))
+        mascara &= indice.mascara_temas(ids_completos)
 
-    final_query_candidatos = f"SELECT DISTINCT P.id, P.escenario_id {base_query} {' '.join(joins)} WHERE {' AND '.join(where_conditions)}"
-    
-    preguntas_candidatas_raw = []
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute(final_query_candidatos, tuple(params))
-            preguntas_candidatas_raw = cursor.fetchall()
-    except psycopg2.Error as e:
-        logger.error(f"Error SQL al seleccionar candidatos prácticos: {e}", exc_info=True)
-        raise
-
-    if not preguntas_candidatas_raw:
+    candidatas = np.flatnonzero(mascara)
+    if len(candidatas) == 0:
         return []
     
     escenarios = defaultdict(list)
-    for row in preguntas_candidatas_raw: 
-        escenarios[row['escenario_id']].append(row['id'])
+    for esc_id, preg_id in zip(indice.escenario_de[candidatas].tolist(), indice.ids(candidatas)):
+        escenarios[esc_id].append(preg_id)
     
     lista_escenario_ids_barajados = list(escenarios.keys())
     random.shuffle(lista_escenario_ids_barajados)
@@ -117,61 +187,203 @@ def _seleccionar_ids_practicas_por_bloques(conn, n_objetivo, temas_lista=None, t
             
     return ids_seleccionados_final
 
-def _seleccionar_ids_teoricas_random(conn, n_objetivo, temas_lista=None, topic_ids=None, excluir_ids=None, especialidad_usuario=None):
-    if n_objetivo == 0:
-        return []
-
-    # --- Construcción de la consulta (igual que antes) ---
-    base_query = "FROM preguntas_contenido P"
-    joins, where_conditions, params = [], ["P.escenario_id IS NULL"], []
-
-    if especialidad_usuario == ESPECIALIDAD_BIOQUIMICA:
-        joins.append("JOIN pregunta_tema PT_esp ON P.id = PT_esp.pregunta_id")
-        where_conditions.append("PT_esp.tema_id < %s")
-        params.append(ID_MICROBIOLOGIA_INICIO)
+# --- Muestreo aleatorio bajo demanda ---
+def _orden_aleatorio(n, rng, lote=64):
+    """
+    Genera los índices 0..n-1 en orden aleatorio, bajo demanda. Mientras no haya salido la mitad se
+    sortean con rechazo (coste esperado O(1) por índice, sin materializar los n); si se llega a la
+    mitad, se baraja de una vez lo que falta. Sacar los k primeros cuesta O(k) para k <= n/2.
+    """
+    tomados = set()
+    while 2 * len(tomados) < n:
+        for i in rng.integers(n, size=lote).tolist():
+            if i not in tomados:
+                tomados.add(i)
+                yield i
+                if 2 * len(tomados) >= n:
+                    break
+    if len(tomados) < n:
+        restantes = np.ones(n, dtype=bool)
+        restantes[np.fromiter(tomados, dtype=np.int64, count=len(tomados))] = False
+        yield from rng.permutation(np.flatnonzero(restantes)).tolist()
+
+def _orden_aleatorio_no_vistas_primero(n, rng, es_vista=None):
+    """Como _orden_aleatorio, pero los índices con es_vista(i) se difieren al final (en orden aleatorio)."""
+    if es_vista is None:
+        yield from _orden_aleatorio(n, rng)
+        return
+    diferidos = []
+    for i in _orden_aleatorio(n, rng):
+        if es_vista(i):
+            diferidos.append(i)
+        else:
+            yield i
+    yield from diferidos
 
+def _candidatas_teoricas(conn, indice, temas_lista=None, topic_ids=None, especialidad_usuario=None, ids_completos=None):
+    """Posiciones (en el índice) de las teóricas que pasan los filtros de especialidad y temas."""
+    candidatas = indice.teoricas_bioquimica if especialidad_usuario == ESPECIALIDAD_BIOQUIMICA else indice.teoricas
     if topic_ids:
-        ids_completos = obtener_ids_completos(conn, topic_ids, temas_lista)
+        if ids_completos is None:
+            ids_completos = obtener_ids_completos(conn, topic_ids, temas_lista)
         if not ids_completos:
-            return []
-        joins.append("JOIN pregunta_tema PT ON P.id = PT.pregunta_id")
-        where_conditions.append("PT.tema_id = ANY(%s)")
-        params.append(list(ids_completos))
-
-    if excluir_ids:
-        where_conditions.append("P.id <> ALL(%s)")
-        params.append(list(excluir_ids))
-
-    # --- Lógica de selección con la consulta SQL corregida ---
-    limit_clause = ""
-    if n_objetivo > 0:
-        limit_clause = "LIMIT %s"
-        params.append(n_objetivo)
-
-    # Consulta interna para obtener los IDs únicos que cumplen los filtros
-    inner_query = f"""
-        SELECT DISTINCT P.id 
-        FROM preguntas_contenido P
-        {' '.join(joins)}
-        WHERE {' AND '.join(where_conditions)}
+            return candidatas[:0]
+        # Igual que el JOIN con pregunta_tema: solo preguntas con algún tema de la selección.
+        candidatas = candidatas[indice.mascara_temas(ids_completos)[candidatas]]
+    return candidatas
+
+def _seleccionar_ids_teoricas_random(conn, n_objetivo, temas_lista=None, topic_ids=None, excluir_ids=None, especialidad_usuario=None, ids_completos=None, vistas=None):
     """
-    
-    # Consulta externa que ordena aleatoriamente y limita los resultados de la interna
-    final_query = f"""
-        SELECT id FROM ({inner_query}) as distinct_ids
-        ORDER BY RANDOM()
-        {limit_clause}
+    Devuelve hasta n_objetivo ids de preguntas teóricas en orden aleatorio (todas si n_objetivo == -1).
+    Los filtros (especialidad, temas, exclusiones) se resuelven sobre el índice en memoria.
+    Si ya se expandieron los temas para este quiz, pasar el resultado en ids_completos.
+    Con 'vistas' (PreguntasVistas del usuario) las preguntas vistas recientemente van al final:
+    solo se usan si no hay suficientes sin ver.
+    Sin filtro de temas se muestrea directamente sobre las teóricas del índice: coste O(n_objetivo).
     """
-    
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute(final_query, tuple(params))
-            return [row['id'] for row in cursor.fetchall()]
-    except psycopg2.Error as e:
-        logger.error(f"Error SQL al seleccionar preguntas teóricas: {e}", exc_info=True)
-        raise
+    if n_objetivo == 0:
+        return []
+
+    indice = obtener_indice_preguntas(conn)
+    candidatas = _candidatas_teoricas(conn, indice, temas_lista, topic_ids, especialidad_usuario, ids_completos)
+    if len(candidatas) == 0:
+        return []
 
-def _seleccionar_bloques_practicos_cualificados(conn, topic_ids, temas_lista):
+    excluidas = indice.mascara_ids(excluir_ids) if excluir_ids else None
+    hay_vistas = vistas is not None and len(vistas) > 0
+    rng = np.random.default_rng()
+
+    if n_objetivo == -1:
+        orden = rng.permutation(candidatas)
+        if excluidas is not None:
+            orden = orden[~excluidas[orden]]
+        if hay_vistas:
+            ya_vistas = vistas.mascara(indice)[orden]
+            orden = np.concatenate([orden[~ya_vistas], orden[ya_vistas]])
+        return indice.ids(orden)
+
+    es_vista = (lambda i: vistas.contiene(int(indice.pregunta_ids[candidatas[i]]))) if hay_vistas else None
+    seleccion = []
+    for i in _orden_aleatorio_no_vistas_primero(len(candidatas), rng, es_vista):
+        pos = candidatas[i]
+        if excluidas is not None and excluidas[pos]:
+            continue
+        seleccion.append(pos)
+        if len(seleccion) == n_objetivo:
+            break
+    return indice.ids(np.array(seleccion, dtype=np.int64))
+
+def _subconjunto_en_rango(tamanos, minimo, maximo):
+    """
+    Posiciones de un subconjunto de 'tamanos' cuya suma sea la mayor posible dentro de
+    [minimo, maximo] (mochila 0/1, una sola tabla hasta 'maximo'), o None si ninguna cae en el rango.
+    """
+    if maximo < 0 or minimo > maximo:
+        return None
+    alcanzable = np.zeros((len(tamanos) + 1, maximo + 1), dtype=bool)
+    alcanzable[0, 0] = True
+    for k, tamano in enumerate(tamanos):
+        alcanzable[k + 1] = alcanzable[k]
+        if 0 < tamano <= maximo:
+            alcanzable[k + 1, tamano:] |= alcanzable[k, :maximo + 1 - tamano]
+    sumas = np.flatnonzero(alcanzable[-1, max(minimo, 0):]) + max(minimo, 0)
+    if not len(sumas):
+        return None
+    seleccion, resto = [], int(sumas[-1])
+    for k in range(len(tamanos), 0, -1):
+        if not alcanzable[k - 1, resto]:
+            seleccion.append(k - 1)
+            resto -= tamanos[k - 1]
+    return seleccion
+
+def _llenar_olla(indice, num_bloques, bloque, preguntas_en_bloques, teoricas, n_total, vistas=None, proporcion_teoricas=None):
+    """
+    Llena el quiz con "unidades" en orden aleatorio: bloques de prácticas completos (bloque(i) devuelve
+    los ids del i-ésimo) y teóricas sueltas (posiciones del índice). Las unidades se sortean bajo
+    demanda y se para en cuanto el quiz está lleno, así que se visitan del orden de n_total.
+
+    Las teóricas se reservan para el final: primero se meten bloques hasta el cupo de prácticas
+    (n_total - round(n_total * proporcion_teoricas)) y después las teóricas, de tamaño 1, completan
+    exactamente lo que falte. Sin proporción se usa la de la olla completa: teóricas frente al total
+    de preguntas candidatas (preguntas_en_bloques es el número de preguntas de todos los bloques).
+    Si no quedan teóricas suficientes se vuelve a los bloques con todo el hueco libre y, como último
+    recurso, se busca una combinación de bloques que las teóricas completen exactamente: el quiz
+    solo queda corto si no existe.
+    """
+    rng = np.random.default_rng()
+    hay_vistas = vistas is not None and len(vistas) > 0
+    vista_bloque = (lambda i: vistas.alguna(bloque(i))) if hay_vistas else None
+    vista_teorica = (lambda j: vistas.contiene(int(indice.pregunta_ids[teoricas[j]]))) if hay_vistas else None
+
+    if proporcion_teoricas is None:
+        # Mezcla natural: la de una olla con todas las unidades, en la que cada hueco sale de una
+        # pregunta teórica o práctica en proporción a cuántas hay.
+        total_candidatas = len(teoricas) + preguntas_en_bloques
+        proporcion_teoricas = len(teoricas) / total_candidatas if total_candidatas else 0.0
+    cupo_practicas = n_total - round(n_total * min(max(proporcion_teoricas, 0.0), 1.0))
+
+    unidades, teoricas_tomadas, num_seleccionadas = [], [], 0
+    bloques_sorteados = _orden_aleatorio_no_vistas_primero(num_bloques, rng, vista_bloque)
+    descartados = []
+
+    def meter_bloques(cupo, candidatos, max_fallos=MAX_FALLOS_BLOQUE):
+        nonlocal num_seleccionadas
+        fallos = 0
+        for i in candidatos:
+            ids_bloque = bloque(i)
+            if num_seleccionadas + len(ids_bloque) <= cupo:
+                unidades.append(ids_bloque)
+                num_seleccionadas += len(ids_bloque)
+                fallos = 0
+            else:
+                descartados.append(i)
+                fallos += 1
+            if num_seleccionadas >= cupo or fallos >= max_fallos:
+                return
+
+    # 1. Bloques de prácticas hasta su cupo.
+    if cupo_practicas > 0 and num_bloques:
+        meter_bloques(cupo_practicas, bloques_sorteados)
+
+    # 2. Teóricas sueltas hasta llenar.
+    if num_seleccionadas < n_total:
+        for j in _orden_aleatorio_no_vistas_primero(len(teoricas), rng, vista_teorica):
+            teoricas_tomadas.append([int(indice.pregunta_ids[teoricas[j]])])
+            num_seleccionadas += 1
+            if num_seleccionadas == n_total:
+                break
+
+    # 3. Sin teóricas suficientes: más bloques en el hueco restante (los descartados también pueden caber).
+    if num_seleccionadas < n_total and num_bloques:
+        pendientes, descartados[:] = descartados[:], []
+        meter_bloques(n_total, itertools.chain(pendientes, bloques_sorteados), max_fallos=num_bloques)
+
+    # 4. Si aun así falta, se busca una combinación de bloques que, completada con teóricas, dé
+    #    exactamente n_total: cualquier suma entre n_total - teóricas disponibles y n_total sirve,
+    #    y se prefiere la mayor (la que deja fuera menos bloques); las teóricas sobrantes se quitan.
+    if num_seleccionadas < n_total and num_bloques:
+        orden = rng.permutation(num_bloques).tolist()
+        bloques = [bloque(i) for i in orden]
+        combinacion = _subconjunto_en_rango([len(b) for b in bloques], n_total - len(teoricas_tomadas), n_total)
+        if combinacion is not None:
+            unidades = [bloques[k] for k in combinacion]
+            del teoricas_tomadas[n_total - sum(len(b) for b in unidades):]
+
+    # Bloques y teóricas se presentan intercalados, como en la olla original.
+    unidades += teoricas_tomadas
+    random.shuffle(unidades)
+    return [pid for unidad in unidades for pid in unidad]
+
+def _priorizar_no_vistas(unidades, vistas):
+    """Reordena (de forma estable) las unidades ya barajadas: primero las que no tienen ninguna pregunta vista."""
+    if vistas is None or not len(vistas):
+        return unidades
+    sin_ver, vistas_recientes = [], []
+    for unidad in unidades:
+        (vistas_recientes if vistas.alguna(unidad) else sin_ver).append(unidad)
+    return sin_ver + vistas_recientes
+
+def _seleccionar_bloques_practicos_cualificados(conn, topic_ids, temas_lista, ids_completos=None):
     """
     Selecciona bloques de preguntas prácticas garantizando su integridad temática.
     Un bloque se considera "cualificado" si más del 50% de sus preguntas 
@@ -181,51 +393,61 @@ def _seleccionar_bloques_practicos_cualificados(conn, topic_ids, temas_lista):
         logger.warning("No se proporcionaron topic_ids para cualificar bloques prácticos.")
         return {}
 
-    ids_completos_jerarquia = obtener_ids_completos(conn, topic_ids, temas_lista)
+    ids_completos_jerarquia = ids_completos if ids_completos is not None else obtener_ids_completos(conn, topic_ids, temas_lista)
     if not ids_completos_jerarquia:
         logger.warning("La jerarquía de temas no devolvió IDs, no se pueden cualificar bloques.")
         return {}
 
-    logger.info(f"Cualificando bloques prácticos para la jerarquía de temas: {ids_completos_jerarquia}")
+    logger.info(f"Cualificando bloques prácticos para {len(ids_completos_jerarquia)} temas de la jerarquía.")
     
-    sql_mapa_escenarios = """
-        SELECT p.id as pregunta_id, p.escenario_id, pt.tema_id
-        FROM preguntas_contenido p
-        JOIN pregunta_tema pt ON p.id = pt.pregunta_id
-        WHERE p.escenario_id IS NOT NULL;
-    """
     try:
-        with conn.cursor() as cursor:
-            cursor.execute(sql_mapa_escenarios)
-            mapa_escenarios_raw = cursor.fetchall()
+        indice = obtener_indice_preguntas(conn)
     except psycopg2.Error as e:
-        logger.error(f"Error SQL en pre-búsqueda de mapa de escenarios: {e}", exc_info=True)
+        logger.error(f"Error SQL al cargar el índice de preguntas: {e}", exc_info=True)
         st.error("Error al analizar los casos prácticos.")
         return {}
 
-    if not mapa_escenarios_raw: return {}
-
-    escenarios_data = defaultdict(lambda: {'miembros': set(), 'temas': []})
-    for row in mapa_escenarios_raw:
-        escenarios_data[row['escenario_id']]['miembros'].add(row['pregunta_id'])
-        escenarios_data[row['escenario_id']]['temas'].append(row['tema_id'])
-    
-    bloques_cualificados = {}
-    for esc_id, data in escenarios_data.items():
-        total_preguntas_en_bloque = len(data['miembros'])
-        if total_preguntas_en_bloque == 0: continue
-        
-        coincidencias = sum(1 for tema in data['temas'] if tema in ids_completos_jerarquia)
-        
-        if (coincidencias / total_preguntas_en_bloque) >= 0.5:
-            bloques_cualificados[esc_id] = sorted(list(data['miembros']))
-            
+    # Como en el JOIN original, solo cuentan como miembros las preguntas con algún tema.
+    bloques_cualificados = {
+        int(indice.escenario_ids[pos_esc]): indice.ids(indice.miembros_con_tema_de_escenario(pos_esc))
+        for pos_esc in indice.escenarios_cualificados(ids_completos_jerarquia).tolist()
+    }
     logger.info(f"Se cualificaron {len(bloques_cualificados)} bloques prácticos.")
     return bloques_cualificados
 
-def obtener_preguntas_para_cuestionario(conn, config_quiz, temas_lista=None, especialidad_usuario=None):
+def _ajustar_enriquecidas(preguntas, incluir_datos_examen=True):
+    """Deja las claves de enriquecimiento igual que enriquecer_preguntas: solo si hay examen / caso práctico."""
+    for preg in preguntas:
+        if not (incluir_datos_examen and preg.get('examen_oficial_id')):
+            preg.pop('datos_examen_completos', None)
+        if not preg.get('escenario_id'):
+            preg.pop('texto_escenario_completo', None)
+    return preguntas
+
+def construir_cuestionario(conn, config_quiz, temas_lista=None, especialidad_usuario=None):
+    """
+    Equivale a obtener_preguntas_para_cuestionario + enriquecer_preguntas (sin datos de examen en el
+    modo Oficial), pero trae las preguntas ya enriquecidas y ordenadas en una sola consulta, más la
+    lectura propia del modo si la tiene (vistas, perfil o repasos; ver SQL_PREGUNTAS_ENRIQUECIDAS).
+    Los exámenes oficiales salen de la caché del proceso (core/examenes_oficiales.py), sin consultas.
+    """
+    if config_quiz.get('modo') == "Oficial":
+        try:
+            preguntas = obtener_examen_oficial(config_quiz.get('ano'), config_quiz.get('ca'), config_quiz.get('esp'), conn)
+        except psycopg2.Error as e:
+            logger.error(f"Error SQL cargando la caché de exámenes oficiales: {e}", exc_info=True)
+            conn.rollback()
+            preguntas = None
+        if preguntas:
+            logger.info(f"Modo Oficial: {len(preguntas)} preguntas desde la caché.")
+            return preguntas
+    return obtener_preguntas_para_cuestionario(conn, config_quiz, temas_lista, especialidad_usuario, enriquecer=True)
+
+def obtener_preguntas_para_cuestionario(conn, config_quiz, temas_lista=None, especialidad_usuario=None, enriquecer=False):
     """
     Función principal que construye y devuelve la lista de preguntas para un quiz.
+    Con enriquecer=True las preguntas incluyen ya 'datos_examen_completos' y 'texto_escenario_completo'
+    (ver construir_cuestionario).
     """
     logger.info(f"Obteniendo preguntas para config: {config_quiz}, Esp: {especialidad_usuario}")
     if temas_lista is None: temas_lista = [] 
@@ -247,14 +469,21 @@ def obtener_preguntas_para_cuestionario(conn, config_quiz, temas_lista=None, esp
                         pc.*,
                         ep.examen_id as examen_oficial_id,
                         ep.numero_pregunta
+                        {columnas_escenario}
                     FROM preguntas_contenido pc
                     JOIN examen_pregunta ep ON pc.id = ep.pregunta_id
                     JOIN examenes_oficiales eo ON ep.examen_id = eo.id
+                    {join_escenario}
                     WHERE eo.ano = %s AND eo.comunidad_autonoma = %s AND eo.especialidad = %s
                     ORDER BY ep.numero_pregunta ASC;
-                """
+                """.format(
+                    columnas_escenario=", esc.texto_escenario AS texto_escenario_completo" if enriquecer else "",
+                    join_escenario="LEFT JOIN escenarios esc ON esc.id = pc.escenario_id" if enriquecer else "",
+                )
                 cursor.execute(sql_oficial, (ano, ca, esp))
                 lista_preguntas_final = [dict(row) for row in cursor.fetchall()]
+                if enriquecer:
+                    _ajustar_enriquecidas(lista_preguntas_final, incluir_datos_examen=False)
                 
                 if not lista_preguntas_final:
                     logger.warning(f"No se encontraron preguntas para el examen {ano}-{ca}-{esp}")
@@ -271,7 +500,8 @@ def obtener_preguntas_para_cuestionario(conn, config_quiz, temas_lista=None, esp
         N_total = 20 
         # 1. PRIMERO, comprobamos si estamos en el modo especial "Aleatorio".
         if modo == "Libre-Aleatorio":
-            N_total = random.choice([20, 50, 100])
+            # 'tamano_fijo' lo usa la reserva de cuestionarios (core/pool_cuestionarios.py) para construir uno de cada tamaño.
+            N_total = num_preg_solicitado if config_quiz.get('tamano_fijo') and num_preg_solicitado in TAMAÑOS_ALEATORIO else random.choice(TAMAÑOS_ALEATORIO)
             config_quiz['numero_preguntas'] = N_total # Actualizamos el config para consistencia
         
         # 2. SI NO, entonces comprobamos si el usuario ha especificado un número.
@@ -281,16 +511,24 @@ def obtener_preguntas_para_cuestionario(conn, config_quiz, temas_lista=None, esp
         ids_preguntas_seleccionadas = []
         order_by_clause_final_fetch = ""
 
+        # Preguntas vistas por el usuario en los últimos días: los modos aleatorios las dejan al final.
+        vistas = None
+        if modo in ("Libre-Aleatorio", "Libre-Personalizado"):
+            vistas = obtener_preguntas_vistas(conn, config_quiz.get('usuario_id'), config_quiz.get('excluir_vistas_dias', VISTAS_DIAS_EXCLUSION))
+
         if modo == "Libre-Personalizado":
+            # La expansión de temas (jerarquía + grupos) se calcula una sola vez por quiz.
+            ids_completos = obtener_ids_completos(conn, topic_ids, temas_lista) if topic_ids else None
             if tipo_preg == "Teóricas":
-                ids_preguntas_seleccionadas = _seleccionar_ids_teoricas_random(conn, N_total, temas_lista, topic_ids, especialidad_usuario=especialidad_usuario)
+                ids_preguntas_seleccionadas = _seleccionar_ids_teoricas_random(conn, N_total, temas_lista, topic_ids, especialidad_usuario=especialidad_usuario, ids_completos=ids_completos, vistas=vistas)
             elif tipo_preg == "Prácticas":
                 # 1. Obtenemos TODOS los bloques cualificados usando nuestra nueva función inteligente.
-                bloques_candidatos = _seleccionar_bloques_practicos_cualificados(conn, topic_ids, temas_lista)
+                bloques_candidatos = _seleccionar_bloques_practicos_cualificados(conn, topic_ids, temas_lista, ids_completos=ids_completos)
 
                 # 2. Barajamos los bloques para que la selección sea aleatoria.
                 lista_bloques = list(bloques_candidatos.values())
                 random.shuffle(lista_bloques)
+                lista_bloques = _priorizar_no_vistas(lista_bloques, vistas)
 
                 # 3. Construimos la lista final de IDs, respetando el orden barajado.
                 #    Como este modo es solo de prácticas, los tomamos todos hasta N_total.
@@ -303,74 +541,58 @@ def obtener_preguntas_para_cuestionario(conn, config_quiz, temas_lista=None, esp
                 
             elif tipo_preg == "Ambas":
                 # --- PASO 1: OBTENER TODOS LOS CANDIDATOS DISPONIBLES ---
-                bloques_practicos_candidatos = _seleccionar_bloques_practicos_cualificados(conn, topic_ids, temas_lista)
-                ids_practicos_candidatos_flat = {pid for block in bloques_practicos_candidatos.values() for pid in block}
-                ids_teoricos_candidatos = _seleccionar_ids_teoricas_random(
-                    conn, -1, temas_lista, topic_ids, 
-                    excluir_ids=list(ids_practicos_candidatos_flat), 
-                    especialidad_usuario=especialidad_usuario
+                # Las teóricas nunca pertenecen a un escenario, así que no hace falta excluir las de los bloques.
+                indice = obtener_indice_preguntas(conn)
+                bloques_practicos_candidatos = list(_seleccionar_bloques_practicos_cualificados(conn, topic_ids, temas_lista, ids_completos=ids_completos).values())
+                teoricas_candidatas = _candidatas_teoricas(conn, indice, temas_lista, topic_ids, especialidad_usuario, ids_completos)
+
+                # --- PASO 2: "OLLA" DE UNIDADES ---
+                # Una "unidad" es o un bloque de prácticas o una teórica suelta; se sortean bajo demanda:
+                # bloques hasta el cupo de prácticas y teóricas para completar exactamente N_total.
+                ids_preguntas_seleccionadas = _llenar_olla(
+                    indice, len(bloques_practicos_candidatos), bloques_practicos_candidatos.__getitem__,
+                    sum(len(b) for b in bloques_practicos_candidatos), teoricas_candidatas, N_total, vistas,
+                    proporcion_teoricas=config_quiz.get('proporcion_teoricas')
                 )
 
-                # --- PASO 2: CREAR Y BARAJAR UNA LISTA ÚNICA DE "UNIDADES" ---
-                # Una "unidad" es o un bloque de prácticas (una lista de IDs) o una teórica (una lista con un solo ID).
-                unidades_practicas = list(bloques_practicos_candidatos.values())
-                unidades_teoricas = [[id_teo] for id_teo in ids_teoricos_candidatos]
-
-                todas_las_unidades = unidades_practicas + unidades_teoricas
-                random.shuffle(todas_las_unidades)
-
-                # --- PASO 3: CONSTRUIR EL QUIZ HASTA LLENARLO ---
-                ids_preguntas_seleccionadas = []
-                for unidad in todas_las_unidades:
-                    # Añadimos la unidad solo si cabe sin pasarnos del total solicitado.
-                    if len(ids_preguntas_seleccionadas) + len(unidad) <= N_total:
-                        ids_preguntas_seleccionadas.extend(unidad)
-                    
-                    # Opcional: si quieres parar en cuanto se llene, aunque no es estrictamente necesario
-                    if len(ids_preguntas_seleccionadas) == N_total:
-                        break
-                    
-        elif modo == "Libre-Aleatorio":
-            # --- PASO 1: OBTENER TODOS LOS CANDIDATOS (SIN FILTRO DE TEMA) ---
-            # Para obtener todos los bloques, llamamos a la función con una lista vacía de temas.
-            # Necesitamos una pequeña adaptación para que _seleccionar_bloques_practicos_cualificados devuelva todos si no hay topic_ids.
-            # (Asumiremos por ahora que tenemos una función _obtener_todos_los_bloques_practicos)
-            
-            # Vamos a simplificarlo por ahora: obtenemos todos los IDs y los agrupamos.
-            with conn.cursor() as cursor:
-                cursor.execute("SELECT id, escenario_id FROM preguntas_contenido WHERE escenario_id IS NOT NULL")
-                rows = cursor.fetchall()
-            
-            bloques_practicos_candidatos = defaultdict(list)
-            for row in rows:
-                bloques_practicos_candidatos[row['escenario_id']].append(row['id'])
+        elif modo == "Libre-Adaptativo":
+            # Muestreo ponderado por los fallos y el olvido de cada tema del usuario (core/seleccion_adaptativa.py).
+            usuario_id = config_quiz.get('usuario_id')
+            if usuario_id is None:
+                logger.warning("Modo Adaptativo sin usuario_id; no se puede personalizar la selección.")
+                st.error("No se pudo identificar al usuario para el modo Adaptativo.")
+                return []
+            ids_preguntas_seleccionadas = seleccionar_ids_adaptativas(conn, N_total, usuario_id, especialidad_usuario)
+
+        elif modo == "Libre-Repaso":
+            # Preguntas vencidas según la programación de repetición espaciada (core/repaso.py).
+            usuario_id = config_quiz.get('usuario_id')
+            if usuario_id is None:
+                logger.warning("Modo Repaso sin usuario_id.")
+                st.error("No se pudo identificar al usuario para el modo Repaso.")
+                return []
+            ids_preguntas_seleccionadas = seleccionar_ids_repaso(conn, usuario_id, N_total)
 
-            ids_practicos_candidatos_flat = {pid for block in bloques_practicos_candidatos.values() for pid in block}
-            
-            # Obtenemos todos los teóricos, sin filtro de tema y excluyendo los prácticos.
-            ids_teoricos_candidatos = _seleccionar_ids_teoricas_random(
-                conn, -1, temas_lista, None, 
-                excluir_ids=list(ids_practicos_candidatos_flat), 
-                especialidad_usuario=especialidad_usuario
-            )
+        elif modo == "Libre-Aleatorio":
+            # --- PASO 1: CANDIDATOS (SIN FILTRO DE TEMA) ---
+            # Todos los escenarios del índice como bloques prácticos y todas las teóricas que pasan el
+            # filtro de especialidad; ninguno se materializa hasta que sale sorteado.
+            indice = obtener_indice_preguntas(conn)
+            teoricas_candidatas = _candidatas_teoricas(conn, indice, especialidad_usuario=especialidad_usuario)
 
             # --- PASO 2: APLICAR LA MISMA LÓGICA DE "OLLA" ---
-            unidades_practicas = list(bloques_practicos_candidatos.values())
-            unidades_teoricas = [[id_teo] for id_teo in ids_teoricos_candidatos]
-
-            todas_las_unidades = unidades_practicas + unidades_teoricas
-            random.shuffle(todas_las_unidades)
+            ids_preguntas_seleccionadas = _llenar_olla(
+                indice, len(indice.escenario_ids), lambda pos_esc: indice.ids(indice.miembros_de_escenario(pos_esc)),
+                len(indice.escenario_miembros), teoricas_candidatas, N_total, vistas,
+                proporcion_teoricas=config_quiz.get('proporcion_teoricas')
+            )
 
-            # --- PASO 3: CONSTRUIR EL QUIZ HASTA LLENARLO ---
-            ids_preguntas_seleccionadas = []
-            for unidad in todas_las_unidades:
-                if len(ids_preguntas_seleccionadas) + len(unidad) <= N_total:
-                    ids_preguntas_seleccionadas.extend(unidad)
-                
-                if len(ids_preguntas_seleccionadas) == N_total:
-                    break
+        if ids_preguntas_seleccionadas and enriquecer:
+            with conn.cursor() as cursor:
+                cursor.execute(SQL_PREGUNTAS_ENRIQUECIDAS, (list(ids_preguntas_seleccionadas),))
+                lista_preguntas_final = _ajustar_enriquecidas([dict(row) for row in cursor.fetchall()])
 
-        if ids_preguntas_seleccionadas:
+        elif ids_preguntas_seleccionadas:
             final_select_query = """
             SELECT P.*, ep.examen_id as examen_oficial_id
             FROM preguntas_contenido P
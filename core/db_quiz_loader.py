@@ -10,13 +10,12 @@ import psycopg2
 import psycopg2.extras
 import streamlit as st
 
+from core.database import conectar_db, conexion_db, DatabaseConnectionError
+from core.cierre_temas import CierreTemas, obtener_cierre_temas
+
 # --- Configuración del Logger para este módulo ---
 logger = logging.getLogger(__name__)
 
-class DatabaseConnectionError(Exception):
-    """Excepción personalizada para problemas al conectar con la base de datos."""
-    pass
-
 # --- Constantes ---
 ID_MICROBIOLOGIA_INICIO = 1762
 ESPECIALIDAD_BIOQUIMICA = 'BQ'
@@ -39,23 +38,8 @@ except ImportError:
     st = _MockStreamlit()
 
 # --- Conexión Base de Datos ---
-def conectar_db():
-    logger.info("Intentando conectar a la BD...")
-    try:
-        conn = psycopg2.connect(
-            host=os.environ.get('DB_HOST'),
-            port=os.environ.get('DB_PORT'),
-            dbname=os.environ.get('DB_NAME'),
-            user=os.environ.get('DB_USER'),
-            password=os.environ.get('DB_PASSWORD'),
-            cursor_factory=psycopg2.extras.DictCursor
-        )
-        logger.info(f"Conexión a la BD establecida (Host: {os.environ.get('DB_HOST')}).")
-        return conn
-    except Exception as e:
-        msg = f"Error fatal al conectar a la BD: {e}"
-        logger.critical(msg, exc_info=True)
-        raise DatabaseConnectionError(msg) from e
+# La conexión se delega en el pool compartido del proceso (core/database.py).
+# conectar_db() se mantiene por compatibilidad; conn.close() devuelve la conexión al pool.
 
 # --- Funciones de Obtención de Datos para Configuración ---
 def obtener_temas_disponibles(conn, especialidad_usuario=None):
@@ -102,76 +86,40 @@ def obtener_examenes_disponibles(conn):
 
 # --- Funciones Auxiliares para Selección de Temas ---
 def expandir_temas_ids(selected_ids, temas_lista):
+    """Solo jerarquía: selección + descendientes dentro de temas_lista (unión de intervalos sobre los códigos ordenados)."""
     if not selected_ids or not temas_lista: 
         return set(selected_ids)
     try:
-        id_to_codigo = {tema['id']: tema['codigo'] for tema in temas_lista}
-        codigo_to_id = {v: k for k, v in id_to_codigo.items()}
-        all_topic_codes_set = set(id_to_codigo.values())
-        
-        initial_selected_ids_set = set(selected_ids)
-        expanded_ids_set = set(initial_selected_ids_set) 
-        codes_to_expand = {id_to_codigo[sid] for sid in initial_selected_ids_set if sid in id_to_codigo}
-        
-        processed_codes = set()
-        queue = list(codes_to_expand)
-
-        while queue:
-            code_str = queue.pop(0)
-            if code_str in processed_codes: continue
-            processed_codes.add(code_str)
-            prefix = code_str + '.'
-            for potential_child_code in all_topic_codes_set:
-                if potential_child_code.startswith(prefix):
-                    child_id = codigo_to_id.get(potential_child_code)
-                    if child_id is not None:
-                        expanded_ids_set.add(child_id)
-                        if potential_child_code not in processed_codes:
-                            queue.append(potential_child_code)
-                            
-        return expanded_ids_set
+        return CierreTemas(temas_lista, []).descendientes(set(selected_ids))
     except Exception as e:
         logger.error(f"Error inesperado en expandir_temas_ids: {e}", exc_info=True)
         return set(selected_ids)
 
 def obtener_ids_completos(conn, selected_ids, temas_lista=None):
+    """
+    Selección + descendientes + temas que comparten grupo (tema_en_grupo) con alguno de ellos.
+    Usa el cierre precalculado del proceso (core/cierre_temas.py); si se pasa temas_lista,
+    la jerarquía se limita a esos temas (p. ej. la lista filtrada por especialidad).
+    Para no repetir la expansión dentro de un mismo quiz, calcularla una vez y pasar el
+    resultado a los selectores (parámetro ids_completos).
+    """
     if not conn:
         logger.error("Se requiere conexión a BD para obtener_ids_completos.")
         st.error("Error de conexión para obtener la lista completa de temas.")
         return set()
 
-    local_temas_lista = temas_lista
-    if local_temas_lista is None:
-        local_temas_lista = obtener_temas_disponibles(conn)
-        if not local_temas_lista:
-            st.warning("No se pudieron obtener los temas disponibles para la expansión.")
-
     if not selected_ids: 
         return set()
         
     initial_selected_ids = set(selected_ids) 
-    
-    ids_finales = expandir_temas_ids(initial_selected_ids, local_temas_lista)
-    
-    if not ids_finales:
-        return ids_finales
+    permitidos = {tema['id'] for tema in temas_lista} if temas_lista else None
 
-    #try:
-        with conn.cursor() as cursor:
-            related_group_ids = set()
-            query_grupos = "SELECT DISTINCT grupo_id FROM tema_en_grupo WHERE tema_id = ANY(%s)"
-            cursor.execute(query_grupos, (list(ids_finales),))
-            related_group_ids.update(row['grupo_id'] for row in cursor.fetchall())
-
-            if related_group_ids:
-                query_temas_grupo = "SELECT DISTINCT tema_id FROM tema_en_grupo WHERE grupo_id = ANY(%s)"
-                cursor.execute(query_temas_grupo, (list(related_group_ids),))
-                newly_found_ids_from_groups = {row['tema_id'] for row in cursor.fetchall()}
-                ids_finales.update(newly_found_ids_from_groups)
-
-    #except psycopg2.Error as e:
-        logger.error(f"Error SQL buscando temas por grupo: {e}", exc_info=True)
+    try:
+        ids_finales = obtener_cierre_temas(conn).expandir(initial_selected_ids, permitidos)
+    except psycopg2.Error as e:
+        logger.error(f"Error SQL cargando el cierre de temas y grupos: {e}", exc_info=True)
         st.error("Error al buscar temas relacionados por grupo.") 
+        local_temas_lista = temas_lista if temas_lista is not None else obtener_temas_disponibles(conn)
         return expandir_temas_ids(initial_selected_ids, local_temas_lista)
     
     logger.info(f"Expansión completa finalizada. Total de IDs de temas (de temas_manual): {len(ids_finales)}")
@@ -0,0 +1,226 @@
+# core/embeddings_binarios.py
+# Formato binario para manual_chunks.embedding (antes solo texto JSON).
+#
+# Columnas nuevas en manual_chunks:
+#   embedding_bin      bytea       -> vector codificado
+#   embedding_formato  varchar(8)  -> 'float32' | 'float16' | 'int8'
+#
+# Codificación (little-endian):
+#   float32 / float16: el vector tal cual.
+#   int8: 4 bytes float32 con la escala + un int8 por componente (x ≈ q * escala, simétrica por fila).
+#
+# Uso (migración única, idempotente; la columna JSON se conserva):
+#   python -m core.embeddings_binarios migrar --formato float16
+#   python -m core.embeddings_binarios informe
+import sys
+import json
+import argparse
+import logging
+
+import numpy as np
+import psycopg2
+import psycopg2.extras
+
+logger = logging.getLogger(__name__)
+
+# --- Constantes ---
+FORMATOS = ('float32', 'float16', 'int8')
+FORMATO_POR_DEFECTO = 'float32'
+TAMANO_LOTE_MIGRACION = 500
+
+DDL_COLUMNAS_BINARIAS = """
+    ALTER TABLE manual_chunks ADD COLUMN IF NOT EXISTS embedding_bin bytea;
+    ALTER TABLE manual_chunks ADD COLUMN IF NOT EXISTS embedding_formato varchar(8);
+"""
+
+SQL_EXISTE_COLUMNA_BINARIA = """
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'manual_chunks' AND column_name = 'embedding_bin'
+"""
+
+
+# --- Codificación ---
+def codificar(vector, formato=FORMATO_POR_DEFECTO):
+    """Vector -> bytes en el formato indicado."""
+    v = np.asarray(vector, dtype=np.float32).ravel()
+    if formato == 'float32':
+        return v.astype('<f4').tobytes()
+    if formato == 'float16':
+        return v.astype('<f2').tobytes()
+    if formato == 'int8':
+        maximo = float(np.abs(v).max()) if len(v) else 0.0
+        escala = maximo / 127.0 if maximo > 0 else 1.0
+        q = np.clip(np.rint(v / escala), -127, 127).astype(np.int8)
+        return np.float32(escala).astype('<f4').tobytes() + q.tobytes()
+    raise ValueError(f"Formato de embedding desconocido: {formato}")
+
+
+def decodificar_lote(buffers, formato, dimension=None):
+    """
+    Lista de buffers (bytes/memoryview) de un mismo formato -> matriz float32 (n, dimension), de solo lectura en float32.
+    Se concatena todo y se decodifica con un único np.frombuffer, sin objetos Python por componente.
+    """
+    if not buffers:
+        return np.zeros((0, dimension or 0), dtype=np.float32)
+    crudo = b''.join(bytes(b) for b in buffers)
+    n = len(buffers)
+    if formato == 'float32':
+        return np.frombuffer(crudo, dtype='<f4').reshape(n, -1).astype(np.float32, copy=False)
+    if formato == 'float16':
+        return np.frombuffer(crudo, dtype='<f2').reshape(n, -1).astype(np.float32)
+    if formato == 'int8':
+        filas = np.frombuffer(crudo, dtype=np.uint8).reshape(n, -1)
+        escalas = filas[:, :4].copy().view('<f4').astype(np.float32)
+        return filas[:, 4:].view(np.int8).astype(np.float32) * escalas
+    raise ValueError(f"Formato de embedding desconocido: {formato}")
+
+
+def decodificar(buffer, formato):
+    return decodificar_lote([buffer], formato)[0]
+
+
+def parsear_embedding_json(valor):
+    """La columna JSON puede llegar como texto ('[0.1, ...]', también pgvector) o ya como lista."""
+    if isinstance(valor, (list, tuple)):
+        return valor
+    return json.loads(valor)
+
+
+def tiene_columna_binaria(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(SQL_EXISTE_COLUMNA_BINARIA)
+        return cursor.fetchone() is not None
+
+
+def leer_embeddings_lote(filas):
+    """
+    Filas (id, embedding_bin, embedding_formato, embedding_json) -> (ids, matriz float32).
+    Las filas binarias se decodifican agrupadas por formato; las que aún no se han migrado, desde JSON.
+    """
+    if not filas:
+        return [], np.zeros((0, 0), dtype=np.float32)
+    por_formato = {}
+    for i, (_, binario, formato, _json) in enumerate(filas):
+        clave = formato if binario is not None and formato in FORMATOS else 'json'
+        por_formato.setdefault(clave, []).append(i)
+
+    bloques = {}
+    for clave, posiciones in por_formato.items():
+        if clave == 'json':
+            bloques[clave] = np.array([parsear_embedding_json(filas[i][3]) for i in posiciones], dtype=np.float32)
+        else:
+            bloques[clave] = decodificar_lote([filas[i][1] for i in posiciones], clave)
+
+    dimension = next(iter(bloques.values())).shape[1]
+    matriz = np.empty((len(filas), dimension), dtype=np.float32)
+    for clave, posiciones in por_formato.items():
+        matriz[posiciones] = bloques[clave]
+    return [fila[0] for fila in filas], matriz
+
+
+# --- Migración ---
+def migrar(conn, formato=FORMATO_POR_DEFECTO, tamano_lote=TAMANO_LOTE_MIGRACION, recodificar=False):
+    """Rellena embedding_bin desde la columna JSON. Confirma por lotes; se puede relanzar si se interrumpe."""
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato de embedding desconocido: {formato}")
+    with conn.cursor() as cursor:
+        cursor.execute(DDL_COLUMNAS_BINARIAS)
+    conn.commit()
+
+    condicion = "embedding IS NOT NULL" + ("" if recodificar else " AND embedding_bin IS NULL")
+    total, ultimo_id = 0, -1
+    while True:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"SELECT id, embedding FROM manual_chunks WHERE {condicion} AND id > %s ORDER BY id LIMIT %s",
+                (ultimo_id, tamano_lote),
+            )
+            filas = cursor.fetchall()
+            if not filas:
+                break
+            valores = [(row[0], psycopg2.Binary(codificar(parsear_embedding_json(row[1]), formato)), formato) for row in filas]
+            psycopg2.extras.execute_values(
+                cursor,
+                """
+                UPDATE manual_chunks AS mc SET embedding_bin = v.bin, embedding_formato = v.formato
+                FROM (VALUES %s) AS v(id, bin, formato) WHERE mc.id = v.id
+                """,
+                valores,
+                template="(%s, %s::bytea, %s)",
+            )
+        conn.commit()
+        total += len(filas)
+        ultimo_id = filas[-1][0]
+        logger.info(f"Migrados {total} embeddings a {formato}.")
+    return total
+
+
+# --- Informe de calidad ---
+def informe_calidad(conn, num_consultas=200, top_k=10, semilla=0):
+    """
+    Compara la búsqueda con cada formato frente a la referencia float32 (desde JSON):
+    recall@k de los top-k y error absoluto medio de la similitud coseno.
+    Como consultas se usan embeddings de chunks del propio corpus (excluyendo el propio chunk).
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT id, embedding FROM manual_chunks WHERE embedding IS NOT NULL ORDER BY id")
+        filas = cursor.fetchall()
+    if len(filas) < 2:
+        return {}  # cada consulta excluye su propio chunk: hacen falta al menos dos
+    referencia = np.array([parsear_embedding_json(row[1]) for row in filas], dtype=np.float32)
+    referencia /= np.maximum(np.linalg.norm(referencia, axis=1, keepdims=True), 1e-12)
+
+    rng = np.random.default_rng(semilla)
+    consultas_pos = rng.choice(len(referencia), min(num_consultas, len(referencia)), replace=False)
+    consultas = referencia[consultas_pos]
+    k = min(top_k, len(referencia) - 1)
+
+    def _top(matriz):
+        sim = consultas @ matriz.T
+        sim[np.arange(len(consultas_pos)), consultas_pos] = -np.inf
+        return np.argpartition(-sim, k - 1, axis=1)[:, :k], sim
+
+    top_ref, sim_ref = _top(referencia)
+    resultados = {}
+    for formato in FORMATOS:
+        matriz = decodificar_lote([codificar(v, formato) for v in referencia], formato)
+        matriz = matriz / np.maximum(np.linalg.norm(matriz, axis=1, keepdims=True), 1e-12)
+        top_fmt, sim_fmt = _top(matriz)
+        aciertos = sum(len(set(a) & set(b)) for a, b in zip(top_ref.tolist(), top_fmt.tolist()))
+        finitos = np.isfinite(sim_ref)
+        resultados[formato] = {
+            'bytes_por_vector': len(codificar(referencia[0], formato)),
+            f'recall@{k}': aciertos / (k * len(consultas_pos)),
+            'error_coseno_medio': float(np.abs(sim_ref[finitos] - sim_fmt[finitos]).mean()),
+        }
+    resultados['json_bytes_por_vector_medio'] = float(np.mean([len(str(row[1])) for row in filas]))
+    return resultados
+
+
+def main(argv=None):
+    from core.database import conexion_db
+
+    parser = argparse.ArgumentParser(description="Formato binario de los embeddings de manual_chunks.")
+    sub = parser.add_subparsers(dest='orden', required=True)
+    p_migrar = sub.add_parser('migrar', help="Rellena embedding_bin desde la columna JSON.")
+    p_migrar.add_argument('--formato', choices=FORMATOS, default=FORMATO_POR_DEFECTO)
+    p_migrar.add_argument('--lote', type=int, default=TAMANO_LOTE_MIGRACION)
+    p_migrar.add_argument('--recodificar', action='store_true', help="Vuelve a codificar también las filas ya migradas.")
+    p_informe = sub.add_parser('informe', help="Calidad de búsqueda de cada formato frente a float32.")
+    p_informe.add_argument('--consultas', type=int, default=200)
+    p_informe.add_argument('--top-k', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    with conexion_db() as conn:
+        if args.orden == 'migrar':
+            total = migrar(conn, args.formato, args.lote, args.recodificar)
+            print(f"Embeddings migrados a {args.formato}: {total}")
+        else:
+            for formato, datos in informe_calidad(conn, args.consultas, args.top_k).items():
+                print(f"{formato}: {datos}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
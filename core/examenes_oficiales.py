@@ -0,0 +1,182 @@
+# core/examenes_oficiales.py
+# Caché del proceso con los exámenes oficiales: el catálogo (ano, comunidad, especialidad) y cada
+# examen completo, ya enriquecido y ordenado por numero_pregunta, con clave (ano, ca, esp).
+#
+# Los exámenes oficiales no cambian una vez cargados, así que se leen una sola vez (2 consultas,
+# al arrancar en segundo plano o en el primer acceso) y después servir el catálogo o empezar un
+# examen no toca la BD. La única invalidación es el fichero de versión EXAMENES_VERSION_FICHERO:
+# la herramienta de ingesta lo reescribe al cargar exámenes y cada proceso, al ver que ha cambiado
+# (un os.stat por acceso), recarga la caché.
+#
+# Uso desde la herramienta de ingesta, tras cargar exámenes:
+#   python -m core.examenes_oficiales --invalidar
+import os
+import sys
+import time
+import argparse
+import threading
+import logging
+
+import psycopg2
+
+from core.database import conexion_db
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración (sobrescribible por variables de entorno) ---
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMENES_VERSION_FICHERO = os.environ.get(
+    'EXAMENES_VERSION_FICHERO', os.path.join(project_root, 'data', 'cache', 'examenes_oficiales.version')
+)
+
+SQL_CATALOGO = """
+    SELECT DISTINCT ano, comunidad_autonoma, especialidad FROM examenes_oficiales
+    ORDER BY ano DESC, comunidad_autonoma ASC, especialidad ASC;
+"""
+
+# Mismo contenido que el modo Oficial de obtener_preguntas_para_cuestionario con enriquecer=True.
+SQL_PREGUNTAS_EXAMENES = """
+    SELECT pc.*, ep.examen_id AS examen_oficial_id, ep.numero_pregunta,
+           esc.texto_escenario AS texto_escenario_completo,
+           eo.ano AS _ano, eo.comunidad_autonoma AS _ca, eo.especialidad AS _esp
+    FROM preguntas_contenido pc
+    JOIN examen_pregunta ep ON pc.id = ep.pregunta_id
+    JOIN examenes_oficiales eo ON ep.examen_id = eo.id
+    LEFT JOIN escenarios esc ON esc.id = pc.escenario_id
+    ORDER BY eo.ano, eo.comunidad_autonoma, eo.especialidad, ep.numero_pregunta ASC;
+"""
+
+
+def _version_fichero():
+    try:
+        return os.stat(EXAMENES_VERSION_FICHERO).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class ExamenesOficiales:
+    """Catálogo y exámenes completos (tuplas de preguntas) de una versión del fichero."""
+
+    def __init__(self, catalogo, examenes, version):
+        self.catalogo = tuple(catalogo)
+        self.examenes = examenes
+        self.version = version
+
+    def examen(self, ano, ca, esp):
+        """Copias de las preguntas del examen (se pueden modificar sin tocar la caché), o None si no existe."""
+        preguntas = self.examenes.get((ano, ca, esp))
+        return [dict(p) for p in preguntas] if preguntas is not None else None
+
+
+def _cargar(conn, version):
+    with conn.cursor() as cursor:
+        cursor.execute(SQL_CATALOGO)
+        catalogo = [dict(row) for row in cursor.fetchall()]
+        cursor.execute(SQL_PREGUNTAS_EXAMENES)
+        examenes = {}
+        for row in cursor.fetchall():
+            preg = dict(row)
+            clave = (preg.pop('_ano'), preg.pop('_ca'), preg.pop('_esp'))
+            if not preg.get('escenario_id'):
+                preg.pop('texto_escenario_completo', None)
+            examenes.setdefault(clave, []).append(preg)
+    conn.commit()
+    examenes = {clave: tuple(preguntas) for clave, preguntas in examenes.items()}
+    logger.info(f"Exámenes oficiales cargados: {len(catalogo)} en el catálogo, {sum(len(p) for p in examenes.values())} preguntas.")
+    return ExamenesOficiales(catalogo, examenes, version)
+
+
+_examenes_actuales = None
+_lock_examenes = threading.Lock()
+
+
+def obtener_examenes_oficiales(conn=None):
+    """
+    Caché vigente; la (re)carga si no existe o si ha cambiado el fichero de versión. Sin 'conn' se
+    usa una conexión del pool solo cuando hay que cargar. Ante un error de carga se mantiene la
+    versión anterior si la hay.
+    """
+    global _examenes_actuales
+    version = _version_fichero()
+    examenes = _examenes_actuales
+    if examenes is not None and examenes.version == version:
+        return examenes
+
+    with _lock_examenes:
+        examenes = _examenes_actuales
+        if examenes is not None and examenes.version == version:
+            return examenes
+        try:
+            if conn is not None:
+                examenes = _cargar(conn, version)
+            else:
+                with conexion_db() as conn_carga:
+                    examenes = _cargar(conn_carga, version)
+        except psycopg2.Error as e:
+            if conn is not None:
+                conn.rollback()
+            if examenes is None:
+                raise
+            logger.error(f"No se pudieron recargar los exámenes oficiales; se mantiene la versión anterior: {e}", exc_info=True)
+            return examenes
+        _examenes_actuales = examenes
+    return examenes
+
+
+def obtener_catalogo_examenes(conn=None):
+    """Lista de dicts {ano, comunidad_autonoma, especialidad}, como obtener_examenes_disponibles."""
+    return [dict(ex) for ex in obtener_examenes_oficiales(conn).catalogo]
+
+
+def obtener_examen_oficial(ano, ca, esp, conn=None):
+    """Preguntas enriquecidas del examen (sin datos_examen_completos, como el modo Oficial), o None."""
+    return obtener_examenes_oficiales(conn).examen(ano, ca, esp)
+
+
+_calentamiento_lanzado = False
+_calentamiento_lock = threading.Lock()
+
+
+def _calentar():
+    try:
+        obtener_examenes_oficiales()
+    except Exception as e:
+        logger.warning(f"No se pudo precargar la caché de exámenes oficiales: {e}")
+
+
+def calentar_examenes_oficiales():
+    """Carga la caché en un hilo daemon (una vez por proceso) para que el primer acceso no espere."""
+    global _calentamiento_lanzado
+    if _calentamiento_lanzado:
+        return
+    with _calentamiento_lock:
+        if _calentamiento_lanzado:
+            return
+        _calentamiento_lanzado = True
+    threading.Thread(target=_calentar, name="calentar-examenes", daemon=True).start()
+
+
+def invalidar_examenes_oficiales():
+    """Reescribe el fichero de versión: todos los procesos recargarán la caché en su próximo acceso."""
+    os.makedirs(os.path.dirname(EXAMENES_VERSION_FICHERO), exist_ok=True)
+    with open(EXAMENES_VERSION_FICHERO, 'w', encoding='utf-8') as f:
+        f.write(f"{time.time_ns()}\n")
+    logger.info(f"Caché de exámenes oficiales invalidada ({EXAMENES_VERSION_FICHERO}).")
+
+
+# --- CLI ---
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Caché de exámenes oficiales.")
+    parser.add_argument('--invalidar', action='store_true', help="Marca los exámenes como modificados (tras una ingesta).")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.invalidar:
+        invalidar_examenes_oficiales()
+        return 0
+    examenes = obtener_examenes_oficiales()
+    print(f"{len(examenes.catalogo)} exámenes en el catálogo, {len(examenes.examenes)} con preguntas.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
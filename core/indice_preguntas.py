@@ -0,0 +1,184 @@
+# core/indice_preguntas.py
+# Índice en memoria del banco de preguntas, compartido por todo el proceso.
+# Se construye una vez (2 consultas) y se reconstruye solo cuando cambia la "huella"
+# del banco, que se comprueba como mucho cada INDICE_TTL_S segundos.
+import os
+import time
+import logging
+
+import numpy as np
+from scipy import sparse
+
+from core.cache_huella import CacheHuella
+
+logger = logging.getLogger(__name__)
+
+# --- Constantes ---
+ID_MICROBIOLOGIA_INICIO = 1762
+INDICE_TTL_S = float(os.environ.get('INDICE_PREGUNTAS_TTL', 300))
+
+SQL_HUELLA_BANCO = """
+    SELECT
+        (SELECT count(*) FROM preguntas_contenido),
+        (SELECT COALESCE(max(id), 0) FROM preguntas_contenido),
+        (SELECT COALESCE(sum(COALESCE(escenario_id, 0)::bigint), 0) FROM preguntas_contenido),
+        (SELECT count(*) FROM pregunta_tema),
+        (SELECT COALESCE(sum(pregunta_id::bigint * 31 + tema_id), 0) FROM pregunta_tema);
+"""
+
+
+def _csr(filas, columnas, num_filas):
+    """Agrupa pares (fila, columna) en formato CSR: (indptr, indices), con las columnas ordenadas por fila."""
+    orden = np.lexsort((columnas, filas))
+    indices = columnas[orden]
+    indptr = np.zeros(num_filas + 1, dtype=np.int64)
+    np.cumsum(np.bincount(filas, minlength=num_filas), out=indptr[1:])
+    return indptr, indices
+
+
+class IndicePreguntas:
+    """
+    Estructura inmutable con arrays compactos de enteros:
+    - pregunta_ids (ordenados) y, alineados con ellos, escenario de cada pregunta (-1 si es teórica).
+    - pregunta -> temas (CSR), tema -> preguntas (CSR) y escenario -> miembros (CSR).
+    - posiciones de las teóricas (teoricas, teoricas_bioquimica).
+    - matriz dispersa escenario × tema con el número de miembros de cada escenario por tema.
+    Todas las "posiciones" son índices dentro de pregunta_ids.
+    """
+
+    def __init__(self, filas_preguntas, filas_pregunta_tema, huella):
+        self.huella = huella
+        self.construido_en = time.monotonic()
+
+        datos = np.array(filas_preguntas, dtype=np.int64).reshape(-1, 2)
+        orden = np.argsort(datos[:, 0], kind='stable')
+        self.pregunta_ids = datos[orden, 0].astype(np.int32)
+        self.escenario_de = datos[orden, 1].astype(np.int32)  # -1 = sin escenario
+        self.es_teorica = self.escenario_de < 0
+        num_preguntas = len(self.pregunta_ids)
+
+        # --- pregunta <-> tema ---
+        pt = np.array(filas_pregunta_tema, dtype=np.int64).reshape(-1, 2)
+        pos = np.searchsorted(self.pregunta_ids, pt[:, 0]) if len(pt) else np.zeros(0, dtype=np.int64)
+        existe = (pos < num_preguntas)
+        existe[existe] &= self.pregunta_ids[pos[existe]] == pt[existe, 0]
+        pos, temas = pos[existe], pt[existe, 1].astype(np.int32)
+
+        self.temas_indptr, self.temas_indices = _csr(pos, temas, num_preguntas)
+        self.num_temas_de = np.diff(self.temas_indptr)
+        self.tema_ids, tema_pos = np.unique(temas, return_inverse=True)
+        self.tema_indptr, self.tema_preguntas = _csr(tema_pos.astype(np.int64), pos, len(self.tema_ids))
+
+        # Preguntas con al menos un tema "no microbiología" (filtro de especialidad BQ).
+        self.es_bioquimica = np.zeros(num_preguntas, dtype=bool)
+        self.es_bioquimica[pos[temas < ID_MICROBIOLOGIA_INICIO]] = True
+
+        # Posiciones de las teóricas (con y sin filtro BQ), densas para muestrear sin recorrer el banco.
+        self.teoricas = np.flatnonzero(self.es_teorica)
+        self.teoricas_bioquimica = np.flatnonzero(self.es_teorica & self.es_bioquimica)
+
+        # --- escenario -> miembros ---
+        practicas = np.flatnonzero(~self.es_teorica)
+        self.escenario_ids, esc_pos = np.unique(self.escenario_de[practicas], return_inverse=True)
+        self.escenario_indptr, self.escenario_miembros = _csr(esc_pos.astype(np.int64), practicas, len(self.escenario_ids))
+
+        # --- escenario × tema (para cualificar bloques prácticos) ---
+        # escenario_tema[e, t] = miembros del escenario e con el tema tema_ids[t];
+        # miembros_con_tema[e] = miembros del escenario e con algún tema.
+        pregunta_de_entrada = np.repeat(np.arange(num_preguntas), self.num_temas_de)
+        en_escenario = ~self.es_teorica[pregunta_de_entrada]
+        filas_esc = np.searchsorted(self.escenario_ids, self.escenario_de[pregunta_de_entrada[en_escenario]])
+        columnas_tema = np.searchsorted(self.tema_ids, self.temas_indices[en_escenario])
+        self.escenario_tema = sparse.csr_matrix(
+            (np.ones(len(filas_esc), dtype=np.int32), (filas_esc, columnas_tema)),
+            shape=(len(self.escenario_ids), len(self.tema_ids)),
+        )
+        con_tema = practicas[self.num_temas_de[practicas] > 0]
+        self.miembros_con_tema = np.bincount(
+            np.searchsorted(self.escenario_ids, self.escenario_de[con_tema]), minlength=len(self.escenario_ids)
+        )
+
+        logger.info(
+            f"Índice de preguntas construido: {num_preguntas} preguntas, {len(self.tema_ids)} temas, "
+            f"{len(self.escenario_ids)} escenarios."
+        )
+
+    # --- Consultas sobre el índice ---
+    def posiciones_temas(self, tema_ids):
+        """Posiciones en tema_ids de los temas dados (se ignoran los que no tienen preguntas)."""
+        buscados = np.fromiter((int(t) for t in tema_ids), dtype=np.int64)
+        pos_temas = np.searchsorted(self.tema_ids, buscados)
+        validos = pos_temas < len(self.tema_ids)
+        return pos_temas[validos][self.tema_ids[pos_temas[validos]] == buscados[validos]]
+
+    def mascara_temas(self, tema_ids):
+        """Máscara de preguntas asociadas a alguno de los temas dados."""
+        mascara = np.zeros(len(self.pregunta_ids), dtype=bool)
+        for t in self.posiciones_temas(tema_ids):
+            mascara[self.tema_preguntas[self.tema_indptr[t]:self.tema_indptr[t + 1]]] = True
+        return mascara
+
+    def mascara_ids(self, pregunta_ids):
+        """Máscara de las preguntas cuyos ids están en la colección dada."""
+        mascara = np.zeros(len(self.pregunta_ids), dtype=bool)
+        buscados = np.fromiter((int(p) for p in pregunta_ids), dtype=np.int64)
+        pos = np.searchsorted(self.pregunta_ids, buscados)
+        validos = pos < len(self.pregunta_ids)
+        pos = pos[validos][self.pregunta_ids[pos[validos]] == buscados[validos]]
+        mascara[pos] = True
+        return mascara
+
+    def escenarios_cualificados(self, tema_ids, umbral=0.5):
+        """
+        Posiciones de los escenarios en los que (pares miembro-tema de la selección) / (miembros con
+        algún tema) >= umbral. Es un producto matriz dispersa × indicador de temas.
+        """
+        indicador = np.zeros(len(self.tema_ids), dtype=np.int32)
+        indicador[self.posiciones_temas(tema_ids)] = 1
+        coincidencias = self.escenario_tema @ indicador
+        return np.flatnonzero((self.miembros_con_tema > 0) & (coincidencias >= umbral * self.miembros_con_tema))
+
+    def miembros_con_tema_de_escenario(self, posicion_escenario):
+        miembros = self.miembros_de_escenario(posicion_escenario)
+        return miembros[self.num_temas_de[miembros] > 0]
+
+    def temas_de(self, posicion):
+        return self.temas_indices[self.temas_indptr[posicion]:self.temas_indptr[posicion + 1]]
+
+    def miembros_de_escenario(self, posicion_escenario):
+        return self.escenario_miembros[self.escenario_indptr[posicion_escenario]:self.escenario_indptr[posicion_escenario + 1]]
+
+    def ids(self, posiciones):
+        """Convierte posiciones a una lista de ids de pregunta (int de Python)."""
+        return self.pregunta_ids[posiciones].tolist()
+
+
+def _huella_banco(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(SQL_HUELLA_BANCO)
+        return tuple(int(v) for v in cursor.fetchone())
+
+
+def _construir_indice(conn, huella):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT id, COALESCE(escenario_id, -1) FROM preguntas_contenido")
+        filas_preguntas = [(row[0], row[1]) for row in cursor.fetchall()]
+        cursor.execute("SELECT pregunta_id, tema_id FROM pregunta_tema")
+        filas_pregunta_tema = [(row[0], row[1]) for row in cursor.fetchall()]
+    return IndicePreguntas(filas_preguntas, filas_pregunta_tema, huella)
+
+
+_cache_indice = CacheHuella("el índice de preguntas", _huella_banco, _construir_indice, INDICE_TTL_S)
+
+
+def obtener_indice_preguntas(conn, forzar=False):
+    """
+    Devuelve el índice vigente. Solo consulta la BD si el índice no existe, si se fuerza,
+    o si ha pasado INDICE_TTL_S desde la última comprobación y la huella del banco ha cambiado.
+    """
+    return _cache_indice.obtener(conn, forzar)
+
+
+def invalidar_indice_preguntas():
+    """Fuerza la reconstrucción en el próximo acceso (p. ej. tras ingerir preguntas)."""
+    _cache_indice.invalidar()
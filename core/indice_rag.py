@@ -0,0 +1,250 @@
+# core/indice_rag.py
+# Índice vectorial de manual_chunks para el chat RAG, compartido por todo el proceso.
+# - Los embeddings se normalizan una vez y se guardan en disco como float32 (.npy),
+#   que se abre con memmap: el coste de arranque es casi nulo y la memoria la gestiona el SO.
+# - El fichero se versiona con la "huella" de la tabla (ids y versión de cada fila); si cambia, se reconstruye.
+# - Con corpus grandes se entrena además un IVF (k-means sobre los vectores) y la búsqueda
+#   solo recorre las listas más cercanas a la pregunta.
+# - Del servidor solo se traen los textos de los chunks ganadores.
+import os
+import glob
+import logging
+
+import numpy as np
+
+from core.cache_huella import CacheHuella
+from core.embeddings_binarios import leer_embeddings_lote, tiene_columna_binaria
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración (sobrescribible por variables de entorno) ---
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RAG_CACHE_DIR = os.environ.get('RAG_CACHE_DIR', os.path.join(project_root, 'data', 'cache', 'rag'))
+RAG_TTL_S = float(os.environ.get('RAG_INDICE_TTL', 300))
+# Por debajo de este número de chunks la búsqueda exacta (un único producto matriz-vector) ya es de milisegundos.
+RAG_IVF_MIN_CHUNKS = int(os.environ.get('RAG_IVF_MIN_CHUNKS', 50000))
+RAG_IVF_NPROBE = int(os.environ.get('RAG_IVF_NPROBE', 8))
+TAMANO_LOTE_LECTURA = 2000
+
+# Además de los ids, el xmin de cada fila: cambia con cualquier UPDATE (texto, embedding o migración a
+# binario), así que una reingesta en el sitio también cambia la huella, sin leer textos ni vectores.
+SQL_HUELLA_CHUNKS = """
+    SELECT count(*), COALESCE(max(id), 0), COALESCE(sum(id::bigint), 0),
+           md5(COALESCE(string_agg(xmin::text, ',' ORDER BY id), ''))
+    FROM manual_chunks
+"""
+
+
+def _normalizar_filas(matriz):
+    normas = np.linalg.norm(matriz, axis=1, keepdims=True)
+    normas[normas == 0] = 1.0
+    return (matriz / normas).astype(np.float32, copy=False)
+
+
+def _entrenar_ivf(matriz, num_listas, iteraciones=10, semilla=0):
+    """
+    k-means esférico sobre una muestra y asignación de todos los vectores a su centroide.
+    Devuelve (centroides, indptr, orden): los chunks de la lista c son orden[indptr[c]:indptr[c+1]].
+    """
+    rng = np.random.default_rng(semilla)
+    num_vectores = len(matriz)
+    muestra = np.asarray(matriz[np.sort(rng.choice(num_vectores, min(num_vectores, num_listas * 64), replace=False))])
+    centroides = muestra[rng.choice(len(muestra), num_listas, replace=False)].copy()
+
+    for _ in range(iteraciones):
+        asignacion = np.argmax(muestra @ centroides.T, axis=1)
+        for c in range(num_listas):
+            miembros = muestra[asignacion == c]
+            if len(miembros):
+                centroides[c] = miembros.sum(axis=0)
+        centroides = _normalizar_filas(centroides)
+
+    asignacion_total = np.concatenate([
+        np.argmax(np.asarray(matriz[i:i + TAMANO_LOTE_LECTURA]) @ centroides.T, axis=1)
+        for i in range(0, num_vectores, TAMANO_LOTE_LECTURA)
+    ])
+    orden = np.argsort(asignacion_total, kind='stable')
+    indptr = np.zeros(num_listas + 1, dtype=np.int64)
+    np.cumsum(np.bincount(asignacion_total, minlength=num_listas), out=indptr[1:])
+    return centroides, indptr, orden
+
+
+class IndiceRAG:
+    """Matriz de embeddings normalizados (memmap) + ids de chunk alineados y, opcionalmente, un IVF."""
+
+    def __init__(self, chunk_ids, matriz, huella, ivf=None):
+        self.chunk_ids = chunk_ids
+        self.matriz = matriz
+        self.huella = huella
+        self.ivf = ivf
+        self.dimension = matriz.shape[1] if matriz.ndim == 2 else 0
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    def buscar(self, vector, top_k, nprobe=RAG_IVF_NPROBE):
+        """Devuelve [(chunk_id, similitud_coseno)] de los top_k chunks más parecidos, de mayor a menor."""
+        if len(self) == 0 or top_k <= 0:
+            return []
+        q = np.asarray(vector, dtype=np.float32).ravel()
+        if q.shape[0] != self.dimension:
+            raise ValueError(f"Dimensión del embedding ({q.shape[0]}) distinta de la del índice ({self.dimension}).")
+        norma = np.linalg.norm(q)
+        if norma == 0:
+            return []
+        q = q / norma
+
+        if self.ivf is None:
+            candidatos = None
+            similitudes = self.matriz @ q
+        else:
+            centroides, indptr, orden = self.ivf
+            nprobe = min(nprobe, len(centroides))
+            listas = np.argpartition(-(centroides @ q), nprobe - 1)[:nprobe]
+            candidatos = np.sort(np.concatenate([orden[indptr[c]:indptr[c + 1]] for c in listas]))
+            similitudes = self.matriz[candidatos] @ q
+
+        k = min(top_k, len(similitudes))
+        if k == 0:
+            return []
+        mejores = np.argpartition(-similitudes, k - 1)[:k]
+        mejores = mejores[np.argsort(-similitudes[mejores])]
+        posiciones = mejores if candidatos is None else candidatos[mejores]
+        return list(zip(self.chunk_ids[posiciones].tolist(), similitudes[mejores].tolist()))
+
+
+# --- Persistencia en disco ---
+def _rutas(huella, directorio=RAG_CACHE_DIR):
+    version = '_'.join(str(v) for v in huella)
+    base = os.path.join(directorio, f"chunks_{version}")
+    return base + '_ids.npy', base + '_vectores.npy', base + '_ivf.npz'
+
+
+def _cargar_de_disco(huella):
+    ruta_ids, ruta_vectores, ruta_ivf = _rutas(huella)
+    if not (os.path.exists(ruta_ids) and os.path.exists(ruta_vectores)):
+        return None
+    try:
+        chunk_ids = np.load(ruta_ids)
+        matriz = np.load(ruta_vectores, mmap_mode='r')
+        ivf = None
+        if os.path.exists(ruta_ivf):
+            with np.load(ruta_ivf) as datos:
+                ivf = (datos['centroides'], datos['indptr'], datos['orden'])
+        logger.info(f"Índice RAG cargado de disco: {len(chunk_ids)} chunks ({ruta_vectores}).")
+        return IndiceRAG(chunk_ids, matriz, huella, ivf)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Caché del índice RAG ilegible, se reconstruye: {e}")
+        return None
+
+
+def _guardar_atomico(ruta, guardar):
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(temporal, 'wb') as f:
+        guardar(f)
+    os.replace(temporal, ruta)
+
+
+def _construir_en_disco(conn, huella):
+    """
+    Lee los embeddings en lotes (cursor de servidor), los normaliza y los vuelca a disco.
+    Usa embedding_bin si ya se migró (core/embeddings_binarios.py) y el JSON para las filas que falten.
+    """
+    os.makedirs(RAG_CACHE_DIR, exist_ok=True)
+    ruta_ids, ruta_vectores, ruta_ivf = _rutas(huella)
+
+    if tiene_columna_binaria(conn):
+        query = ("SELECT id, embedding_bin, embedding_formato, CASE WHEN embedding_bin IS NULL THEN embedding END "
+                 "FROM manual_chunks WHERE embedding_bin IS NOT NULL OR embedding IS NOT NULL ORDER BY id")
+    else:
+        query = "SELECT id, NULL, NULL, embedding FROM manual_chunks WHERE embedding IS NOT NULL ORDER BY id"
+
+    ids, lotes = [], []
+    with conn.cursor(name='indice_rag_chunks') as cursor:
+        cursor.itersize = TAMANO_LOTE_LECTURA
+        cursor.execute(query)
+        while True:
+            filas = cursor.fetchmany(TAMANO_LOTE_LECTURA)
+            if not filas:
+                break
+            ids_lote, matriz_lote = leer_embeddings_lote([tuple(row) for row in filas])
+            ids.extend(ids_lote)
+            lotes.append(_normalizar_filas(matriz_lote))
+
+    chunk_ids = np.array(ids, dtype=np.int64)
+    matriz = np.concatenate(lotes) if lotes else np.zeros((0, 0), dtype=np.float32)
+    _guardar_atomico(ruta_ids, lambda f: np.save(f, chunk_ids))
+    _guardar_atomico(ruta_vectores, lambda f: np.save(f, matriz))
+
+    if len(chunk_ids) >= RAG_IVF_MIN_CHUNKS:
+        num_listas = int(np.sqrt(len(chunk_ids)))
+        centroides, indptr, orden = _entrenar_ivf(matriz, num_listas)
+        _guardar_atomico(ruta_ivf, lambda f: np.savez(f, centroides=centroides, indptr=indptr, orden=orden))
+        logger.info(f"IVF del índice RAG entrenado con {num_listas} listas.")
+
+    # Las versiones anteriores ya no sirven.
+    vigentes = {ruta_ids, ruta_vectores, ruta_ivf}
+    for ruta in glob.glob(os.path.join(RAG_CACHE_DIR, 'chunks_*')):
+        if ruta not in vigentes and not ruta.endswith('.tmp'):
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+    logger.info(f"Índice RAG construido: {len(chunk_ids)} chunks.")
+    return _cargar_de_disco(huella)
+
+
+def _huella_chunks(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(SQL_HUELLA_CHUNKS)
+        num, max_id, suma_ids, versiones = cursor.fetchone()
+        return int(num), int(max_id), int(suma_ids), versiones
+
+
+def _construir_indice(conn, huella):
+    """Del disco si ya hay un fichero de esta huella; si no, leyendo los embeddings."""
+    return _cargar_de_disco(huella) or _construir_en_disco(conn, huella)
+
+
+_cache_indice = CacheHuella("el índice RAG", _huella_chunks, _construir_indice, RAG_TTL_S)
+
+
+def obtener_indice_rag(conn, forzar=False):
+    """
+    Devuelve el índice vigente. Solo consulta la BD si no existe, si se fuerza o si ha pasado
+    RAG_TTL_S desde la última comprobación; y solo lee los embeddings si la huella no está en disco.
+    """
+    return _cache_indice.obtener(conn, forzar)
+
+
+def invalidar_indice_rag():
+    """Fuerza la reconstrucción en el próximo acceso (p. ej. tras reindexar el manual)."""
+    _cache_indice.invalidar()
+
+
+def version_corpus(indice):
+    """Identificador de la versión de manual_chunks a la que corresponde el índice (cambia al reingestar)."""
+    return '_'.join(str(v) for v in indice.huella)
+
+
+def recuperar_chunks(conn, vector, top_k):
+    """
+    Top-k del índice y, solo para esos ids, el texto desde manual_chunks.
+    Devuelve (version_corpus, [(chunk_id, chunk_text)]) en orden de relevancia.
+    """
+    indice = obtener_indice_rag(conn)
+    resultados = indice.buscar(vector, top_k)
+    if not resultados:
+        return version_corpus(indice), []
+    ids_ganadores = [chunk_id for chunk_id, _ in resultados]
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT id, chunk_text FROM manual_chunks WHERE id = ANY(%s)", (ids_ganadores,))
+        textos = {row[0]: row[1] for row in cursor.fetchall()}
+    return version_corpus(indice), [(chunk_id, textos[chunk_id]) for chunk_id in ids_ganadores if chunk_id in textos]
+
+
+def buscar_chunks_relevantes(conn, vector, top_k):
+    """Textos de los top-k chunks, en orden de relevancia."""
+    _, chunks = recuperar_chunks(conn, vector, top_k)
+    return [texto for _, texto in chunks]
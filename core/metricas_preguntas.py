@@ -0,0 +1,93 @@
+# core/metricas_preguntas.py
+# Modelo de lectura de las métricas derivadas por pregunta (stats_metricas_pregunta, mantenida
+# por core/rollup_stats.py): tasa de acierto, p50/p90 del tiempo de respuesta e índice de
+# discriminación. Se carga en arrays de NumPy alineados por pregunta_id y se comparte en el
+# proceso (lo usa el modo Adaptativo, core/seleccion_adaptativa.py, para restar peso a las
+# preguntas que no discriminan); solo se recarga si cambia la huella de la tabla, comprobada
+# como mucho cada METRICAS_TTL_S.
+import os
+import logging
+
+import numpy as np
+
+from core.cache_huella import CacheHuella
+
+logger = logging.getLogger(__name__)
+
+METRICAS_TTL_S = float(os.environ.get('METRICAS_PREGUNTAS_TTL', 300))
+
+SQL_HUELLA_METRICAS = "SELECT count(*), COALESCE(extract(epoch FROM max(actualizado_en)), 0) FROM stats_metricas_pregunta"
+
+
+class MetricasPreguntas:
+    """Arrays inmutables ordenados por pregunta_id; NaN donde la métrica no está disponible."""
+
+    def __init__(self, filas, huella):
+        self.huella = huella
+        datos = np.array(filas, dtype=np.float64).reshape(-1, 6)
+        orden = np.argsort(datos[:, 0], kind='stable')
+        datos = datos[orden]
+        self.pregunta_ids = datos[:, 0].astype(np.int32)
+        self.num_respuestas = datos[:, 1].astype(np.int32)
+        self.tasa_acierto = datos[:, 2].astype(np.float32)
+        self.tiempo_p50_ms = datos[:, 3].astype(np.float32)
+        self.tiempo_p90_ms = datos[:, 4].astype(np.float32)
+        self.indice_discriminacion = datos[:, 5].astype(np.float32)
+        for array in (self.pregunta_ids, self.num_respuestas, self.tasa_acierto, self.tiempo_p50_ms,
+                      self.tiempo_p90_ms, self.indice_discriminacion):
+            array.setflags(write=False)
+
+    def posiciones(self, pregunta_ids):
+        """Posición de cada id en los arrays, o -1 si la pregunta aún no tiene métricas."""
+        buscados = np.asarray(pregunta_ids, dtype=np.int64).ravel()
+        if not len(self.pregunta_ids):
+            return np.full(len(buscados), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.pregunta_ids, buscados), len(self.pregunta_ids) - 1)
+        return np.where(self.pregunta_ids[pos] == buscados, pos, -1)
+
+    def valores(self, metrica, pregunta_ids, por_defecto=np.nan):
+        """Array con la métrica ('tasa_acierto', 'tiempo_p50_ms'...) de cada id; 'por_defecto' si no hay dato."""
+        array = getattr(self, metrica)
+        pos = self.posiciones(pregunta_ids)
+        resultado = np.full(len(pos), por_defecto, dtype=np.float32)
+        hay = pos >= 0
+        resultado[hay] = array[pos[hay]]
+        resultado[np.isnan(resultado)] = por_defecto
+        return resultado
+
+
+def _huella_metricas(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(SQL_HUELLA_METRICAS)
+        return tuple(float(v) for v in cursor.fetchone())
+
+
+def _cargar(conn, huella):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT pregunta_id, num_respuestas, tasa_acierto,
+                   COALESCE(tiempo_p50_ms, 'NaN'), COALESCE(tiempo_p90_ms, 'NaN'), COALESCE(indice_discriminacion, 'NaN')
+            FROM stats_metricas_pregunta
+        """)
+        filas = [tuple(row) for row in cursor.fetchall()]
+    conn.commit()
+    logger.info(f"Métricas de preguntas cargadas: {len(filas)} preguntas.")
+    return MetricasPreguntas(filas, huella)
+
+
+# Si la tabla aún no existe (ningún rollup ejecutado) se usa un modelo vacío.
+_cache_metricas = CacheHuella("las métricas de preguntas", _huella_metricas, _cargar, METRICAS_TTL_S,
+                              vacio=lambda: MetricasPreguntas([], (0.0, 0.0)))
+
+
+def obtener_metricas_preguntas(conn, forzar=False):
+    """
+    Devuelve las métricas vigentes. Si la tabla aún no existe (ningún rollup ejecutado) devuelve
+    un modelo vacío; ante otros errores mantiene la versión anterior.
+    """
+    return _cache_metricas.obtener(conn, forzar)
+
+
+def invalidar_metricas_preguntas():
+    """Fuerza la reconstrucción en el próximo acceso (la llama rollup_stats tras recalcular métricas)."""
+    _cache_metricas.invalidar()
@@ -0,0 +1,263 @@
+# core/paginas_pdf.py
+# Pre-render en servidor de los PDF de data/manuales con PyMuPDF. Los informes (data/informes) no
+# se pre-renderizan: static/ se sirve sin login y solo se publica material de los manuales.
+# Cada PDF se identifica por el hash de su contenido y sus páginas se guardan como imágenes
+# WebP (PNG si Pillow no tiene WebP) junto con miniaturas y un manifiesto JSON:
+#
+#   static/paginas/<hash>/manifiesto.json
+#   static/paginas/<hash>/p0001.webp, t0001.webp, ...
+#
+# Al estar bajo static/, Streamlit las sirve en /app/static/paginas/... (con ETag y caché del navegador).
+# Un PDF solo se vuelve a renderizar si cambia su contenido; el hash se recalcula solo si cambian mtime o tamaño.
+#
+# Uso (pre-render completo, p. ej. tras añadir manuales):
+#   python -m core.paginas_pdf [--purgar]
+import os
+import io
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pymupdf
+except ImportError:
+    logger.warning("PyMuPDF no encontrado. Los PDF se mostrarán con el visor PDF.js.")
+    pymupdf = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# --- Configuración ---
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRECTORIO_PAGINAS = os.path.join(project_root, 'static', 'paginas')
+URL_PAGINAS = 'app/static/paginas'
+CARPETAS_PDF = [
+    os.path.join(project_root, 'data', 'manuales'),
+]
+ESCALA_PAGINA = float(os.environ.get('PAGINAS_PDF_ESCALA', 1.5))
+ANCHO_MINIATURA = 160
+CALIDAD_WEBP = 80
+# Páginas que se renderizan antes de mostrar el diálogo; el resto, en segundo plano.
+PAGINAS_SINCRONAS = 3
+
+_huellas = {}  # ruta -> ((mtime_ns, tamaño), hash)
+_en_curso = set()
+_lock = threading.Lock()
+_retiradas = False
+
+
+def huella_contenido(ruta):
+    """Hash (sha256 truncado) del contenido. Solo se relee el fichero si cambian mtime o tamaño."""
+    st = os.stat(ruta)
+    clave = (st.st_mtime_ns, st.st_size)
+    previa = _huellas.get(ruta)
+    if previa and previa[0] == clave:
+        return previa[1]
+    h = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(bloque)
+    huella = h.hexdigest()[:24]
+    _huellas[ruta] = (clave, huella)
+    return huella
+
+
+def _formato_imagen():
+    if Image is not None and 'WEBP' in Image.registered_extensions().values():
+        return 'webp'
+    return 'png'
+
+
+def _escribir_atomico(ruta, datos):
+    temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporal, 'wb') as f:
+        f.write(datos)
+    os.replace(temporal, ruta)
+
+
+def _codificar_pixmap(pix, formato):
+    if formato == 'webp':
+        modo = 'RGBA' if pix.alpha else 'RGB'
+        imagen = Image.frombytes(modo, (pix.width, pix.height), pix.samples)
+        salida = io.BytesIO()
+        imagen.save(salida, 'WEBP', quality=CALIDAD_WEBP, method=4)
+        return salida.getvalue()
+    return pix.tobytes('png')
+
+
+def es_publicable(ruta):
+    """Si el PDF está dentro de alguna de CARPETAS_PDF."""
+    ruta_real = os.path.realpath(ruta)
+    for carpeta in CARPETAS_PDF:
+        carpeta_real = os.path.realpath(carpeta)
+        if os.path.commonpath([ruta_real, carpeta_real]) == carpeta_real:
+            return True
+    return False
+
+
+def _ruta_manifiesto(huella):
+    return os.path.join(DIRECTORIO_PAGINAS, huella, 'manifiesto.json')
+
+
+def leer_manifiesto(huella):
+    try:
+        with open(_ruta_manifiesto(huella), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _guardar_manifiesto(huella, manifiesto):
+    _escribir_atomico(_ruta_manifiesto(huella), json.dumps(manifiesto).encode('utf-8'))
+
+
+def renderizar_pdf(ruta, hasta_pagina=None):
+    """
+    Renderiza (o completa) las páginas del PDF hasta 'hasta_pagina' (todas si None).
+    Las páginas ya presentes no se repiten. Devuelve el manifiesto actualizado.
+    """
+    if pymupdf is None:
+        raise RuntimeError("PyMuPDF no está instalado.")
+    huella = huella_contenido(ruta)
+    directorio = os.path.join(DIRECTORIO_PAGINAS, huella)
+    os.makedirs(directorio, exist_ok=True)
+
+    with pymupdf.open(ruta) as doc:
+        manifiesto = leer_manifiesto(huella)
+        if manifiesto is None:
+            manifiesto = {
+                'origen': os.path.relpath(ruta, project_root).replace(os.sep, '/'),
+                'paginas': doc.page_count,
+                'formato': _formato_imagen(),
+                'tamanos': [[round(p.rect.width * ESCALA_PAGINA), round(p.rect.height * ESCALA_PAGINA)] for p in doc],
+                'renderizadas': 0,
+            }
+        formato = manifiesto['formato']
+        limite = doc.page_count if hasta_pagina is None else min(hasta_pagina, doc.page_count)
+
+        for numero in range(manifiesto['renderizadas'], limite):
+            pagina = doc[numero]
+            ruta_pagina = os.path.join(directorio, f"p{numero + 1:04d}.{formato}")
+            ruta_miniatura = os.path.join(directorio, f"t{numero + 1:04d}.{formato}")
+            if not os.path.exists(ruta_pagina):
+                pix = pagina.get_pixmap(matrix=pymupdf.Matrix(ESCALA_PAGINA, ESCALA_PAGINA), alpha=False)
+                _escribir_atomico(ruta_pagina, _codificar_pixmap(pix, formato))
+            if not os.path.exists(ruta_miniatura):
+                escala = ANCHO_MINIATURA / max(pagina.rect.width, 1)
+                pix = pagina.get_pixmap(matrix=pymupdf.Matrix(escala, escala), alpha=False)
+                _escribir_atomico(ruta_miniatura, _codificar_pixmap(pix, formato))
+            manifiesto['renderizadas'] = numero + 1
+            # El manifiesto se actualiza por página para que un render interrumpido se pueda continuar.
+            _guardar_manifiesto(huella, manifiesto)
+
+    if manifiesto['renderizadas'] == 0:
+        _guardar_manifiesto(huella, manifiesto)
+    manifiesto['hash'] = huella
+    return manifiesto
+
+
+def _renderizar_resto(ruta, huella):
+    try:
+        renderizar_pdf(ruta)
+    except Exception as e:
+        logger.error(f"Error pre-renderizando '{ruta}': {e}", exc_info=True)
+    finally:
+        with _lock:
+            _en_curso.discard(huella)
+
+
+def retirar_paginas_no_publicables():
+    """Borra las páginas ya renderizadas de PDF que no son de CARPETAS_PDF (p. ej. informes de versiones anteriores)."""
+    if not os.path.isdir(DIRECTORIO_PAGINAS):
+        return
+    for nombre in os.listdir(DIRECTORIO_PAGINAS):
+        manifiesto = leer_manifiesto(nombre)
+        if manifiesto is not None and not es_publicable(os.path.join(project_root, manifiesto['origen'])):
+            shutil.rmtree(os.path.join(DIRECTORIO_PAGINAS, nombre), ignore_errors=True)
+            logger.info(f"Páginas retiradas de {manifiesto['origen']}: {nombre}")
+
+
+def obtener_paginas(ruta):
+    """
+    Manifiesto con las primeras PAGINAS_SINCRONAS páginas ya disponibles; si faltan más,
+    se lanzan en un hilo (uno por PDF). Devuelve None si no se puede pre-renderizar o si el
+    PDF no es publicable (el visor lo incrusta entonces en la sesión).
+    """
+    global _retiradas
+    if pymupdf is None or not es_publicable(ruta):
+        return None
+    if not _retiradas:
+        _retiradas = True
+        retirar_paginas_no_publicables()
+    try:
+        huella = huella_contenido(ruta)
+        manifiesto = leer_manifiesto(huella)
+        if manifiesto is None or manifiesto['renderizadas'] < min(PAGINAS_SINCRONAS, manifiesto['paginas']):
+            manifiesto = renderizar_pdf(ruta, hasta_pagina=PAGINAS_SINCRONAS)
+        manifiesto['hash'] = huella
+    except Exception as e:
+        logger.error(f"No se pudieron preparar las páginas de '{ruta}': {e}", exc_info=True)
+        return None
+
+    if manifiesto['renderizadas'] < manifiesto['paginas']:
+        with _lock:
+            lanzar = huella not in _en_curso
+            _en_curso.add(huella)
+        if lanzar:
+            threading.Thread(target=_renderizar_resto, args=(ruta, huella), daemon=True,
+                             name=f"prerender-{huella[:8]}").start()
+    return manifiesto
+
+
+def url_pagina(manifiesto, numero, miniatura=False):
+    prefijo = 't' if miniatura else 'p'
+    return f"{URL_PAGINAS}/{manifiesto['hash']}/{prefijo}{numero:04d}.{manifiesto['formato']}"
+
+
+# --- Pre-render completo ---
+def listar_pdfs():
+    for carpeta in CARPETAS_PDF:
+        for raiz, _, ficheros in os.walk(carpeta):
+            for nombre in sorted(ficheros):
+                if nombre.lower().endswith('.pdf'):
+                    yield os.path.join(raiz, nombre)
+
+
+def prerenderizar_todo(purgar=False):
+    """Renderiza todos los PDF publicados. Con purgar=True borra las carpetas de versiones que ya no existen."""
+    retirar_paginas_no_publicables()
+    vigentes = set()
+    for ruta in listar_pdfs():
+        manifiesto = renderizar_pdf(ruta)
+        vigentes.add(manifiesto['hash'])
+        logger.info(f"{manifiesto['origen']}: {manifiesto['paginas']} páginas listas.")
+    if purgar and os.path.isdir(DIRECTORIO_PAGINAS):
+        for nombre in os.listdir(DIRECTORIO_PAGINAS):
+            if nombre not in vigentes:
+                shutil.rmtree(os.path.join(DIRECTORIO_PAGINAS, nombre), ignore_errors=True)
+                logger.info(f"Páginas obsoletas eliminadas: {nombre}")
+    return vigentes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-render de páginas de los manuales.")
+    parser.add_argument('--purgar', action='store_true', help="Elimina las páginas de PDF que ya no existen o han cambiado.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if pymupdf is None:
+        print("PyMuPDF no está instalado.")
+        return 1
+    print(f"PDF pre-renderizados: {len(prerenderizar_todo(args.purgar))}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
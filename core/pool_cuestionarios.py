@@ -0,0 +1,196 @@
+# core/pool_cuestionarios.py
+# Reserva de cuestionarios Libre-Aleatorio ya construidos y enriquecidos, para empezar al instante.
+#
+# El modo Aleatorio solo depende de la especialidad (BQ o el resto) y del tamaño (20/50/100), así
+# que un hilo en segundo plano mantiene para cada combinación hasta POOL_CUESTIONARIOS_TAMANO
+# cuestionarios listos (construir_cuestionario: selección en memoria y una consulta). Tomar uno es
+# un popleft de una deque; cuando una reserva baja de la mitad se despierta al hilo para reponerla.
+# - Cada cuestionario guarda la huella del índice con el que se construyó; si el banco cambia, se descarta.
+# - Con usuario, se acepta un cuestionario si como mucho POOL_CUESTIONARIOS_MAX_VISTAS de sus
+#   preguntas se vieron en los últimos días (core/preguntas_vistas.py); al servirlo, las unidades
+#   con preguntas vistas pasan al final, como en la construcción al momento. Si tiene más, se deja
+#   en la reserva para otro usuario, pero tras POOL_CUESTIONARIOS_MAX_RECHAZOS rechazos se descarta
+#   para que el hilo construya otro. Se prueban como mucho POOL_CUESTIONARIOS_REINTENTOS por petición.
+# - Si no hay ninguno servible, tomar devuelve None y el llamante construye el cuestionario al momento.
+import os
+import random
+import threading
+import collections
+import logging
+
+from core.database import conexion_db
+from core.db_quiz_handler import construir_cuestionario, _priorizar_no_vistas, TAMAÑOS_ALEATORIO, ESPECIALIDAD_BIOQUIMICA
+from core.indice_preguntas import obtener_indice_preguntas
+from core.preguntas_vistas import obtener_preguntas_vistas
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración (sobrescribible por variables de entorno) ---
+POOL_CUESTIONARIOS_TAMANO = int(os.environ.get('POOL_CUESTIONARIOS_TAMANO', 4))
+POOL_CUESTIONARIOS_REINTENTOS = int(os.environ.get('POOL_CUESTIONARIOS_REINTENTOS', 3))
+# Fracción máxima de preguntas ya vistas por el usuario para servirle un cuestionario de la reserva.
+POOL_CUESTIONARIOS_MAX_VISTAS = float(os.environ.get('POOL_CUESTIONARIOS_MAX_VISTAS', 0.2))
+POOL_CUESTIONARIOS_MAX_RECHAZOS = int(os.environ.get('POOL_CUESTIONARIOS_MAX_RECHAZOS', 3))
+# Cada cuánto revisa el hilo las reservas aunque nadie lo despierte, y espera tras un error.
+POOL_CUESTIONARIOS_INTERVALO_S = float(os.environ.get('POOL_CUESTIONARIOS_INTERVALO', 60))
+POOL_CUESTIONARIOS_ESPERA_ERROR_S = 10.0
+
+ESPECIALIDADES_POOL = (None, ESPECIALIDAD_BIOQUIMICA)
+
+
+def _clave_especialidad(especialidad_usuario):
+    # El modo Aleatorio solo distingue BQ del resto.
+    return ESPECIALIDAD_BIOQUIMICA if especialidad_usuario == ESPECIALIDAD_BIOQUIMICA else None
+
+
+def _unidades(preguntas):
+    """Agrupa las preguntas seguidas del mismo caso práctico (escenario_id) en una unidad; las demás van solas."""
+    unidades = []
+    for preg in preguntas:
+        escenario = preg.get('escenario_id')
+        if escenario and unidades and unidades[-1][0].get('escenario_id') == escenario:
+            unidades[-1].append(preg)
+        else:
+            unidades.append([preg])
+    return unidades
+
+
+def _vistas_al_final(preguntas, vistas):
+    """Mismo criterio que la construcción al momento: primero las unidades sin ninguna pregunta vista."""
+    unidades = [[p['id'] for p in unidad] for unidad in _unidades(preguntas)]
+    por_id = {p['id']: p for p in preguntas}
+    return [por_id[pid] for unidad in _priorizar_no_vistas(unidades, vistas) for pid in unidad]
+
+
+class PoolCuestionarios:
+    """Reservas acotadas de cuestionarios por (especialidad, tamaño), repuestas por un hilo daemon."""
+
+    def __init__(self, tamano=POOL_CUESTIONARIOS_TAMANO):
+        self.tamano = tamano
+        self._reservas = {(esp, n): collections.deque() for esp in ESPECIALIDADES_POOL for n in TAMAÑOS_ALEATORIO}
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._parar = threading.Event()
+        self._hilo = None
+        self._servidos = 0
+        self._fallos = 0
+
+    # --- Ciclo de vida ---
+    def iniciar(self):
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._bucle, name="pool-cuestionarios", daemon=True)
+            self._hilo.start()
+            logger.info(f"Reserva de cuestionarios iniciada ({self.tamano} por especialidad y tamaño).")
+
+    def detener(self):
+        self._parar.set()
+        self._despertar.set()
+
+    def _pendientes(self):
+        with self._lock:
+            return [clave for clave, reserva in self._reservas.items() if len(reserva) < self.tamano]
+
+    def _descartar_obsoletos(self, huella):
+        with self._lock:
+            for clave, reserva in self._reservas.items():
+                vigentes = [item for item in reserva if item[0] == huella]
+                if len(vigentes) < len(reserva):
+                    self._reservas[clave] = collections.deque(vigentes)
+
+    def _bucle(self):
+        while not self._parar.is_set():
+            try:
+                with conexion_db() as conn:
+                    huella = obtener_indice_preguntas(conn).huella
+                    self._descartar_obsoletos(huella)
+                    for clave in self._pendientes():
+                        self._reponer(conn, clave, huella)
+            except Exception as e:
+                logger.error(f"Error reponiendo la reserva de cuestionarios: {e}", exc_info=True)
+                self._parar.wait(POOL_CUESTIONARIOS_ESPERA_ERROR_S)
+                continue
+            self._despertar.wait(POOL_CUESTIONARIOS_INTERVALO_S)
+            self._despertar.clear()
+
+    def _reponer(self, conn, clave, huella):
+        especialidad, num_preguntas = clave
+        while not self._parar.is_set():
+            with self._lock:
+                if len(self._reservas[clave]) >= self.tamano:
+                    return
+            config = {'modo': 'Libre-Aleatorio', 'numero_preguntas': num_preguntas, 'tamano_fijo': True}
+            preguntas = construir_cuestionario(conn, config, especialidad_usuario=especialidad)
+            if not preguntas:
+                logger.warning(f"La reserva {clave} no pudo construir un cuestionario; se reintentará más tarde.")
+                return
+            with self._lock:
+                self._reservas[clave].append((huella, preguntas, 0))
+
+    # --- Consumo ---
+    def tomar(self, conn, especialidad_usuario=None, usuario_id=None):
+        """
+        Devuelve un cuestionario listo (lista de preguntas enriquecidas) de un tamaño al azar, con las
+        unidades ya vistas al final, o None si no hay ninguno servible para este usuario.
+        """
+        clave = (_clave_especialidad(especialidad_usuario), random.choice(TAMAÑOS_ALEATORIO))
+        huella = obtener_indice_preguntas(conn).huella
+        vistas = obtener_preguntas_vistas(conn, usuario_id) if usuario_id else None
+
+        hay_vistas = vistas is not None and len(vistas) > 0
+        elegido = None
+        with self._lock:
+            reserva = self._reservas[clave]
+            for _ in range(min(POOL_CUESTIONARIOS_REINTENTOS, len(reserva))):
+                huella_cuestionario, preguntas, rechazos = reserva.popleft()
+                if huella_cuestionario != huella:
+                    continue  # banco cambiado: se descarta
+                if hay_vistas:
+                    num_vistas = sum(vistas.contiene(p['id']) for p in preguntas)
+                    if num_vistas > POOL_CUESTIONARIOS_MAX_VISTAS * len(preguntas):
+                        if rechazos + 1 < POOL_CUESTIONARIOS_MAX_RECHAZOS:
+                            reserva.append((huella_cuestionario, preguntas, rechazos + 1))  # para otro usuario
+                        continue
+                elegido = preguntas
+                break
+            if elegido is not None:
+                self._servidos += 1
+            else:
+                self._fallos += 1
+            reponer = len(reserva) * 2 < self.tamano
+        if reponer:
+            self._despertar.set()
+        if elegido is not None and hay_vistas:
+            elegido = _vistas_al_final(elegido, vistas)
+        return elegido
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'reservas': {f"{esp or 'general'}-{n}": len(r) for (esp, n), r in self._reservas.items()},
+                'servidos': self._servidos,
+                'fallos': self._fallos,
+            }
+
+
+# --- Instancia del proceso ---
+_pool_global = None
+_pool_lock = threading.Lock()
+
+
+def obtener_pool_cuestionarios():
+    """Reserva del proceso. Al crearla arranca el hilo, que empieza a llenarla en segundo plano."""
+    global _pool_global
+    if _pool_global is None:
+        with _pool_lock:
+            if _pool_global is None:
+                pool = PoolCuestionarios()
+                pool.iniciar()
+                _pool_global = pool
+    return _pool_global
+
+
+def tomar_cuestionario_aleatorio(conn, especialidad_usuario=None, usuario_id=None):
+    """Cuestionario Libre-Aleatorio listo de la reserva, o None (el llamante lo construye al momento)."""
+    if POOL_CUESTIONARIOS_TAMANO <= 0:
+        return None
+    return obtener_pool_cuestionarios().tomar(conn, especialidad_usuario, usuario_id)
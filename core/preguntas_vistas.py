@@ -0,0 +1,129 @@
+# core/preguntas_vistas.py
+# Conjunto compacto de preguntas vistas por usuario y día, para no repetir en los modos aleatorios
+# las preguntas respondidas en los últimos días.
+#
+# stats_vistas_usuario_dia guarda, por (usuario, día), un bitmap sobre los ids de pregunta
+# (bit i = pregunta i respondida ese día), empaquetado con np.packbits y comprimido con zlib:
+# un día típico ocupa unos cientos de bytes sea cual sea el historial. Lo mantiene el rollup
+# incremental (core/rollup_stats.py, marca 'vistas') y se purgan los días más antiguos que
+# VISTAS_RETENCION_DIAS. Al montar un quiz se leen como mucho N filas (una por día) y se
+# combinan con OR en memoria: coste constante respecto al tamaño del historial.
+import os
+import zlib
+import logging
+
+import numpy as np
+import psycopg2
+import psycopg2.extras
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración (sobrescribible por variables de entorno) ---
+VISTAS_DIAS_EXCLUSION = int(os.environ.get('VISTAS_DIAS_EXCLUSION', 7))
+VISTAS_RETENCION_DIAS = int(os.environ.get('VISTAS_RETENCION_DIAS', 60))
+
+DDL_VISTAS = """
+    CREATE TABLE IF NOT EXISTS stats_vistas_usuario_dia (
+        usuario_id integer NOT NULL,
+        fecha date NOT NULL,
+        bitmap bytea NOT NULL,
+        num_preguntas integer NOT NULL,
+        PRIMARY KEY (usuario_id, fecha)
+    );
+"""
+
+
+# --- Codificación del bitmap ---
+def codificar_bitmap(bits):
+    """Array booleano indexado por pregunta_id -> bytes (packbits + zlib)."""
+    return zlib.compress(np.packbits(bits, bitorder='little').tobytes(), 6)
+
+
+def decodificar_bitmap(datos):
+    return np.unpackbits(np.frombuffer(zlib.decompress(bytes(datos)), dtype=np.uint8), bitorder='little').astype(bool)
+
+
+def _union(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    resultado = a.copy()
+    resultado[:len(b)] |= b
+    return resultado
+
+
+class PreguntasVistas:
+    """Unión de los bitmaps de varios días: por_id[pregunta_id] es True si se vio en ese periodo."""
+
+    def __init__(self, por_id=None):
+        self.por_id = por_id if por_id is not None else np.zeros(0, dtype=bool)
+
+    def __len__(self):
+        return int(self.por_id.sum())
+
+    def contiene(self, pregunta_id):
+        return 0 <= pregunta_id < len(self.por_id) and bool(self.por_id[pregunta_id])
+
+    def alguna(self, pregunta_ids):
+        return any(self.contiene(p) for p in pregunta_ids)
+
+    def mascara(self, indice):
+        """Máscara alineada con indice.pregunta_ids."""
+        ids = indice.pregunta_ids
+        mascara = np.zeros(len(ids), dtype=bool)
+        dentro = ids < len(self.por_id)
+        mascara[dentro] = self.por_id[ids[dentro]]
+        return mascara
+
+
+# --- Rollup ---
+def registrar_vistas(cursor, desde_id, hasta_id):
+    """Rollup: añade a los bitmaps diarios las preguntas respondidas con desde_id < id <= hasta_id."""
+    cursor.execute("""
+        SELECT usuario_id, fecha_respuesta::date, array_agg(DISTINCT pregunta_id)
+        FROM stats_respuestas_usuario
+        WHERE id > %s AND id <= %s AND fecha_respuesta >= current_date - %s
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+    """, (desde_id, hasta_id, VISTAS_RETENCION_DIAS))
+    grupos = cursor.fetchall()
+    if grupos:
+        cursor.execute("""
+            SELECT v.usuario_id, v.fecha, v.bitmap
+            FROM stats_vistas_usuario_dia v
+            JOIN unnest(%s::int[], %s::date[]) AS t(usuario_id, fecha)
+              ON v.usuario_id = t.usuario_id AND v.fecha = t.fecha
+        """, ([g[0] for g in grupos], [g[1] for g in grupos]))
+        existentes = {(row[0], row[1]): decodificar_bitmap(row[2]) for row in cursor.fetchall()}
+
+        filas = []
+        for usuario_id, fecha, pregunta_ids in grupos:
+            nuevos = np.zeros(max(pregunta_ids) + 1, dtype=bool)
+            nuevos[pregunta_ids] = True
+            bits = _union(existentes.get((usuario_id, fecha), nuevos), nuevos)
+            filas.append((usuario_id, fecha, psycopg2.Binary(codificar_bitmap(bits)), int(bits.sum())))
+        psycopg2.extras.execute_values(cursor, """
+            INSERT INTO stats_vistas_usuario_dia (usuario_id, fecha, bitmap, num_preguntas) VALUES %s
+            ON CONFLICT (usuario_id, fecha) DO UPDATE SET bitmap = EXCLUDED.bitmap, num_preguntas = EXCLUDED.num_preguntas;
+        """, filas, page_size=500)
+    cursor.execute("DELETE FROM stats_vistas_usuario_dia WHERE fecha < current_date - %s", (VISTAS_RETENCION_DIAS,))
+
+
+# --- Lectura ---
+def obtener_preguntas_vistas(conn, usuario_id, dias=VISTAS_DIAS_EXCLUSION):
+    """Preguntas vistas por el usuario en los últimos 'dias' (hoy incluido). Vacío si no hay datos."""
+    if not usuario_id or dias <= 0:
+        return PreguntasVistas()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT bitmap FROM stats_vistas_usuario_dia WHERE usuario_id = %s AND fecha > current_date - %s",
+                (usuario_id, dias),
+            )
+            filas = cursor.fetchall()
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        return PreguntasVistas()
+    por_id = np.zeros(0, dtype=bool)
+    for row in filas:
+        por_id = _union(por_id, decodificar_bitmap(row[0]))
+    return PreguntasVistas(por_id)
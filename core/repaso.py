@@ -0,0 +1,147 @@
+# core/repaso.py
+# Repetición espaciada (SM-2) sobre el historial de respuestas.
+#
+# stats_repaso_programacion guarda, por (usuario, pregunta), el estado SM-2 y la fecha del próximo
+# repaso. La mantiene el rollup incremental (core/rollup_stats.py, marca 'repaso') con las respuestas
+# nuevas de stats_respuestas_usuario, nunca recorriendo el historial completo al empezar un quiz.
+# Con el índice (usuario_id, proximo_repaso), "qué le toca repasar ahora" es un recorrido de índice
+# acotado por LIMIT, independiente del tamaño del historial.
+#
+# Calidad SM-2 (0-5) de cada respuesta:
+#   acierto rápido (<= REPASO_UMBRAL_RAPIDO_MS) -> 5, acierto -> 4, fallo -> 2, sin responder -> 1
+import os
+import datetime
+import logging
+
+import psycopg2
+import psycopg2.extras
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración (sobrescribible por variables de entorno) ---
+REPASO_UMBRAL_RAPIDO_MS = int(os.environ.get('REPASO_UMBRAL_RAPIDO_MS', 15000))
+FACILIDAD_INICIAL = 2.5
+FACILIDAD_MINIMA = 1.3
+INTERVALO_MAXIMO_DIAS = 365
+
+DDL_REPASO = """
+    CREATE TABLE IF NOT EXISTS stats_repaso_programacion (
+        usuario_id integer NOT NULL,
+        pregunta_id integer NOT NULL,
+        repeticiones integer NOT NULL DEFAULT 0,
+        facilidad real NOT NULL DEFAULT 2.5,
+        intervalo_dias real NOT NULL DEFAULT 0,
+        lapsos integer NOT NULL DEFAULT 0,
+        ultima_respuesta timestamp NOT NULL,
+        proximo_repaso timestamp NOT NULL,
+        PRIMARY KEY (usuario_id, pregunta_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_stats_repaso_usuario_proximo ON stats_repaso_programacion (usuario_id, proximo_repaso);
+"""
+
+
+# --- Modelo SM-2 ---
+def calidad_respuesta(es_correcta, respuesta_seleccionada, tiempo_respuesta_ms):
+    if respuesta_seleccionada == 'TIMEOUT':
+        return 1
+    if not es_correcta:
+        return 2
+    if tiempo_respuesta_ms is not None and 0 < tiempo_respuesta_ms <= REPASO_UMBRAL_RAPIDO_MS:
+        return 5
+    return 4
+
+
+def aplicar_sm2(estado, calidad, fecha):
+    """
+    estado: [repeticiones, facilidad, intervalo_dias, lapsos, ultima_respuesta, proximo_repaso].
+    Devuelve el estado tras una respuesta de 'calidad' en 'fecha'.
+    """
+    repeticiones, facilidad, intervalo, lapsos = estado[0], estado[1], estado[2], estado[3]
+    if calidad >= 3:
+        if repeticiones == 0:
+            intervalo = 1.0
+        elif repeticiones == 1:
+            intervalo = 6.0
+        else:
+            intervalo = min(round(intervalo * facilidad), INTERVALO_MAXIMO_DIAS)
+        repeticiones += 1
+    else:
+        repeticiones, intervalo = 0, 1.0
+        lapsos += 1
+    facilidad = max(FACILIDAD_MINIMA, facilidad + 0.1 - (5 - calidad) * (0.08 + (5 - calidad) * 0.02))
+    return [repeticiones, facilidad, intervalo, lapsos, fecha, fecha + datetime.timedelta(days=intervalo)]
+
+
+def programar_repaso(cursor, desde_id, hasta_id):
+    """
+    Rollup: aplica SM-2 a las respuestas con desde_id < id <= hasta_id, en orden cronológico por
+    (usuario, pregunta), partiendo del estado guardado, y escribe los estados resultantes.
+    """
+    cursor.execute("""
+        SELECT usuario_id, pregunta_id, es_correcta, respuesta_seleccionada, tiempo_respuesta_ms, fecha_respuesta
+        FROM stats_respuestas_usuario
+        WHERE id > %s AND id <= %s
+        ORDER BY usuario_id, pregunta_id, fecha_respuesta, id
+    """, (desde_id, hasta_id))
+    respuestas = cursor.fetchall()
+    if not respuestas:
+        return
+
+    pares = sorted({(row[0], row[1]) for row in respuestas})
+    cursor.execute("""
+        SELECT p.usuario_id, p.pregunta_id, p.repeticiones, p.facilidad, p.intervalo_dias, p.lapsos,
+               p.ultima_respuesta, p.proximo_repaso
+        FROM stats_repaso_programacion p
+        JOIN unnest(%s::int[], %s::int[]) AS t(usuario_id, pregunta_id)
+          ON p.usuario_id = t.usuario_id AND p.pregunta_id = t.pregunta_id
+    """, ([par[0] for par in pares], [par[1] for par in pares]))
+    estados = {(row[0], row[1]): list(row[2:]) for row in cursor.fetchall()}
+
+    for usuario_id, pregunta_id, es_correcta, seleccionada, tiempo_ms, fecha in respuestas:
+        clave = (usuario_id, pregunta_id)
+        estado = estados.get(clave) or [0, FACILIDAD_INICIAL, 0.0, 0, fecha, fecha]
+        estados[clave] = aplicar_sm2(estado, calidad_respuesta(es_correcta, seleccionada, tiempo_ms), fecha)
+
+    psycopg2.extras.execute_values(cursor, """
+        INSERT INTO stats_repaso_programacion
+            (usuario_id, pregunta_id, repeticiones, facilidad, intervalo_dias, lapsos, ultima_respuesta, proximo_repaso)
+        VALUES %s
+        ON CONFLICT (usuario_id, pregunta_id) DO UPDATE SET
+            repeticiones = EXCLUDED.repeticiones,
+            facilidad = EXCLUDED.facilidad,
+            intervalo_dias = EXCLUDED.intervalo_dias,
+            lapsos = EXCLUDED.lapsos,
+            ultima_respuesta = EXCLUDED.ultima_respuesta,
+            proximo_repaso = EXCLUDED.proximo_repaso;
+    """, [(par[0], par[1], *estados[par]) for par in pares], page_size=1000)
+
+
+# --- Consultas del modo Repaso ---
+def seleccionar_ids_repaso(conn, usuario_id, n_objetivo):
+    """Hasta n_objetivo preguntas vencidas del usuario, empezando por las que más tiempo llevan vencidas."""
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT pregunta_id FROM stats_repaso_programacion
+                WHERE usuario_id = %s AND proximo_repaso <= now()::timestamp
+                ORDER BY proximo_repaso
+                LIMIT %s
+            """, (usuario_id, n_objetivo))
+            return [row[0] for row in cursor.fetchall()]
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        return []
+
+
+def contar_repasos_pendientes(conn, usuario_id):
+    """Número de preguntas vencidas del usuario (0 si la programación aún no existe)."""
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT count(*) FROM stats_repaso_programacion WHERE usuario_id = %s AND proximo_repaso <= now()::timestamp",
+                (usuario_id,),
+            )
+            return cursor.fetchone()[0]
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        return 0
@@ -0,0 +1,482 @@
+# core/rollup_stats.py
+# Rollups incrementales de estadísticas a partir del registro de respuestas (stats_respuestas_usuario).
+#
+# El camino de escritura de un quiz solo añade filas a stats_respuestas_usuario; las tablas
+# temporales (diaria, semanal y mensual), los contadores por pregunta (stats_agregadas_pregunta),
+# sus métricas derivadas (stats_metricas_pregunta), la programación de repasos
+# (stats_repaso_programacion, core/repaso.py) y los bitmaps de preguntas vistas
+# (stats_vistas_usuario_dia, core/preguntas_vistas.py) se mantienen aquí, por lotes, desde una
+# marca de agua: cada rollup guarda en stats_rollup_marcas el último id de respuesta ya agregado
+# y en cada ejecución procesa solo las filas nuevas, con una sentencia por tabla.
+#
+# Consistencia de la marca: los ids se asignan al insertar pero las transacciones pueden
+# confirmarse en otro orden. Los escritores toman un lock consultivo compartido mientras
+# insertan y el rollup lo toma en exclusiva, en una transacción propia y breve, para leer max(id):
+# en ese momento no hay inserciones a medias, así que todo id <= max(id) ya es visible y ninguno
+# quedará atrás. Un segundo lock consultivo impide que dos procesos ejecuten el mismo rollup a la
+# vez; quien no lo consigue se retira, y quien lo tiene sigue pasando hasta que max(id) deja de
+# moverse después de soltarlo, así que ninguna respuesta confirmada queda sin agregar.
+#
+# Uso:
+#   python -m core.rollup_stats                  (rollup incremental, p. ej. desde cron)
+#   python -m core.rollup_stats --recalcular [--desde AAAA-MM-DD]
+#   python -m core.rollup_stats --metricas      (recalcula las métricas de todas las preguntas)
+#   python -m core.rollup_stats --crear-indices (migración: índices de los rollups, sin bloquear escrituras)
+import os
+import sys
+import argparse
+import datetime
+import threading
+import logging
+
+import psycopg2
+import psycopg2.extras
+from psycopg2 import sql
+
+from core.repaso import DDL_REPASO, programar_repaso
+from core.preguntas_vistas import DDL_VISTAS, registrar_vistas
+from core.metricas_preguntas import invalidar_metricas_preguntas
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración ---
+# Ids de respuesta que procesa cada rollup por pasada (acota la transacción al ponerse al día).
+MAX_IDS_POR_PASADA = 100000
+# Índice de discriminación: grupos superior e inferior (27 %) según el % de aciertos global del
+# usuario, considerando solo usuarios con un mínimo de respuestas y grupos con un mínimo de tamaño.
+PERCENTIL_GRUPOS = 27
+MIN_RESPUESTAS_USUARIO = 20
+MIN_RESPUESTAS_GRUPO = 5
+# Las métricas releen el historial completo de cada pregunta tocada y los percentiles de todos los
+# usuarios, así que no se recalculan en cada vaciado de la cola sino como mucho cada tantos segundos.
+ROLLUP_METRICAS_INTERVALO_S = float(os.environ.get('ROLLUP_METRICAS_INTERVALO', 900))
+
+SQL_LOCK_ESCRITURA_COMPARTIDO = "SELECT pg_advisory_xact_lock_shared(hashtext('stats_respuestas_usuario'))"
+SQL_LOCK_ESCRITURA_EXCLUSIVO = "SELECT pg_advisory_xact_lock(hashtext('stats_respuestas_usuario'))"
+
+DDL_MARCAS = """
+    CREATE TABLE IF NOT EXISTS stats_rollup_marcas (
+        nombre varchar(64) PRIMARY KEY,
+        ultimo_id bigint NOT NULL DEFAULT 0,
+        actualizado_en timestamptz NOT NULL DEFAULT now()
+    );
+"""
+
+DDL_METRICAS = """
+    CREATE TABLE IF NOT EXISTS stats_metricas_pregunta (
+        pregunta_id integer PRIMARY KEY,
+        num_respuestas integer NOT NULL,
+        tasa_acierto double precision NOT NULL,
+        tiempo_p50_ms double precision,
+        tiempo_p90_ms double precision,
+        indice_discriminacion double precision,
+        actualizado_en timestamptz NOT NULL DEFAULT now()
+    );
+"""
+
+# Índice que usa el rollup de métricas para leer el historial de las preguntas tocadas. No se crea
+# en asegurar_esquema (camino de escritura de los quizzes): construirlo sobre todo el registro
+# bloquearía las inserciones. Se crea aparte, sin bloquearlas: python -m core.rollup_stats --crear-indices
+INDICE_RESPUESTAS_PREGUNTA = 'idx_stats_respuestas_usuario_pregunta'
+SQL_CREAR_INDICE_RESPUESTAS_PREGUNTA = sql.SQL(
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON stats_respuestas_usuario (pregunta_id)"
+).format(sql.Identifier(INDICE_RESPUESTAS_PREGUNTA))
+
+# tipo -> (tabla, columna de periodo, sufijo de columnas, unidad de date_trunc, intervalo del periodo)
+TABLAS_TEMPORALES = {
+    'diario': ('stats_usuario_tiempo_diario', 'fecha', 'dia', 'day', '1 day'),
+    'semanal': ('stats_usuario_tiempo_semanal', 'fecha_inicio_semana', 'semana', 'week', '1 week'),
+    'mensual': ('stats_usuario_tiempo_mensual', 'fecha_inicio_mes', 'mes', 'month', '1 month'),
+}
+
+_esquema_ok = False
+_esquema_lock = threading.Lock()
+
+
+def _identificadores(tipo):
+    tabla, col_fecha, sufijo, unidad, intervalo = TABLAS_TEMPORALES[tipo]
+    ids = {
+        'tabla': sql.Identifier(tabla), 'col_fecha': sql.Identifier(col_fecha),
+        'col_resp': sql.Identifier(f"respuestas_{sufijo}"),
+        'col_aciertos': sql.Identifier(f"aciertos_{sufijo}"),
+        'col_errores': sql.Identifier(f"errores_{sufijo}"),
+        'col_p_aciertos': sql.Identifier(f"porcentaje_aciertos_{sufijo}"),
+        'col_p_errores': sql.Identifier(f"porcentaje_errores_{sufijo}"),
+        'col_var_p_aciertos': sql.Identifier(f"variacion_porcentaje_aciertos_{sufijo}_anterior"),
+    }
+    return ids, unidad, intervalo
+
+
+# --- Marca de agua ---
+def max_id_confirmado(conn):
+    """
+    Mayor id de respuesta tal que todos los ids menores o iguales ya están confirmados.
+    El lock es de transacción: se suelta al confirmar o, si algo falla, al deshacer, así que la
+    conexión nunca vuelve al pool reteniéndolo (un lock de sesión sobrevive al rollback).
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(SQL_LOCK_ESCRITURA_EXCLUSIVO)
+            cursor.execute("SELECT COALESCE(max(id), 0) FROM stats_respuestas_usuario")
+            hasta_id = cursor.fetchone()[0]
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    return hasta_id
+
+
+def asegurar_esquema(conn):
+    """
+    Crea las tablas de los rollups y sus marcas. Un rollup sin marca empieza en el máximo id actual:
+    lo anterior ya está sumado en las tablas por el camino de escritura antiguo (para rehacerlo,
+    --recalcular). Los de ROLLUPS_DESDE_CERO empiezan en 0.
+    """
+    global _esquema_ok
+    if _esquema_ok:
+        return
+    with _esquema_lock:
+        if _esquema_ok:
+            return
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext('stats_rollup_marcas'))")
+            cursor.execute(DDL_MARCAS)
+            cursor.execute(DDL_METRICAS)
+            cursor.execute(DDL_REPASO)
+            cursor.execute(DDL_VISTAS)
+        conn.commit()
+        hasta_id = max_id_confirmado(conn)
+        with conn.cursor() as cursor:
+            psycopg2.extras.execute_values(
+                cursor,
+                "INSERT INTO stats_rollup_marcas (nombre, ultimo_id) VALUES %s ON CONFLICT (nombre) DO NOTHING",
+                [(nombre, 0 if nombre in ROLLUPS_DESDE_CERO else hasta_id) for nombre in ROLLUPS],
+            )
+            if cursor.rowcount:
+                logger.info(f"Marcas de rollup inicializadas en el id {hasta_id}.")
+        conn.commit()
+        _esquema_ok = True
+
+
+def crear_indices(conn):
+    """
+    Crea con CONCURRENTLY los índices que necesitan los rollups (fuera de transacción). Si un intento
+    anterior se interrumpió y dejó el índice como inválido, lo borra y lo vuelve a crear.
+    """
+    autocommit_previo = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s",
+                (INDICE_RESPUESTAS_PREGUNTA,),
+            )
+            fila = cursor.fetchone()
+            if fila is not None and not fila[0]:
+                logger.warning(f"Índice {INDICE_RESPUESTAS_PREGUNTA} inválido (creación interrumpida); se vuelve a crear.")
+                cursor.execute(sql.SQL("DROP INDEX CONCURRENTLY {}").format(sql.Identifier(INDICE_RESPUESTAS_PREGUNTA)))
+            cursor.execute(SQL_CREAR_INDICE_RESPUESTAS_PREGUNTA)
+        logger.info(f"Índice {INDICE_RESPUESTAS_PREGUNTA} disponible.")
+    finally:
+        conn.autocommit = autocommit_previo
+
+
+# --- Rollup temporal ---
+def _sumar_periodos(cursor, tipo, filtro, parametros):
+    """
+    Suma a la tabla del tipo las respuestas que cumplen 'filtro' (fragmento SQL sobre r.*),
+    agrupadas por (usuario, periodo). Devuelve los (usuario_id, periodo) tocados.
+    """
+    ids, unidad, _ = _identificadores(tipo)
+    consulta = sql.SQL("""
+    INSERT INTO {tabla} (usuario_id, {col_fecha}, {col_resp}, {col_aciertos}, {col_errores})
+    SELECT r.usuario_id, date_trunc({unidad}, r.fecha_respuesta)::date,
+           count(*), count(*) FILTER (WHERE r.es_correcta), count(*) FILTER (WHERE NOT r.es_correcta)
+    FROM stats_respuestas_usuario r
+    WHERE {filtro}
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+    ON CONFLICT (usuario_id, {col_fecha}) DO UPDATE SET
+        {col_resp} = {tabla}.{col_resp} + EXCLUDED.{col_resp},
+        {col_aciertos} = {tabla}.{col_aciertos} + EXCLUDED.{col_aciertos},
+        {col_errores} = {tabla}.{col_errores} + EXCLUDED.{col_errores}
+    RETURNING usuario_id, {col_fecha};
+    """).format(unidad=sql.Literal(unidad), filtro=sql.SQL(filtro), **ids)
+    cursor.execute(consulta, parametros)
+    return cursor.fetchall()
+
+
+def _recalcular_porcentajes(cursor, tipo, periodos):
+    """
+    Recalcula porcentajes y variación frente al periodo anterior de los periodos indicados y de
+    los inmediatamente siguientes (su variación depende de estos). Una sola sentencia.
+    """
+    if not periodos:
+        return
+    ids, _, intervalo = _identificadores(tipo)
+    consulta = sql.SQL("""
+    WITH tocados AS (
+        SELECT * FROM unnest(%(usuarios)s::int[], %(periodos)s::date[]) AS t(usuario_id, periodo)
+    ),
+    afectados AS (
+        SELECT usuario_id, periodo FROM tocados
+        UNION
+        SELECT usuario_id, (periodo + {intervalo}::interval)::date FROM tocados
+    )
+    UPDATE {tabla} t SET
+        {col_p_aciertos} = ROUND(t.{col_aciertos} * 100.0 / NULLIF(t.{col_resp}, 0), 2),
+        {col_p_errores} = ROUND(t.{col_errores} * 100.0 / NULLIF(t.{col_resp}, 0), 2),
+        {col_var_p_aciertos} = ROUND(t.{col_aciertos} * 100.0 / NULLIF(t.{col_resp}, 0), 2) - COALESCE((
+            SELECT ROUND(p.{col_aciertos} * 100.0 / NULLIF(p.{col_resp}, 0), 2)
+            FROM {tabla} p
+            WHERE p.usuario_id = t.usuario_id AND p.{col_fecha} = (t.{col_fecha} - {intervalo}::interval)::date
+        ), 0.00)
+    FROM afectados a
+    WHERE t.usuario_id = a.usuario_id AND t.{col_fecha} = a.periodo;
+    """).format(intervalo=sql.Literal(intervalo), **ids)
+    cursor.execute(consulta, {
+        'usuarios': [fila[0] for fila in periodos],
+        'periodos': [fila[1] for fila in periodos],
+    })
+
+
+def rollup_temporal(cursor, desde_id, hasta_id):
+    """Agrega las respuestas con desde_id < id <= hasta_id en las tablas diaria, semanal y mensual."""
+    for tipo in TABLAS_TEMPORALES:
+        periodos = _sumar_periodos(cursor, tipo, "r.id > %(desde)s AND r.id <= %(hasta)s",
+                                   {'desde': desde_id, 'hasta': hasta_id})
+        _recalcular_porcentajes(cursor, tipo, periodos)
+
+
+# --- Rollup por pregunta ---
+def rollup_preguntas(cursor, desde_id, hasta_id):
+    """
+    Suma a stats_agregadas_pregunta las respuestas nuevas, una fila por pregunta y en orden de
+    clave. Mismo criterio que antes en el camino de escritura: los TIMEOUT no cuentan tiempo.
+    """
+    cursor.execute("""
+    INSERT INTO stats_agregadas_pregunta
+        (pregunta_id, total_respuestas, total_correctas, total_incorrectas,
+         suma_tiempo_respuesta_ms, num_respuestas_con_tiempo)
+    SELECT r.pregunta_id, count(*),
+           count(*) FILTER (WHERE r.es_correcta), count(*) FILTER (WHERE NOT r.es_correcta),
+           COALESCE(sum(r.tiempo_respuesta_ms) FILTER (WHERE r.respuesta_seleccionada <> 'TIMEOUT'), 0),
+           count(*) FILTER (WHERE r.respuesta_seleccionada <> 'TIMEOUT' AND r.tiempo_respuesta_ms > 0)
+    FROM stats_respuestas_usuario r
+    WHERE r.id > %(desde)s AND r.id <= %(hasta)s
+    GROUP BY r.pregunta_id
+    ORDER BY r.pregunta_id
+    ON CONFLICT (pregunta_id) DO UPDATE SET
+        total_respuestas = stats_agregadas_pregunta.total_respuestas + EXCLUDED.total_respuestas,
+        total_correctas = stats_agregadas_pregunta.total_correctas + EXCLUDED.total_correctas,
+        total_incorrectas = stats_agregadas_pregunta.total_incorrectas + EXCLUDED.total_incorrectas,
+        suma_tiempo_respuesta_ms = stats_agregadas_pregunta.suma_tiempo_respuesta_ms + EXCLUDED.suma_tiempo_respuesta_ms,
+        num_respuestas_con_tiempo = stats_agregadas_pregunta.num_respuestas_con_tiempo + EXCLUDED.num_respuestas_con_tiempo;
+    """, {'desde': desde_id, 'hasta': hasta_id})
+
+
+def _filtro_metricas(filtro):
+    """
+    Sentencia que recalcula stats_metricas_pregunta de las preguntas que cumplen 'filtro' (sobre r.*)
+    usando todas sus respuestas hasta %(hasta)s: tasa de acierto, p50/p90 del tiempo (sin TIMEOUT)
+    y el índice de discriminación (tasa de acierto del grupo superior menos la del inferior).
+    """
+    return sql.SQL("""
+    WITH tocadas AS (
+        SELECT DISTINCT r.pregunta_id FROM stats_respuestas_usuario r WHERE {filtro}
+    ),
+    habilidad AS (
+        SELECT usuario_id, ntile(100) OVER (ORDER BY porcentaje_aciertos) AS percentil
+        FROM stats_agregadas_usuario_global
+        WHERE total_respuestas >= %(min_usuario)s
+    ),
+    respuestas AS (
+        SELECT r.pregunta_id, r.es_correcta, h.percentil,
+               CASE WHEN r.respuesta_seleccionada <> 'TIMEOUT' AND r.tiempo_respuesta_ms > 0
+                    THEN r.tiempo_respuesta_ms END AS tiempo_ms
+        FROM stats_respuestas_usuario r
+        JOIN tocadas t ON t.pregunta_id = r.pregunta_id
+        LEFT JOIN habilidad h ON h.usuario_id = r.usuario_id
+        WHERE r.id <= %(hasta)s
+    )
+    INSERT INTO stats_metricas_pregunta
+        (pregunta_id, num_respuestas, tasa_acierto, tiempo_p50_ms, tiempo_p90_ms, indice_discriminacion, actualizado_en)
+    SELECT pregunta_id, count(*), avg(es_correcta::int),
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY tiempo_ms),
+           percentile_cont(0.9) WITHIN GROUP (ORDER BY tiempo_ms),
+           CASE WHEN count(*) FILTER (WHERE percentil > 100 - %(percentil)s) >= %(min_grupo)s
+                 AND count(*) FILTER (WHERE percentil <= %(percentil)s) >= %(min_grupo)s
+                THEN avg(es_correcta::int) FILTER (WHERE percentil > 100 - %(percentil)s)
+                     - avg(es_correcta::int) FILTER (WHERE percentil <= %(percentil)s)
+           END,
+           now()
+    FROM respuestas
+    GROUP BY pregunta_id
+    ORDER BY pregunta_id
+    ON CONFLICT (pregunta_id) DO UPDATE SET
+        num_respuestas = EXCLUDED.num_respuestas,
+        tasa_acierto = EXCLUDED.tasa_acierto,
+        tiempo_p50_ms = EXCLUDED.tiempo_p50_ms,
+        tiempo_p90_ms = EXCLUDED.tiempo_p90_ms,
+        indice_discriminacion = EXCLUDED.indice_discriminacion,
+        actualizado_en = EXCLUDED.actualizado_en;
+    """).format(filtro=sql.SQL(filtro))
+
+
+def _parametros_metricas(**parametros):
+    parametros.update(min_usuario=MIN_RESPUESTAS_USUARIO, percentil=PERCENTIL_GRUPOS, min_grupo=MIN_RESPUESTAS_GRUPO)
+    return parametros
+
+
+def rollup_metricas(cursor, desde_id, hasta_id):
+    """Recalcula las métricas derivadas de las preguntas con respuestas nuevas (percentiles y discriminación no son sumables)."""
+    cursor.execute(_filtro_metricas("r.id > %(desde)s AND r.id <= %(hasta)s"),
+                   _parametros_metricas(desde=desde_id, hasta=hasta_id))
+
+
+def recalcular_metricas(conn):
+    """Recalcula las métricas de todas las preguntas (p. ej. para refrescar la discriminación con las habilidades actuales)."""
+    asegurar_esquema(conn)
+    hasta_id = max_id_confirmado(conn)
+    with conn.cursor() as cursor:
+        cursor.execute(_filtro_metricas("r.id <= %(hasta)s"), _parametros_metricas(hasta=hasta_id))
+        logger.info(f"Métricas recalculadas para {cursor.rowcount} preguntas.")
+    conn.commit()
+    invalidar_metricas_preguntas()
+
+
+# nombre de la marca -> función (cursor, desde_id, hasta_id). Se ejecutan en este orden.
+ROLLUPS = {
+    'temporales': rollup_temporal,
+    'preguntas': rollup_preguntas,
+    'metricas': rollup_metricas,
+    'repaso': programar_repaso,
+    'vistas': registrar_vistas,
+}
+# Rollups cuyas tablas no existían con el camino de escritura antiguo: su marca empieza en 0 y
+# se ponen al día con todo el historial, por tramos de MAX_IDS_POR_PASADA.
+ROLLUPS_DESDE_CERO = {'repaso', 'vistas'}
+# Rollups no aditivos que se ejecutan como mucho cada tantos segundos (según el actualizado_en de
+# su marca). Cuando tocan, avanzan hasta el último id de una vez: su coste depende de las preguntas
+# tocadas, no del número de respuestas nuevas.
+ROLLUPS_PERIODICOS = {'metricas': ROLLUP_METRICAS_INTERVALO_S}
+
+
+# --- Ejecución ---
+def ejecutar_rollups(conn, esperar=False):
+    """
+    Ejecuta todos los rollups desde su marca hasta el último id confirmado.
+    Si otro proceso ya los está ejecutando, vuelve sin hacer nada (o espera, con esperar=True):
+    ese proceso verá sus respuestas, porque tras cada pasada sin cambios vuelve a leer max(id)
+    una vez soltado el lock y sigue mientras se haya movido. Los ROLLUPS_PERIODICOS solo se
+    ejecutan si ha pasado su intervalo; si no, se quedan para una ejecución posterior.
+    Devuelve {nombre: ids avanzados por su marca}.
+    """
+    asegurar_esquema(conn)
+    agregadas = {nombre: 0 for nombre in ROLLUPS}
+    max_id = max_id_confirmado(conn)
+    while True:
+        hubo_cambios = False
+        with conn.cursor() as cursor:
+            if esperar:
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext('stats_rollup_marcas'))")
+            else:
+                cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext('stats_rollup_marcas'))")
+                if not cursor.fetchone()[0]:
+                    conn.rollback()
+                    logger.info("Rollup de estadísticas ya en curso en otro proceso.")
+                    return agregadas
+            cursor.execute("SELECT nombre, ultimo_id, extract(epoch FROM now() - actualizado_en) FROM stats_rollup_marcas")
+            marcas = {row[0]: (row[1], float(row[2])) for row in cursor.fetchall()}
+            for nombre, rollup in ROLLUPS.items():
+                desde_id, antiguedad_s = marcas.get(nombre, (max_id, 0.0))
+                if desde_id >= max_id:
+                    continue
+                if nombre in ROLLUPS_PERIODICOS:
+                    if antiguedad_s < ROLLUPS_PERIODICOS[nombre]:
+                        continue
+                    hasta_id = max_id
+                else:
+                    hasta_id = min(max_id, desde_id + MAX_IDS_POR_PASADA)
+                rollup(cursor, desde_id, hasta_id)
+                cursor.execute(
+                    "UPDATE stats_rollup_marcas SET ultimo_id = %s, actualizado_en = now() WHERE nombre = %s",
+                    (hasta_id, nombre),
+                )
+                agregadas[nombre] += hasta_id - desde_id
+                hubo_cambios = True
+        conn.commit()
+        # Quien no consiguió el lock mientras se agregaba confirmó sus respuestas antes de intentarlo:
+        # leyendo max(id) después de soltarlo, aparecen aquí.
+        siguiente_max_id = max_id_confirmado(conn)
+        if not hubo_cambios and siguiente_max_id == max_id:
+            break
+        max_id = siguiente_max_id
+    if agregadas['metricas']:
+        # El modelo de lectura de este proceso se refresca en su próximo acceso; los demás, por TTL.
+        invalidar_metricas_preguntas()
+    if any(agregadas.values()):
+        logger.info(f"Rollup de estadísticas completado (ids avanzados por rollup: {agregadas}).")
+    return agregadas
+
+
+def recalcular_temporales(conn, desde=None):
+    """
+    Reconstruye las tablas temporales desde el registro de respuestas, completas o a partir de
+    la fecha 'desde' (se rehacen todos los periodos que la contienen o son posteriores).
+    """
+    asegurar_esquema(conn)
+    hasta_id = max_id_confirmado(conn)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('stats_rollup_marcas'))")
+        cursor.execute("SELECT ultimo_id FROM stats_rollup_marcas WHERE nombre = 'temporales' FOR UPDATE")
+        marca = cursor.fetchone()[0]
+        # Primero se pone al día lo pendiente desde la marca (puede caer antes de 'desde').
+        if marca < hasta_id:
+            rollup_temporal(cursor, marca, hasta_id)
+        for tipo in TABLAS_TEMPORALES:
+            ids, unidad, _ = _identificadores(tipo)
+            inicio = None
+            if desde is not None:
+                cursor.execute("SELECT date_trunc(%s, %s::timestamp)::date", (unidad, desde))
+                inicio = cursor.fetchone()[0]
+                cursor.execute(sql.SQL("DELETE FROM {tabla} WHERE {col_fecha} >= %s").format(**ids), (inicio,))
+                periodos = _sumar_periodos(cursor, tipo, "r.id <= %(hasta)s AND r.fecha_respuesta >= %(inicio)s",
+                                           {'hasta': hasta_id, 'inicio': inicio})
+            else:
+                cursor.execute(sql.SQL("DELETE FROM {tabla}").format(**ids))
+                periodos = _sumar_periodos(cursor, tipo, "r.id <= %(hasta)s", {'hasta': hasta_id})
+            _recalcular_porcentajes(cursor, tipo, periodos)
+            logger.info(f"Tabla {tipo} recalculada desde {inicio or 'el inicio'}: {len(periodos)} periodos.")
+        cursor.execute(
+            "UPDATE stats_rollup_marcas SET ultimo_id = %s, actualizado_en = now() WHERE nombre = 'temporales'",
+            (max(marca, hasta_id),),
+        )
+    conn.commit()
+
+
+def main(argv=None):
+    from core.database import conexion_db
+
+    parser = argparse.ArgumentParser(description="Rollups incrementales de estadísticas.")
+    parser.add_argument('--recalcular', action='store_true', help="Reconstruye las tablas temporales desde las respuestas.")
+    parser.add_argument('--desde', type=datetime.date.fromisoformat, help="Con --recalcular, fecha (AAAA-MM-DD) desde la que rehacer.")
+    parser.add_argument('--metricas', action='store_true', help="Recalcula las métricas derivadas de todas las preguntas.")
+    parser.add_argument('--crear-indices', action='store_true', help="Crea los índices de los rollups (CONCURRENTLY).")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    with conexion_db() as conn:
+        if args.crear_indices:
+            crear_indices(conn)
+        elif args.recalcular:
+            recalcular_temporales(conn, args.desde)
+        elif args.metricas:
+            recalcular_metricas(conn)
+        else:
+            print(f"Ids agregados por rollup: {ejecutar_rollups(conn, esperar=True)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
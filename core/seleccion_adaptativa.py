@@ -0,0 +1,209 @@
+# core/seleccion_adaptativa.py
+# Selección de preguntas del modo "Libre-Adaptativo".
+#
+# A partir de stats_agregadas_usuario_tema se calcula para cada usuario un vector de pesos por
+# tema, alineado con indice.tema_ids:
+#   peso_tema = tasa_de_error_suavizada * factor_olvido
+# - La tasa de error usa un prior Beta (ADAPTATIVO_PRIOR_ERROR con fuerza ADAPTATIVO_PRIOR_FUERZA),
+#   así que un tema sin respuestas pesa como uno con un 50 % de fallos y un tema con pocas
+#   respuestas no se dispara por un fallo aislado.
+# - El factor de olvido crece desde 1 (practicado hoy) hasta 2 con los días desde ultimo_uso
+#   (constante ADAPTATIVO_TAU_DIAS); los temas nunca practicados tienen factor 2.
+# El peso de una pregunta es el máximo de los pesos de sus temas, multiplicado por
+# ADAPTATIVO_FACTOR_NO_DISCRIMINA si su índice de discriminación (core/metricas_preguntas.py) está
+# por debajo de ADAPTATIVO_DISCRIMINACION_MINIMA: una pregunta que los alumnos flojos aciertan
+# tanto o más que los fuertes no ayuda a detectar lagunas. El de un caso práctico es la media de
+# sus preguntas. Las unidades (casos completos y teóricas sueltas) se ordenan con un muestreo
+# ponderado sin reemplazo (Efraimidis-Spirakis: clave = log(u) / peso) y se llenan como en el
+# modo Aleatorio. Todo son operaciones vectorizadas sobre el índice en memoria y una consulta
+# por usuario, cacheada ADAPTATIVO_CACHE_TTL_S segundos o hasta que stats_handler registra un
+# quiz suyo (invalidar_perfil_usuario).
+import os
+import threading
+import datetime
+import logging
+
+import numpy as np
+from cachetools import TTLCache
+
+from core.indice_preguntas import obtener_indice_preguntas
+from core.metricas_preguntas import obtener_metricas_preguntas
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración (sobrescribible por variables de entorno) ---
+ADAPTATIVO_PRIOR_ERROR = float(os.environ.get('ADAPTATIVO_PRIOR_ERROR', 0.5))
+ADAPTATIVO_PRIOR_FUERZA = float(os.environ.get('ADAPTATIVO_PRIOR_FUERZA', 4))
+ADAPTATIVO_TAU_DIAS = float(os.environ.get('ADAPTATIVO_TAU_DIAS', 14))
+ADAPTATIVO_CACHE_TTL_S = float(os.environ.get('ADAPTATIVO_CACHE_TTL', 120))
+# Preguntas que no discriminan (sin dato de discriminación el factor es 1).
+ADAPTATIVO_DISCRIMINACION_MINIMA = float(os.environ.get('ADAPTATIVO_DISCRIMINACION_MINIMA', 0.0))
+ADAPTATIVO_FACTOR_NO_DISCRIMINA = float(os.environ.get('ADAPTATIVO_FACTOR_NO_DISCRIMINA', 0.25))
+# Peso mínimo: ningún tema desaparece del todo de la selección.
+PESO_MINIMO = 0.02
+# Unidades candidatas por pregunta pedida que se ordenan en la primera pasada.
+FACTOR_CANDIDATAS = 4
+ESPECIALIDAD_BIOQUIMICA = 'BQ'
+
+_perfiles = TTLCache(maxsize=2048, ttl=ADAPTATIVO_CACHE_TTL_S)
+_temas_por_indice = {}  # huella del índice -> posición en tema_ids de cada entrada de temas_indices
+_factores_por_huellas = {}  # (huella del índice, huella de las métricas) -> factor por pregunta
+_lock = threading.Lock()
+
+
+def _posiciones_temas(indice):
+    """Posición en indice.tema_ids de cada tema del CSR pregunta -> temas (se calcula una vez por índice)."""
+    with _lock:
+        posiciones = _temas_por_indice.get(indice.huella)
+    if posiciones is None:
+        posiciones = np.searchsorted(indice.tema_ids, indice.temas_indices)
+        with _lock:
+            _temas_por_indice.clear()
+            _temas_por_indice[indice.huella] = posiciones
+    return posiciones
+
+
+def _factores_discriminacion(indice, metricas):
+    """Factor de cada pregunta del índice según su discriminación (se calcula una vez por índice y métricas)."""
+    clave = (indice.huella, metricas.huella)
+    with _lock:
+        factores = _factores_por_huellas.get(clave)
+    if factores is None:
+        discriminacion = metricas.valores('indice_discriminacion', indice.pregunta_ids)
+        factores = np.where(discriminacion < ADAPTATIVO_DISCRIMINACION_MINIMA,
+                            np.float32(ADAPTATIVO_FACTOR_NO_DISCRIMINA), np.float32(1.0)).astype(np.float32)
+        factores.setflags(write=False)
+        with _lock:
+            _factores_por_huellas.clear()
+            _factores_por_huellas[clave] = factores
+    return factores
+
+
+def _dias_desde(ultimo_uso, ahora):
+    if ultimo_uso is None:
+        return np.inf
+    if ultimo_uso.tzinfo is not None:
+        ahora = ahora.astimezone(ultimo_uso.tzinfo)
+    return max((ahora - ultimo_uso).total_seconds() / 86400.0, 0.0)
+
+
+def _calcular_pesos_temas(filas, tema_ids, ahora):
+    total = np.zeros(len(tema_ids), dtype=np.float64)
+    errores = np.zeros(len(tema_ids), dtype=np.float64)
+    dias = np.full(len(tema_ids), np.inf)
+    if filas and len(tema_ids):
+        datos_ids = np.array([f[0] for f in filas], dtype=np.int64)
+        pos = np.minimum(np.searchsorted(tema_ids, datos_ids), len(tema_ids) - 1)
+        validos = tema_ids[pos] == datos_ids
+        total[pos[validos]] = np.array([f[1] or 0 for f in filas], dtype=np.float64)[validos]
+        errores[pos[validos]] = np.array([f[2] or 0 for f in filas], dtype=np.float64)[validos]
+        dias[pos[validos]] = np.array([_dias_desde(f[3], ahora) for f in filas], dtype=np.float64)[validos]
+
+    tasa_error = (errores + ADAPTATIVO_PRIOR_ERROR * ADAPTATIVO_PRIOR_FUERZA) / (total + ADAPTATIVO_PRIOR_FUERZA)
+    factor_olvido = 2.0 - np.exp(-dias / ADAPTATIVO_TAU_DIAS)
+    return np.maximum(tasa_error * factor_olvido, PESO_MINIMO).astype(np.float32)
+
+
+def pesos_temas_usuario(conn, usuario_id, indice):
+    """Vector de pesos del usuario alineado con indice.tema_ids (cacheado por usuario e índice)."""
+    clave = (usuario_id, indice.huella)
+    with _lock:
+        pesos = _perfiles.get(clave)
+    if pesos is not None:
+        return pesos
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT tema_id, total_respuestas, total_incorrectas, ultimo_uso FROM stats_agregadas_usuario_tema WHERE usuario_id = %s",
+            (usuario_id,),
+        )
+        filas = [tuple(row) for row in cursor.fetchall()]
+    pesos = _calcular_pesos_temas(filas, indice.tema_ids, datetime.datetime.now())
+    pesos.setflags(write=False)
+    with _lock:
+        _perfiles[clave] = pesos
+    return pesos
+
+
+def invalidar_perfil_usuario(usuario_id=None):
+    """Descarta el vector cacheado de un usuario (o de todos)."""
+    with _lock:
+        for clave in [c for c in _perfiles if usuario_id is None or c[0] == usuario_id]:
+            _perfiles.pop(clave, None)
+
+
+def pesos_preguntas(indice, pesos_temas):
+    """Peso de cada pregunta del índice: el máximo de sus temas (el prior si no tiene temas)."""
+    peso_sin_tema = np.float32(ADAPTATIVO_PRIOR_ERROR * 2.0)
+    pesos = np.full(len(indice.pregunta_ids), peso_sin_tema, dtype=np.float32)
+    con_temas = indice.num_temas_de > 0
+    if len(indice.temas_indices):
+        por_entrada = pesos_temas[_posiciones_temas(indice)]
+        maximos = np.maximum.reduceat(por_entrada, indice.temas_indptr[:-1][con_temas])
+        pesos[con_temas] = maximos
+    return pesos
+
+
+def _tramos_por_clave(claves, num_candidatas):
+    """
+    Índices en orden de clave descendente, en dos tramos: las num_candidatas mejores (argpartition,
+    casi siempre bastan para llenar el quiz) y, solo si se piden, todas las demás.
+    """
+    if num_candidatas >= len(claves):
+        yield np.argsort(-claves)
+        return
+    particion = np.argpartition(-claves, num_candidatas - 1)
+    mejores, resto = particion[:num_candidatas], particion[num_candidatas:]
+    yield mejores[np.argsort(-claves[mejores])]
+    yield resto[np.argsort(-claves[resto])]
+
+
+def seleccionar_ids_adaptativas(conn, n_objetivo, usuario_id, especialidad_usuario=None, rng=None):
+    """
+    Devuelve hasta n_objetivo ids, casos prácticos completos y teóricas, muestreados con
+    probabilidad proporcional al peso de cada unidad para el usuario.
+    """
+    if n_objetivo <= 0:
+        return []
+    rng = rng or np.random.default_rng()
+    indice = obtener_indice_preguntas(conn)
+    pesos = pesos_preguntas(indice, pesos_temas_usuario(conn, usuario_id, indice))
+    pesos *= _factores_discriminacion(indice, obtener_metricas_preguntas(conn))
+
+    # Unidades: primero los casos prácticos (como en el modo Aleatorio, sin filtro de especialidad),
+    # después las teóricas que pasan el filtro.
+    tamanos_bloques = np.diff(indice.escenario_indptr)
+    if len(indice.escenario_miembros):
+        pesos_bloques = np.add.reduceat(pesos[indice.escenario_miembros], indice.escenario_indptr[:-1]) / np.maximum(tamanos_bloques, 1)
+    else:
+        pesos_bloques = np.zeros(0, dtype=np.float32)
+    mascara_teoricas = indice.es_teorica.copy()
+    if especialidad_usuario == ESPECIALIDAD_BIOQUIMICA:
+        mascara_teoricas &= indice.es_bioquimica
+    teoricas = np.flatnonzero(mascara_teoricas)
+
+    num_bloques = len(tamanos_bloques)
+    pesos_unidades = np.concatenate([pesos_bloques, pesos[teoricas]]).astype(np.float64)
+    tamanos_unidades = np.concatenate([tamanos_bloques, np.ones(len(teoricas), dtype=np.int64)]).tolist()
+    if len(pesos_unidades) == 0:
+        return []
+
+    # Efraimidis-Spirakis: las unidades con mayor log(u) / peso forman una muestra ponderada sin reemplazo.
+    claves = np.log(rng.random(len(pesos_unidades))) / pesos_unidades
+    seleccion, num_seleccionadas = [], 0
+    for tramo in _tramos_por_clave(claves, FACTOR_CANDIDATAS * n_objetivo):
+        for unidad in tramo.tolist():
+            if num_seleccionadas + tamanos_unidades[unidad] <= n_objetivo:
+                seleccion.append(unidad)
+                num_seleccionadas += tamanos_unidades[unidad]
+                if num_seleccionadas == n_objetivo:
+                    break
+        if num_seleccionadas == n_objetivo:
+            break
+
+    ids = []
+    for unidad in seleccion:
+        if unidad < num_bloques:
+            ids.extend(indice.ids(indice.miembros_de_escenario(unidad)))
+        else:
+            ids.append(int(indice.pregunta_ids[teoricas[unidad - num_bloques]]))
+    return ids
@@ -1,13 +1,16 @@
 # stats_handler.py
+import uuid
 import logging
-import datetime
+import threading
+from collections import Counter, defaultdict
 from datetime import datetime as dt
-from psycopg2 import sql
 import psycopg2
+import psycopg2.extras
 
 # MODIFICACIÓN: Importar desde los nuevos módulos refactorizados
-from .db_quiz_loader import conectar_db, DatabaseConnectionError
-from .db_quiz_handler import get_temas_directos_pregunta, get_pregunta_detalle_por_id, obtener_total_respuestas_previas_usuario
+from .db_quiz_loader import conexion_db, DatabaseConnectionError
+from . import rollup_stats
+from .seleccion_adaptativa import invalidar_perfil_usuario
 
 # --- Configuración Global ---
 TAMAÑO_BLOQUE_PREGUNTAS = 50
@@ -20,331 +23,280 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# --- Funciones Auxiliares para Actualizar Estadísticas ---
-
-def _registrar_respuesta_usuario_y_stats_pregunta(
-    cursor, usuario_id, pregunta_id, respuesta_seleccionada_db, 
-    es_correcta, tiempo_respuesta_ms, fecha_respuesta):
+# --- Intentos de Quiz (idempotencia) ---
+# Cada quiz lleva un intento_id (UUID) generado al empezar. El primer envío de un intento lo
+# reclama en stats_intentos_procesados dentro de la misma transacción que escribe las stats;
+# cualquier envío posterior del mismo intento (doble clic, rerun, reintento de la cola)
+# no encuentra nada que reclamar y no suma nada. Si dos envíos coinciden en el tiempo, el
+# segundo espera en la clave primaria a que el primero confirme o se deshaga.
+DDL_INTENTOS = """
+    CREATE TABLE IF NOT EXISTS stats_intentos_procesados (
+        intento_id uuid PRIMARY KEY,
+        usuario_id integer NOT NULL,
+        num_respuestas integer NOT NULL DEFAULT 0,
+        procesado_en timestamptz NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS idx_stats_intentos_procesados_usuario ON stats_intentos_procesados (usuario_id);
+"""
+DDL_INTENTO_RESPUESTAS = """
+    ALTER TABLE stats_respuestas_usuario ADD COLUMN IF NOT EXISTS intento_id uuid;
+    CREATE INDEX IF NOT EXISTS idx_stats_respuestas_usuario_intento ON stats_respuestas_usuario (intento_id)
+        WHERE intento_id IS NOT NULL;
+"""
+_esquema_intentos_ok = False
+_esquema_intentos_lock = threading.Lock()
+
+def nuevo_intento_id():
+    return str(uuid.uuid4())
+
+def _asegurar_esquema_intentos(conn):
+    """Crea la tabla de intentos y la columna intento_id (solo si falta, para no bloquear la tabla en cada arranque)."""
+    global _esquema_intentos_ok
+    if _esquema_intentos_ok:
+        return
+    with _esquema_intentos_lock:
+        if _esquema_intentos_ok:
+            return
+        with conn.cursor() as cursor:
+            # CREATE ... IF NOT EXISTS no es seguro con varios procesos creando a la vez.
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext('stats_intentos_procesados'))")
+            cursor.execute(DDL_INTENTOS)
+            cursor.execute("""
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'stats_respuestas_usuario' AND column_name = 'intento_id'
+            """)
+            if cursor.fetchone() is None:
+                cursor.execute(DDL_INTENTO_RESPUESTAS)
+        conn.commit()
+        _esquema_intentos_ok = True
+
+def _reclamar_intento(cursor, intento_id, usuario_id):
+    """True si este envío es el primero del intento; False si el intento ya se había procesado."""
+    cursor.execute("""
+        INSERT INTO stats_intentos_procesados (intento_id, usuario_id) VALUES (%s, %s)
+        ON CONFLICT (intento_id) DO NOTHING;
+    """, (intento_id, usuario_id))
+    return cursor.rowcount == 1
+
+# --- Motor de Estadísticas por Lotes ---
+# Todas las respuestas de un quiz se agregan primero en Python y luego se escriben con
+# unas pocas sentencias multi-fila: cada fila (usuario, tema) se toca una sola vez por
+# quiz, en orden de clave para evitar interbloqueos entre quizzes.
+# Las tablas temporales (diaria, semanal, mensual) y los contadores por pregunta no se
+# tocan aquí: los mantiene el rollup incremental de core/rollup_stats.py a partir de
+# stats_respuestas_usuario (una pregunta popular ya no es una fila caliente por quiz).
+
+def _evaluar_respuesta(respuesta_seleccionada_original_ui, tiempo_respuesta_ms, respuesta_correcta_db):
     """
-    1. Inserta la respuesta individual en stats_respuestas_usuario.
-    2. Actualiza las estadísticas agregadas para esa pregunta en stats_agregadas_pregunta.
+    Normaliza la respuesta de la UI y devuelve (respuesta_seleccionada_db, es_correcta, tiempo_para_suma).
+    Una respuesta vacía se registra como 'TIMEOUT' y no cuenta para los promedios de tiempo.
     """
-    respuesta_id_insertada = None
-    try:
-        sql_insert_respuesta = """
-        INSERT INTO stats_respuestas_usuario 
-            (usuario_id, pregunta_id, respuesta_seleccionada, es_correcta, tiempo_respuesta_ms, fecha_respuesta)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        RETURNING id;
-        """
-        cursor.execute(sql_insert_respuesta, (
-            usuario_id, pregunta_id, respuesta_seleccionada_db, 
-            es_correcta, tiempo_respuesta_ms, fecha_respuesta
-        ))
-        respuesta_id_insertada = cursor.fetchone()[0]
+    es_correcta = False
+    respuesta_seleccionada_db = 'TIMEOUT'
 
-        tiempo_para_suma = tiempo_respuesta_ms if respuesta_seleccionada_db != 'TIMEOUT' and tiempo_respuesta_ms is not None else 0
-        incremento_contador_tiempo = 1 if tiempo_para_suma > 0 else 0
-        
-        sql_update_stats_pregunta = """
-        INSERT INTO stats_agregadas_pregunta 
-            (pregunta_id, total_respuestas, total_correctas, total_incorrectas, 
-             suma_tiempo_respuesta_ms, num_respuestas_con_tiempo)
-        VALUES (%s, 1, %s, %s, %s, %s)
-        ON CONFLICT (pregunta_id) DO UPDATE SET
-            total_respuestas = stats_agregadas_pregunta.total_respuestas + 1,
-            total_correctas = stats_agregadas_pregunta.total_correctas + EXCLUDED.total_correctas,
-            total_incorrectas = stats_agregadas_pregunta.total_incorrectas + EXCLUDED.total_incorrectas,
-            suma_tiempo_respuesta_ms = stats_agregadas_pregunta.suma_tiempo_respuesta_ms + EXCLUDED.suma_tiempo_respuesta_ms,
-            num_respuestas_con_tiempo = stats_agregadas_pregunta.num_respuestas_con_tiempo + EXCLUDED.num_respuestas_con_tiempo;
-        """
-        cursor.execute(sql_update_stats_pregunta, (
-            pregunta_id, 
-            1 if es_correcta else 0, 
-            1 if not es_correcta else 0, 
-            tiempo_para_suma, 
-            incremento_contador_tiempo
-        ))
-    except psycopg2.Error as e_db:
-        logger.error(f"Error en _registrar_respuesta_usuario_y_stats_pregunta para P_ID {pregunta_id}: {e_db}", exc_info=True)
-        raise
-    return respuesta_id_insertada
+    if respuesta_seleccionada_original_ui is not None and str(respuesta_seleccionada_original_ui).strip() != "":
+        respuesta_seleccionada_db = str(respuesta_seleccionada_original_ui).upper()
+        if respuesta_seleccionada_db in ('A', 'B', 'C', 'D'):
+            es_correcta = (respuesta_seleccionada_db == str(respuesta_correcta_db).upper())
+
+    tiempo_para_suma = tiempo_respuesta_ms if respuesta_seleccionada_db != 'TIMEOUT' and tiempo_respuesta_ms is not None else 0
+    return respuesta_seleccionada_db, es_correcta, tiempo_para_suma
 
-def _registrar_respuesta_tema_detalle(cursor, respuesta_usuario_id, pregunta_id, es_correcta, conn_db):
+def _obtener_datos_preguntas(cursor, pregunta_ids):
     """
-    Inserta la relación entre la respuesta y sus temas en stats_respuestas_usuario_tema_detalle.
+    Una sola consulta para todas las preguntas del quiz: {pregunta_id: (respuesta_correcta, [tema_ids])}.
+    Sustituye a get_pregunta_detalle_por_id + get_temas_directos_pregunta por respuesta.
     """
-    if respuesta_usuario_id is None:
-        return
-
-    temas_ids = get_temas_directos_pregunta(conn_db, pregunta_id)
-    if not temas_ids:
-        return
-
-    sql_insert_tema_detalle = """
+    cursor.execute("""
+        SELECT p.id, p.respuesta_correcta,
+               COALESCE(array_agg(pt.tema_id) FILTER (WHERE pt.tema_id IS NOT NULL), '{}') AS temas_ids
+        FROM preguntas_contenido p
+        LEFT JOIN pregunta_tema pt ON pt.pregunta_id = p.id
+        WHERE p.id = ANY(%s)
+        GROUP BY p.id, p.respuesta_correcta;
+    """, (list(pregunta_ids),))
+    return {row[0]: (row[1], list(row[2])) for row in cursor.fetchall()}
+
+def _insertar_respuestas_y_detalle_temas(cursor, usuario_id, respuestas, intento_id=None):
+    """
+    Inserta todas las respuestas en stats_respuestas_usuario y su desglose por tema en
+    stats_respuestas_usuario_tema_detalle con una única sentencia (INSERT ... SELECT unnest).
+    """
+    sql_insert = """
+    WITH nuevas AS (
+        INSERT INTO stats_respuestas_usuario
+            (usuario_id, intento_id, pregunta_id, respuesta_seleccionada, es_correcta, tiempo_respuesta_ms, fecha_respuesta)
+        SELECT %s, %s::uuid, r.pregunta_id, r.respuesta_seleccionada, r.es_correcta, r.tiempo_respuesta_ms, r.fecha_respuesta
+        FROM unnest(%s::int[], %s::text[], %s::boolean[], %s::int[], %s::timestamp[])
+            AS r(pregunta_id, respuesta_seleccionada, es_correcta, tiempo_respuesta_ms, fecha_respuesta)
+        RETURNING id, pregunta_id, es_correcta
+    )
     INSERT INTO stats_respuestas_usuario_tema_detalle
         (respuesta_usuario_id, tema_id, es_correcta_en_contexto)
-    VALUES (%s, %s, %s)
+    SELECT n.id, pt.tema_id, n.es_correcta
+    FROM nuevas n
+    JOIN pregunta_tema pt ON pt.pregunta_id = n.pregunta_id
     ON CONFLICT (respuesta_usuario_id, tema_id) DO NOTHING;
     """
-    for tema_id in temas_ids:
-        try:
-            cursor.execute(sql_insert_tema_detalle, (respuesta_usuario_id, tema_id, es_correcta))
-        except psycopg2.Error as e_db:
-            logger.error(f"Error insertando en stats_respuestas_usuario_tema_detalle (resp_id {respuesta_usuario_id}, tema_id {tema_id}): {e_db}", exc_info=True)
-
-def _actualizar_stats_agregadas_usuario_tema(
-    cursor, usuario_id, temas_ids, es_correcta, 
-    respuesta_seleccionada_db, tiempo_respuesta_ms):
+    cursor.execute(sql_insert, (
+        usuario_id, intento_id,
+        [r['pregunta_id'] for r in respuestas],
+        [r['respuesta_seleccionada_db'] for r in respuestas],
+        [r['es_correcta'] for r in respuestas],
+        [r['tiempo_respuesta_ms'] for r in respuestas],
+        [r['fecha_respuesta'] for r in respuestas],
+    ))
+
+def _actualizar_stats_agregadas_usuario_tema(cursor, usuario_id, agregados_tema):
     """
-    Actualiza stats_agregadas_usuario_tema para los temas indicados.
+    Upsert multi-fila en stats_agregadas_usuario_tema.
+    agregados_tema: {tema_id: [respuestas, correctas, incorrectas, suma_tiempo_ms, num_con_tiempo]}
     """
-    if not temas_ids:
+    if not agregados_tema:
         return
-
-    tiempo_para_suma = tiempo_respuesta_ms if respuesta_seleccionada_db != 'TIMEOUT' and tiempo_respuesta_ms is not None else 0
-    incremento_contador_tiempo = 1 if tiempo_para_suma > 0 else 0
-
-    sql_update_stats_tema = """
-    INSERT INTO stats_agregadas_usuario_tema 
-        (usuario_id, tema_id, total_respuestas, total_correctas, total_incorrectas, 
+    sql_upsert = """
+    INSERT INTO stats_agregadas_usuario_tema
+        (usuario_id, tema_id, total_respuestas, total_correctas, total_incorrectas,
          suma_tiempo_respuesta_ms, num_respuestas_con_tiempo, ultimo_uso)
-    VALUES (%s, %s, 1, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+    VALUES %s
     ON CONFLICT (usuario_id, tema_id) DO UPDATE SET
-        total_respuestas = stats_agregadas_usuario_tema.total_respuestas + 1,
+        total_respuestas = stats_agregadas_usuario_tema.total_respuestas + EXCLUDED.total_respuestas,
         total_correctas = stats_agregadas_usuario_tema.total_correctas + EXCLUDED.total_correctas,
         total_incorrectas = stats_agregadas_usuario_tema.total_incorrectas + EXCLUDED.total_incorrectas,
         suma_tiempo_respuesta_ms = stats_agregadas_usuario_tema.suma_tiempo_respuesta_ms + EXCLUDED.suma_tiempo_respuesta_ms,
         num_respuestas_con_tiempo = stats_agregadas_usuario_tema.num_respuestas_con_tiempo + EXCLUDED.num_respuestas_con_tiempo,
         ultimo_uso = CURRENT_TIMESTAMP;
     """
-    for tema_id in temas_ids:
-        try:
-            cursor.execute(sql_update_stats_tema, (
-                usuario_id, tema_id, 
-                1 if es_correcta else 0, 
-                1 if not es_correcta else 0, 
-                tiempo_para_suma, 
-                incremento_contador_tiempo
-            ))
-        except psycopg2.Error as e_db:
-            logger.error(f"Error actualizando stats_agregadas_usuario_tema (user {usuario_id}, tema {tema_id}): {e_db}", exc_info=True)
-            raise
+    filas = [(usuario_id, tema_id, *valores) for tema_id, valores in sorted(agregados_tema.items())]
+    psycopg2.extras.execute_values(
+        cursor, sql_upsert, filas,
+        template="(%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)", page_size=len(filas)
+    )
 
-def _actualizar_stats_agregadas_usuario_global(cursor, usuario_id, es_correcta):
+def _actualizar_stats_agregadas_usuario_global(cursor, usuario_id, total_respuestas, total_aciertos, total_errores):
     """
-    Actualiza stats_agregadas_usuario_global.
+    Actualiza stats_agregadas_usuario_global con los totales del quiz en una sola sentencia.
     """
     sql_update_stats_global = """
-    INSERT INTO stats_agregadas_usuario_global 
-        (usuario_id, total_respuestas, total_aciertos, total_errores, 
+    INSERT INTO stats_agregadas_usuario_global
+        (usuario_id, total_respuestas, total_aciertos, total_errores,
          porcentaje_aciertos, porcentaje_errores, ultima_actualizacion)
-    VALUES (%s, 1, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+    VALUES (%(usuario_id)s, %(total)s, %(aciertos)s, %(errores)s,
+            ROUND(%(aciertos)s * 100.0 / %(total)s, 2), ROUND(%(errores)s * 100.0 / %(total)s, 2), CURRENT_TIMESTAMP)
     ON CONFLICT (usuario_id) DO UPDATE SET
-        total_respuestas = stats_agregadas_usuario_global.total_respuestas + 1,
+        total_respuestas = stats_agregadas_usuario_global.total_respuestas + EXCLUDED.total_respuestas,
         total_aciertos = stats_agregadas_usuario_global.total_aciertos + EXCLUDED.total_aciertos,
         total_errores = stats_agregadas_usuario_global.total_errores + EXCLUDED.total_errores,
-        porcentaje_aciertos = ROUND(((stats_agregadas_usuario_global.total_aciertos + EXCLUDED.total_aciertos) * 100.0) / NULLIF(stats_agregadas_usuario_global.total_respuestas + 1, 0), 2),
-        porcentaje_errores = ROUND(((stats_agregadas_usuario_global.total_errores + EXCLUDED.total_errores) * 100.0) / NULLIF(stats_agregadas_usuario_global.total_respuestas + 1, 0), 2),
+        porcentaje_aciertos = ROUND(((stats_agregadas_usuario_global.total_aciertos + EXCLUDED.total_aciertos) * 100.0) / NULLIF(stats_agregadas_usuario_global.total_respuestas + EXCLUDED.total_respuestas, 0), 2),
+        porcentaje_errores = ROUND(((stats_agregadas_usuario_global.total_errores + EXCLUDED.total_errores) * 100.0) / NULLIF(stats_agregadas_usuario_global.total_respuestas + EXCLUDED.total_respuestas, 0), 2),
         ultima_actualizacion = CURRENT_TIMESTAMP;
     """
-    acierto_val = 1 if es_correcta else 0
-    error_val = 1 if not es_correcta else 0
-    porc_acierto_inicial = 100.0 if es_correcta else 0.0
-    porc_error_inicial = 0.0 if es_correcta else 100.0
-    try:
-        cursor.execute(sql_update_stats_global, (
-            usuario_id, acierto_val, error_val, 
-            porc_acierto_inicial, porc_error_inicial
-        ))
-    except psycopg2.Error as e_db:
-        logger.error(f"Error actualizando stats_agregadas_usuario_global para user {usuario_id}: {e_db}", exc_info=True)
-        raise
+    cursor.execute(sql_update_stats_global, {
+        'usuario_id': usuario_id, 'total': total_respuestas,
+        'aciertos': total_aciertos, 'errores': total_errores
+    })
 
-def _actualizar_estadisticas_temporales(cursor, usuario_id, es_correcta, fecha_respuesta, tipo_temporal):
+def procesar_lote_respuestas(cursor, usuario_id, respuestas_acumuladas_ui, intento_id=None):
     """
-    Actualiza las estadísticas temporales (diarias, semanales, mensuales) para un usuario.
+    Motor por lotes: valida y agrega en Python todas las respuestas del quiz y las escribe
+    con un número fijo de sentencias (independiente del tamaño del quiz).
+    Con intento_id, un intento ya procesado no vuelve a sumar (devuelve 0).
+    No hace COMMIT; devuelve el número de respuestas registradas.
     """
-    logger.debug(f"Actualizando stats {tipo_temporal} para usuario {usuario_id}.")
-    
-    if tipo_temporal == 'diario':
-        fecha_periodo_actual = fecha_respuesta.date()
-        fecha_periodo_anterior = fecha_periodo_actual - datetime.timedelta(days=1)
-        tabla_stats, col_fecha, prefijo_cols = 'stats_usuario_tiempo_diario', 'fecha', 'dia'
-    elif tipo_temporal == 'semanal':
-        fecha_periodo_actual = fecha_respuesta.date() - datetime.timedelta(days=fecha_respuesta.weekday())
-        fecha_periodo_anterior = fecha_periodo_actual - datetime.timedelta(weeks=1)
-        tabla_stats, col_fecha, prefijo_cols = 'stats_usuario_tiempo_semanal', 'fecha_inicio_semana', 'semana'
-    elif tipo_temporal == 'mensual':
-        fecha_periodo_actual = fecha_respuesta.date().replace(day=1)
-        ultimo_dia_mes_pasado = fecha_periodo_actual - datetime.timedelta(days=1)
-        fecha_periodo_anterior = ultimo_dia_mes_pasado.replace(day=1)
-        tabla_stats, col_fecha, prefijo_cols = 'stats_usuario_tiempo_mensual', 'fecha_inicio_mes', 'mes'
-    else:
-        logger.warning(f"Tipo temporal '{tipo_temporal}' no reconocido.")
-        return
-
-    resp_col = f"respuestas_{prefijo_cols}"
-    aciertos_col = f"aciertos_{prefijo_cols}"
-    errores_col = f"errores_{prefijo_cols}"
-    p_aciertos_col = f"porcentaje_aciertos_{prefijo_cols}"
-    p_errores_col = f"porcentaje_errores_{prefijo_cols}"
-    var_p_aciertos_col = f"variacion_porcentaje_aciertos_{prefijo_cols}_anterior"
-    var_p_errores_col = f"variacion_porcentaje_errores_{prefijo_cols}_anterior"
-
-    porc_aciertos_anterior_db = 0.00
-    sql_get_anterior = sql.SQL(
-        "SELECT {col_p_aciertos} FROM {tabla} WHERE usuario_id = %s AND {col_fecha_ref} = %s"
-    ).format(
-        col_p_aciertos=sql.Identifier(p_aciertos_col),
-        tabla=sql.Identifier(tabla_stats),
-        col_fecha_ref=sql.Identifier(col_fecha)
-    )
-    try:
-        cursor.execute(sql_get_anterior, (usuario_id, fecha_periodo_anterior.strftime('%Y-%m-%d')))
-        res_anterior = cursor.fetchone()
-        if res_anterior:
-            porc_aciertos_anterior_db = res_anterior[0] if res_anterior[0] is not None else 0.00
-    except psycopg2.Error as e_get_ant:
-        logger.warning(f"No se pudo obtener stats del periodo anterior para {tipo_temporal} {usuario_id}: {e_get_ant}")
-
-    query_template = sql.SQL("""
-    INSERT INTO {tabla} (
-        usuario_id, {col_fecha_ref}, 
-        {col_resp}, {col_aciertos}, {col_errores}, 
-        {col_p_aciertos}, {col_p_errores},
-        {col_var_p_aciertos}
-    )
-    VALUES (%s, %s, 1, %s, %s, %s, %s, %s)
-    ON CONFLICT (usuario_id, {col_fecha_ref}) DO UPDATE SET
-        {col_resp} = {tabla}.{col_resp} + 1,
-        {col_aciertos} = {tabla}.{col_aciertos} + EXCLUDED.{col_aciertos},
-        {col_errores} = {tabla}.{col_errores} + EXCLUDED.{col_errores},
-        {col_p_aciertos} = ROUND((({tabla}.{col_aciertos} + EXCLUDED.{col_aciertos}) * 100.0) / ({tabla}.{col_resp} + 1), 2),
-        {col_p_errores} = ROUND((({tabla}.{col_errores} + EXCLUDED.{col_errores}) * 100.0) / ({tabla}.{col_resp} + 1), 2),
-        {col_var_p_aciertos} = ROUND((({tabla}.{col_aciertos} + EXCLUDED.{col_aciertos}) * 100.0) / ({tabla}.{col_resp} + 1), 2) - %s;
-    """)
-    
-    final_query = query_template.format(
-        tabla=sql.Identifier(tabla_stats), col_fecha_ref=sql.Identifier(col_fecha),
-        col_resp=sql.Identifier(resp_col), col_aciertos=sql.Identifier(aciertos_col), col_errores=sql.Identifier(errores_col),
-        col_p_aciertos=sql.Identifier(p_aciertos_col), col_p_errores=sql.Identifier(p_errores_col),
-        col_var_p_aciertos=sql.Identifier(var_p_aciertos_col)
-    )
-
-    acierto_val = 1 if es_correcta else 0
-    error_val = 1 if not es_correcta else 0
-    p_acierto_inicial = 100.0 if es_correcta else 0.0
-    p_error_inicial = 0.0 if es_correcta else 100.0
-    var_p_acierto_inicial = p_acierto_inicial - porc_aciertos_anterior_db
-    
-    try:
-        cursor.execute(final_query, (
-            usuario_id, fecha_periodo_actual.strftime('%Y-%m-%d'),
-            acierto_val, error_val,
-            p_acierto_inicial, p_error_inicial,
-            var_p_acierto_inicial,
-            porc_aciertos_anterior_db
-        ))
-    except psycopg2.Error as e_db:
-        logger.error(f"Error actualizando stats temporales ({tipo_temporal}) para {usuario_id}: {e_db}", exc_info=True)
-        raise
-
-def _procesar_estadisticas_respuesta_individual(
-    cursor, conn_db, usuario_id, pregunta_id, respuesta_seleccionada_original_ui, 
-    tiempo_respuesta_ms, fecha_respuesta_dt_obj, global_question_seq_num):
+    if intento_id is not None and not _reclamar_intento(cursor, intento_id, usuario_id):
+        logger.info(f"Intento {intento_id} ya procesado; envío duplicado ignorado.")
+        return 0
+
+    respuestas_parseadas = []
+    for resp_ui_data in respuestas_acumuladas_ui:
+        pregunta_id_raw = resp_ui_data.get('pregunta_id')
+        fecha_respuesta_str = resp_ui_data.get('fecha_respuesta')
+        if pregunta_id_raw is None or fecha_respuesta_str is None:
+            continue
+        try:
+            pregunta_id = int(pregunta_id_raw)
+            fecha_respuesta_dt_obj = dt.fromisoformat(fecha_respuesta_str)
+        except ValueError:
+            continue
+        respuestas_parseadas.append((pregunta_id, fecha_respuesta_dt_obj, resp_ui_data))
+
+    if not respuestas_parseadas:
+        return 0
+
+    datos_preguntas = _obtener_datos_preguntas(cursor, {p[0] for p in respuestas_parseadas})
+
+    respuestas = []
+    agregados_tema = defaultdict(lambda: [0, 0, 0, 0, 0])
+
+    for pregunta_id, fecha_respuesta, resp_ui_data in respuestas_parseadas:
+        respuesta_correcta_db, temas_ids = datos_preguntas.get(pregunta_id, (None, []))
+        if respuesta_correcta_db is None:
+            logger.warning(f"No se pudieron obtener detalles para P_ID {pregunta_id}. Saltando stats.")
+            continue
+
+        tiempo_respuesta_ms = resp_ui_data.get('tiempo_respuesta_ms')
+        respuesta_seleccionada_db, es_correcta, tiempo_para_suma = _evaluar_respuesta(
+            resp_ui_data.get('respuesta_usuario'), tiempo_respuesta_ms, respuesta_correcta_db
+        )
+        respuestas.append({
+            'pregunta_id': pregunta_id, 'respuesta_seleccionada_db': respuesta_seleccionada_db,
+            'es_correcta': es_correcta, 'tiempo_respuesta_ms': tiempo_respuesta_ms,
+            'fecha_respuesta': fecha_respuesta
+        })
+
+        incremento = (1, 1 if es_correcta else 0, 0 if es_correcta else 1, tiempo_para_suma, 1 if tiempo_para_suma > 0 else 0)
+        # Un tema repetido en pregunta_tema cuenta tantas veces como aparece (igual que el upsert por fila).
+        for tema_id, repeticiones in Counter(temas_ids).items():
+            for i, valor in enumerate(incremento):
+                agregados_tema[tema_id][i] += valor * repeticiones
+
+    if not respuestas:
+        return 0
+
+    # Lock compartido: el rollup lo toma en exclusiva para fijar su marca sin dejar inserciones a medias.
+    cursor.execute(rollup_stats.SQL_LOCK_ESCRITURA_COMPARTIDO)
+    _insertar_respuestas_y_detalle_temas(cursor, usuario_id, respuestas, intento_id)
+    _actualizar_stats_agregadas_usuario_tema(cursor, usuario_id, agregados_tema)
+
+    total_aciertos = sum(1 for r in respuestas if r['es_correcta'])
+    _actualizar_stats_agregadas_usuario_global(cursor, usuario_id, len(respuestas), total_aciertos, len(respuestas) - total_aciertos)
+
+    if intento_id is not None:
+        cursor.execute("UPDATE stats_intentos_procesados SET num_respuestas = %s WHERE intento_id = %s",
+                       (len(respuestas), intento_id))
+    return len(respuestas)
+
+def registrar_quiz_finalizado(usuario_id, respuestas_acumuladas_ui, intento_id=None):
     """
-    Orquesta todas las actualizaciones de estadísticas para una sola respuesta.
+    Procesa y confirma las estadísticas de un quiz en su propia transacción.
+    A diferencia de procesar_respuestas_del_quiz_finalizado, propaga los errores
+    (la cola de estadísticas decide si reintentar). Con intento_id es idempotente:
+    reenviar el mismo intento devuelve 0 sin tocar los agregados.
     """
-    pregunta_db_details = get_pregunta_detalle_por_id(conn_db, pregunta_id)
-    if not pregunta_db_details or pregunta_db_details.get('respuesta_correcta') is None:
-        logger.warning(f"No se pudieron obtener detalles para P_ID {pregunta_id}. Saltando stats.")
-        return False 
-
-    respuesta_correcta_db = pregunta_db_details.get('respuesta_correcta')
-    es_correcta = False
-    respuesta_seleccionada_db = 'TIMEOUT'
-
-    if respuesta_seleccionada_original_ui is not None and str(respuesta_seleccionada_original_ui).strip() != "":
-        respuesta_seleccionada_db = str(respuesta_seleccionada_original_ui).upper()
-        if respuesta_seleccionada_db in ('A', 'B', 'C', 'D'):
-            es_correcta = (respuesta_seleccionada_db == str(respuesta_correcta_db).upper())
-
-    tiempo_efectivo_para_promedios = tiempo_respuesta_ms
-    if respuesta_seleccionada_db == 'TIMEOUT':
-        tiempo_efectivo_para_promedios = None 
-
-    respuesta_id = _registrar_respuesta_usuario_y_stats_pregunta(
-        cursor, usuario_id, pregunta_id, respuesta_seleccionada_db,
-        es_correcta, tiempo_respuesta_ms, fecha_respuesta_dt_obj
-    )
-    if respuesta_id is None: return False
-
-    temas_ids = get_temas_directos_pregunta(conn_db, pregunta_id)
-    _registrar_respuesta_tema_detalle(cursor, respuesta_id, pregunta_id, es_correcta, conn_db)
-
-    _actualizar_stats_agregadas_usuario_tema(
-        cursor, usuario_id, temas_ids, es_correcta, 
-        respuesta_seleccionada_db, tiempo_efectivo_para_promedios
-    )
-    _actualizar_stats_agregadas_usuario_global(cursor, usuario_id, es_correcta)
-    
-    for tipo_temp in ['diario', 'semanal', 'mensual']:
-        _actualizar_estadisticas_temporales(cursor, usuario_id, es_correcta, fecha_respuesta_dt_obj, tipo_temp)
-
-    return True
+    if not respuestas_acumuladas_ui:
+        return 0
+    # La conexión vuelve al pool al salir del bloque; si no se llegó al COMMIT, se hace ROLLBACK.
+    with conexion_db() as conn:
+        _asegurar_esquema_intentos(conn)
+        rollup_stats.asegurar_esquema(conn)
+        with conn.cursor() as cursor:
+            num_registradas = procesar_lote_respuestas(cursor, usuario_id, respuestas_acumuladas_ui, intento_id)
+        conn.commit()
+    # stats_agregadas_usuario_tema acaba de cambiar: el próximo Adaptativo debe contar este quiz.
+    invalidar_perfil_usuario(usuario_id)
+    logger.info(f"COMMIT REALIZADO. Estadísticas del quiz procesadas ({num_registradas} respuestas).")
+    return num_registradas
 
-def procesar_respuestas_del_quiz_finalizado(usuario_id, respuestas_acumuladas_ui):
+def procesar_respuestas_del_quiz_finalizado(usuario_id, respuestas_acumuladas_ui, intento_id=None):
     logger.info(f"INICIO PROCESAMIENTO QUIZ para Usuario ID: {usuario_id}, {len(respuestas_acumuladas_ui)} respuestas.")
     if not respuestas_acumuladas_ui:
         logger.info("No hay respuestas para procesar.")
         return
-        
-    conn = None
-    try:
-        conn = conectar_db()
-        
-        global_question_count_before_quiz = obtener_total_respuestas_previas_usuario(conn, usuario_id)
-        
-        current_global_question_seq_num = global_question_count_before_quiz
-
-        with conn.cursor() as cursor:
-            for idx, resp_ui_data in enumerate(respuestas_acumuladas_ui):
-                pregunta_id_raw = resp_ui_data.get('pregunta_id')
-                fecha_respuesta_str = resp_ui_data.get('fecha_respuesta')
 
-                if pregunta_id_raw is None or fecha_respuesta_str is None:
-                    continue
-                try:
-                    pregunta_id = int(pregunta_id_raw)
-                    fecha_respuesta_dt_obj = dt.fromisoformat(fecha_respuesta_str)
-                except ValueError:
-                    continue
-
-                current_global_question_seq_num += 1
-                
-                _procesar_estadisticas_respuesta_individual(
-                    cursor, conn, usuario_id, pregunta_id, 
-                    resp_ui_data.get('respuesta_usuario'), resp_ui_data.get('tiempo_respuesta_ms'), fecha_respuesta_dt_obj,
-                    current_global_question_seq_num
-                )
-
-        conn.commit()
-        logger.info("COMMIT REALIZADO. Estadísticas del quiz procesadas.")
+    try:
+        registrar_quiz_finalizado(usuario_id, respuestas_acumuladas_ui, intento_id)
 
     except (DatabaseConnectionError, psycopg2.Error) as e_db_main:
-        logger.critical(f"ERROR DE BD CRÍTICO durante procesamiento del quiz: {e_db_main}", exc_info=True)
-        if conn:
-            try: conn.rollback(); logger.info("ROLLBACK realizado.")
-            except Exception as e_rb: logger.error(f"Error durante ROLLBACK: {e_rb}", exc_info=True)
+        logger.critical(f"ERROR DE BD CRÍTICO durante procesamiento del quiz (ROLLBACK): {e_db_main}", exc_info=True)
     except Exception as e_main:
-        logger.critical(f"ERROR GENERAL CRÍTICO durante procesamiento del quiz: {e_main}", exc_info=True)
-        if conn:
-            try: conn.rollback(); logger.info("ROLLBACK realizado.")
-            except Exception as e_rb: logger.error(f"Error durante ROLLBACK: {e_rb}", exc_info=True)
-    finally:
-        if conn:
-            try: 
-                conn.close()
-                logger.info("Conexión a BD cerrada.")
-            except Exception as e_cl: logger.error(f"Error al cerrar conexión: {e_cl}", exc_info=True)
+        logger.critical(f"ERROR GENERAL CRÍTICO durante procesamiento del quiz (ROLLBACK): {e_main}", exc_info=True)
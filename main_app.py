@@ -27,7 +27,6 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 # --- Importaciones de tus nuevos módulos ---
-from core.db_quiz_loader import conectar_db, obtener_temas_disponibles
 from ui.styles import CSS_STRING
 from core import auth_handler
 from utils.helpers import COMUNIDAD_MAP, ESPECIALIDAD_MAP, get_key_from_value
@@ -38,6 +37,7 @@ from ui.quiz_session_page import display_quiz_session_section
 from ui.results_page import display_results_section
 # MODIFICACIÓN: Cambiar el nombre de la función importada para reflejar su nueva ubicación
 from ui.chat_RAG import display_rag_chat_section
+from core.examenes_oficiales import calentar_examenes_oficiales
 
 # --- INICIO: Carga de Variables de Entorno ---
 print("DEBUG MAIN_APP: Script main_app.py iniciado.")
@@ -47,6 +47,9 @@ dotenv_path = os.path.join(script_dir, '.env')
 load_dotenv(dotenv_path=dotenv_path, override=True, verbose=True)
 # --- FIN: Carga de Variables de Entorno ---
 
+# Precarga en segundo plano (una vez por proceso) de la caché de exámenes oficiales.
+calentar_examenes_oficiales()
+
 # --- Configuración Inicial de Página Streamlit ---
 st.set_page_config(layout="centered", page_title="MENTORA")
 
@@ -184,26 +187,6 @@ else: # --- Usuario SÍ Autenticado ---
 
     # --- PESTAÑA 1: CUESTIONARIOS ---
     with tab_cuestionarios:
-        if 'temas_disponibles_lista' not in st.session_state:
-            print("DEBUG MAIN_APP (AUTH): Cargando temas disponibles para usuario autenticado...")
-            conn_temp_auth = None
-            try:
-                conn_temp_auth = conectar_db()
-                if conn_temp_auth:
-                    especialidad_actual = st.session_state.user_info.get('especialidad')
-                    st.session_state.temas_disponibles_lista = obtener_temas_disponibles(conn_temp_auth, especialidad_actual)
-                    if not st.session_state.temas_disponibles_lista:
-                        st.warning("No se encontraron temas disponibles para esta especialidad.")
-                else:
-                    st.error("No se pudo conectar a la base de datos para cargar temas (AUTH).")
-                    st.session_state.temas_disponibles_lista = []
-            except Exception as e_auth:
-                st.error(f"Error al cargar temas disponibles (AUTH): {e_auth}")
-                st.session_state.temas_disponibles_lista = []
-            finally:
-                if conn_temp_auth:
-                    conn_temp_auth.close()
-
         # --- Enrutador de Vistas ---
         if st.session_state.estado_app in ['seleccion_modo', 'configuracion_libre', 'configuracion_oficial']:
             display_config_section() 
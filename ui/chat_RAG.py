@@ -3,20 +3,23 @@
 # MODIFICACIÓN: Refactorizado para un flujo de estado robusto y correcto.
 # ==============================================================================
 import streamlit as st
-import psycopg2
-import psycopg2.extras
-import json
 import logging
 import os
 from dotenv import load_dotenv
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 from openai import OpenAI
 
+from core.database import conectar_db, conexion_db, DatabaseConnectionError
+from core.indice_rag import recuperar_chunks
+from core.cache_embeddings import obtener_embedding_cacheado
+from core.cache_respuestas_rag import obtener_cache_respuestas, reproducir_respuesta
+
 # --- 1. Configuración y Parámetros ---
 logger = logging.getLogger(__name__)
 load_dotenv()
 TOP_K_CHUNKS_FOR_RAG = 10
+MENSAJE_ERROR_CHAT = "Lo siento, ha ocurrido un error al generar la respuesta."
+EMBEDDING_MODEL = "text-embedding-3-small"
 
 # --- Configuración de Clientes de API ---
 try:
@@ -47,50 +50,43 @@ PREGUNTA DEL USUARIO:
 
 # --- Funciones de BD y Lógica RAG ---
 def get_db_connection():
-    """Establece y devuelve una conexión a la base de datos PostgreSQL."""
+    """Devuelve una conexión del pool compartido (conn.close() la devuelve al pool)."""
     try:
-        conn = psycopg2.connect(
-            host=os.environ.get('DB_HOST'), port=os.environ.get('DB_PORT'),
-            dbname=os.environ.get('DB_NAME'), user=os.environ.get('DB_USER'),
-            password=os.environ.get('DB_PASSWORD'),
-            cursor_factory=psycopg2.extras.DictCursor
-        )
-        return conn
-    except Exception as e:
+        return conectar_db()
+    except DatabaseConnectionError as e:
         logger.error(f"No se pudo conectar a la base de datos en el chat RAG: {e}", exc_info=True)
         return None
 
+def _calcular_embedding(question_text):
+    response = openai_client.embeddings.create(input=[question_text], model=EMBEDDING_MODEL)
+    return np.array(response.data[0].embedding, dtype=np.float32)
+
 def get_question_embedding(question_text):
-    """Genera un embedding para la pregunta del usuario."""
+    """Genera un embedding para la pregunta del usuario (o lo recupera de la caché si ya se preguntó)."""
     try:
-        response = openai_client.embeddings.create(input=[question_text], model="text-embedding-3-small")
-        return np.array(response.data[0].embedding)
+        return obtener_embedding_cacheado(question_text, EMBEDDING_MODEL, _calcular_embedding)
     except Exception as e:
         logger.error(f"Error al generar embedding para la pregunta: {e}")
         return None
 
-def find_relevant_chunks(conn, question_embedding, top_k):
-    """Encuentra los chunks más relevantes en la base de datos."""
+def retrieve_chunks(conn, question_embedding, top_k):
+    """
+    Recupera los chunks más relevantes usando el índice vectorial del proceso (core/indice_rag.py).
+    Devuelve (version_corpus, chunk_ids, contexto); contexto es "" si no hay nada relevante.
+    """
     if question_embedding is None:
-        return ""
+        return None, [], ""
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT chunk_text, embedding FROM manual_chunks")
-            all_chunks = cursor.fetchall()
-        
-        if not all_chunks:
-            return ""
-
-        chunk_vectors = np.array([json.loads(chunk['embedding']) for chunk in all_chunks])
-        similarities = cosine_similarity(question_embedding.reshape(1, -1), chunk_vectors)[0]
-        top_k_indices = np.argsort(similarities)[-top_k:][::-1]
-        
-        relevant_texts = [all_chunks[i]['chunk_text'] for i in top_k_indices]
-        return "\n---\n".join(relevant_texts)
+        version, chunks = recuperar_chunks(conn, question_embedding, top_k)
+        return version, [chunk_id for chunk_id, _ in chunks], "\n---\n".join(texto for _, texto in chunks)
         
     except Exception as e:
         logger.error(f"Error al buscar chunks relevantes: {e}", exc_info=True)
-        return ""
+        return None, [], ""
+
+def find_relevant_chunks(conn, question_embedding, top_k):
+    """Encuentra los chunks más relevantes y devuelve su texto concatenado."""
+    return retrieve_chunks(conn, question_embedding, top_k)[2]
 
 def stream_deepseek_response(question, context):
     """Llama a la API de DeepSeek y devuelve la respuesta en streaming."""
@@ -109,7 +105,7 @@ def stream_deepseek_response(question, context):
                 yield chunk.choices[0].delta.content
     except Exception as e:
         logger.error(f"Error en la llamada a la API de chat de DeepSeek: {e}")
-        yield "Lo siento, ha ocurrido un error al generar la respuesta."
+        yield MENSAJE_ERROR_CHAT
 
 # --- Función Principal de la Interfaz de Usuario ---
 def display_rag_chat_section():
@@ -148,21 +144,32 @@ def display_rag_chat_section():
         # Mantenemos avatar=None también aquí
         with st.chat_message("assistant", avatar=None):
             with st.spinner("Buscando en el Manual de Medicina de Laboratorio..."):
-                conn = get_db_connection()
-                if not conn:
+                context = None
+                cached_answer = None
+                try:
+                    question_embedding = get_question_embedding(last_prompt)
+                    with conexion_db() as conn:
+                        corpus_version, chunk_ids, context = retrieve_chunks(conn, question_embedding, TOP_K_CHUNKS_FOR_RAG)
+                        if context:
+                            cached_answer = obtener_cache_respuestas().buscar(conn, corpus_version, question_embedding, chunk_ids)
+                except DatabaseConnectionError as e:
+                    logger.error(f"No se pudo conectar a la base de datos en el chat RAG: {e}", exc_info=True)
+
+                if context is None:
                     full_response = "Error de conexión a la base de datos."
                     st.error(full_response)
                 else:
-                    question_embedding = get_question_embedding(last_prompt)
-                    context = find_relevant_chunks(conn, question_embedding, TOP_K_CHUNKS_FOR_RAG)
-                    conn.close()
-                    
                     if not context:
                         full_response = "No he encontrado información relevante en el manual para tu pregunta."
                         st.markdown(full_response)
+                    elif cached_answer is not None:
+                        # Misma pregunta (semánticamente) y mismos chunks: se reproduce la respuesta guardada.
+                        full_response = st.write_stream(reproducir_respuesta(cached_answer))
                     else:
                         response_generator = stream_deepseek_response(last_prompt, context)
                         full_response = st.write_stream(response_generator)
+                        if isinstance(full_response, str) and full_response and MENSAJE_ERROR_CHAT not in full_response:
+                            obtener_cache_respuestas().guardar(corpus_version, question_embedding, chunk_ids, full_response)
             
         # Añadir la respuesta completa del asistente al historial
         st.session_state.rag_messages.append({"role": "assistant", "content": full_response})
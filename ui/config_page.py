@@ -4,15 +4,15 @@ import logging
 
 # MODIFICACIÓN: Actualizar las importaciones para apuntar a los nuevos scripts.
 from core.db_quiz_loader import (
-    conectar_db,
-    obtener_examenes_disponibles,
-    format_topics_for_tree
-)
-from core.db_quiz_handler import (
-    obtener_preguntas_para_cuestionario,
-    obtener_datos_examen,
-    obtener_texto_escenario
+    conexion_db,
+    DatabaseConnectionError
 )
+from core.db_quiz_handler import construir_cuestionario
+from core.pool_cuestionarios import obtener_pool_cuestionarios, tomar_cuestionario_aleatorio
+from core.examenes_oficiales import obtener_catalogo_examenes, obtener_examen_oficial
+from core.catalogo_temas import obtener_catalogo_temas, CatalogoTemas
+from core.stats_handler import nuevo_intento_id
+from core.repaso import contar_repasos_pendientes
 from utils.helpers import _remove_empty_children_recursive
 
 try:
@@ -30,6 +30,24 @@ except Exception as e:
 
 logger = logging.getLogger(__name__)
 
+
+def _catalogo_temas():
+    # Se lee en cada uso (no se guarda en la sesión): así las sesiones largas ven el catálogo tras una recarga.
+    especialidad = st.session_state.user_info.get('especialidad')
+    try:
+        return obtener_catalogo_temas(especialidad)
+    except DatabaseConnectionError:
+        st.error("No se pudo conectar a la base de datos para cargar temas.")
+    except Exception as e:
+        logger.error(f"Error al cargar el catálogo de temas: {e}", exc_info=True)
+        st.error(f"Error al cargar temas disponibles: {e}")
+    return CatalogoTemas([], None)
+
+
+def _temas_disponibles():
+    # Tupla compartida por todas las sesiones (core/catalogo_temas.py): solo lectura.
+    return _catalogo_temas().temas
+
 def display_config_section():
         
     st.header("Configura tu cuestionario")
@@ -55,7 +73,7 @@ def display_config_section():
     if st.session_state.modo_seleccionado is not None:
         if st.session_state.modo_seleccionado == "Entrenamiento Libre":
             st.subheader("Modo Entrenamiento Libre")
-            submodo_options = ["Aleatorio", "Personalizado"]
+            submodo_options = ["Aleatorio", "Adaptativo", "Repaso", "Personalizado"]
             cols_submodo = st.columns(len(submodo_options))
             for i, sub_opt in enumerate(submodo_options):
                 with cols_submodo[i]:
@@ -69,50 +87,145 @@ def display_config_section():
             config_actual = {}
             if st.session_state.entrenamiento_libre_submodo == "Aleatorio":
                 st.markdown("<br>", unsafe_allow_html=True)
-                config_actual = {"modo": "Libre-Aleatorio", "numero_preguntas": st.session_state.get("config_num_preg_aleatorio", 20)}
+                config_actual = {"modo": "Libre-Aleatorio", "numero_preguntas": st.session_state.get("config_num_preg_aleatorio", 20), "usuario_id": st.session_state.user_info.get('id')}
+                obtener_pool_cuestionarios()  # arranca la reserva en segundo plano mientras se muestra la página
 
                 if st.button("🚀 Comenzar", key="start_button_aleatorio", use_container_width=True):
                     logger.info(f"Botón Empezar (Aleatorio) pulsado. Config: {config_actual}")
                     with st.spinner("Preparando tu cuestionario..."):
-                        conn_quiz = None
                         try:
-                            conn_quiz = conectar_db()
-                            if conn_quiz:
-                                temas_para_funcion = st.session_state.get('temas_disponibles_lista', [])
+                            with conexion_db() as conn_quiz:
+                                temas_para_funcion = _temas_disponibles()
                                 especialidad_usuario = st.session_state.user_info.get('especialidad')
                                 
-                                preguntas_seleccionadas_raw = obtener_preguntas_para_cuestionario(conn_quiz, config_actual, temas_para_funcion, especialidad_usuario)
+                                # Primero un cuestionario ya preparado de la reserva; si no hay, se construye al momento.
+                                preguntas_seleccionadas_raw = tomar_cuestionario_aleatorio(conn_quiz, especialidad_usuario, config_actual['usuario_id'])
+                                if preguntas_seleccionadas_raw is None:
+                                    preguntas_seleccionadas_raw = construir_cuestionario(conn_quiz, config_actual, temas_para_funcion, especialidad_usuario)
                                 
                                 if preguntas_seleccionadas_raw:
-                                    logger.info(f"Enriqueciendo {len(preguntas_seleccionadas_raw)} preguntas para modo Aleatorio...")
-                                    enriched_preguntas = []
-                                    for preg_dict in preguntas_seleccionadas_raw:
-                                        enriched_preg = preg_dict.copy()
-                                        examen_id = preg_dict.get('examen_oficial_id')
-                                        escenario_id = preg_dict.get('escenario_id')
-                                        if examen_id:
-                                            enriched_preg['datos_examen_completos'] = obtener_datos_examen(conn_quiz, examen_id)
-                                        if escenario_id:
-                                            enriched_preg['texto_escenario_completo'] = obtener_texto_escenario(conn_quiz, escenario_id)
-                                        enriched_preguntas.append(enriched_preg)
-                                    st.session_state.cuestionario_actual = enriched_preguntas
+                                    st.session_state.cuestionario_actual = preguntas_seleccionadas_raw
                                     
                                     st.session_state.pregunta_actual_idx = 0
                                     st.session_state.respuestas_usuario = {}
+                                    st.session_state.intento_id = nuevo_intento_id()
                                     st.session_state.estado_app = 'cuestionario'
                                     logger.info("Cambiando a estado 'cuestionario' (Aleatorio).")
                                     st.rerun()
                                 else:
                                     st.warning("No se encontraron preguntas para el modo Aleatorio con los criterios actuales.")
-                            else:
-                                st.error("Error de conexión. No se pudo iniciar el cuestionario.")
+                        except DatabaseConnectionError:
+                            st.error("Error de conexión. No se pudo iniciar el cuestionario.")
                         except Exception as e:
                             logger.error(f"Error al iniciar cuestionario Aleatorio: {e}", exc_info=True)
                             st.error("Ocurrió un error al preparar el cuestionario.")
-                        finally:
-                            if conn_quiz:
-                                conn_quiz.close()
-                                logger.debug("Conexión (Aleatorio) cerrada.")
+
+            elif st.session_state.entrenamiento_libre_submodo == "Adaptativo":
+                st.markdown("")
+                st.caption("Prioriza los temas en los que más fallas y los que llevas más tiempo sin practicar.")
+                st.markdown("Número de preguntas")
+                opciones_num_preguntas = [20, 50, 100]
+                if st.session_state.get('config_num_preguntas', 20) not in opciones_num_preguntas:
+                    st.session_state.config_num_preguntas = 20
+                cols_num_adaptativo = st.columns(len(opciones_num_preguntas))
+                for i, num_opt in enumerate(opciones_num_preguntas):
+                    with cols_num_adaptativo[i]:
+                        is_selected = (st.session_state.config_num_preguntas == num_opt)
+                        if st.button(label=str(num_opt), key=f"btn_num_adaptativo_{num_opt}", use_container_width=True, type=('primary' if is_selected else 'secondary')):
+                            if not is_selected: st.session_state.config_num_preguntas = num_opt; st.rerun()
+
+                st.markdown("<br>", unsafe_allow_html=True)
+                config_actual = {
+                    "modo": "Libre-Adaptativo",
+                    "numero_preguntas": st.session_state.config_num_preguntas,
+                    "usuario_id": st.session_state.user_info.get('id'),
+                }
+
+                if st.button("🚀 Comenzar", key="start_button_adaptativo", use_container_width=True):
+                    logger.info(f"Botón Empezar (Adaptativo) pulsado. Config: {config_actual}")
+                    with st.spinner("Preparando tu cuestionario..."):
+                        try:
+                            with conexion_db() as conn_quiz:
+                                temas_para_funcion = _temas_disponibles()
+                                especialidad_usuario = st.session_state.user_info.get('especialidad')
+
+                                preguntas_seleccionadas_raw = construir_cuestionario(conn_quiz, config_actual, temas_para_funcion, especialidad_usuario)
+
+                                if preguntas_seleccionadas_raw:
+                                    st.session_state.cuestionario_actual = preguntas_seleccionadas_raw
+
+                                    st.session_state.pregunta_actual_idx = 0
+                                    st.session_state.respuestas_usuario = {}
+                                    st.session_state.intento_id = nuevo_intento_id()
+                                    st.session_state.estado_app = 'cuestionario'
+                                    logger.info("Cambiando a estado 'cuestionario' (Adaptativo).")
+                                    st.rerun()
+                                else:
+                                    st.warning("No se encontraron preguntas para el modo Adaptativo.")
+                        except DatabaseConnectionError:
+                            st.error("Error de conexión. No se pudo iniciar el cuestionario.")
+                        except Exception as e:
+                            logger.error(f"Error al iniciar cuestionario Adaptativo: {e}", exc_info=True)
+                            st.error("Ocurrió un error al preparar el cuestionario.")
+
+            elif st.session_state.entrenamiento_libre_submodo == "Repaso":
+                st.markdown("")
+                usuario_id_repaso = st.session_state.user_info.get('id')
+                try:
+                    with conexion_db() as conn_repaso:
+                        pendientes_repaso = contar_repasos_pendientes(conn_repaso, usuario_id_repaso)
+                except DatabaseConnectionError:
+                    pendientes_repaso = None
+                    st.error("Error de conexión. No se pudieron consultar tus repasos.")
+
+                if pendientes_repaso == 0:
+                    st.info("No tienes preguntas pendientes de repaso. ¡Vuelve más tarde!")
+                elif pendientes_repaso:
+                    st.caption(f"Tienes {pendientes_repaso} preguntas pendientes de repaso. Se muestran primero las que más tiempo llevan vencidas.")
+                    st.markdown("Número de preguntas")
+                    opciones_num_preguntas = [20, 50, 100]
+                    if st.session_state.get('config_num_preguntas', 20) not in opciones_num_preguntas:
+                        st.session_state.config_num_preguntas = 20
+                    cols_num_repaso = st.columns(len(opciones_num_preguntas))
+                    for i, num_opt in enumerate(opciones_num_preguntas):
+                        with cols_num_repaso[i]:
+                            is_selected = (st.session_state.config_num_preguntas == num_opt)
+                            if st.button(label=str(num_opt), key=f"btn_num_repaso_{num_opt}", use_container_width=True, type=('primary' if is_selected else 'secondary')):
+                                if not is_selected: st.session_state.config_num_preguntas = num_opt; st.rerun()
+
+                    st.markdown("<br>", unsafe_allow_html=True)
+                    config_actual = {
+                        "modo": "Libre-Repaso",
+                        "numero_preguntas": st.session_state.config_num_preguntas,
+                        "usuario_id": usuario_id_repaso,
+                    }
+
+                    if st.button("🚀 Comenzar", key="start_button_repaso", use_container_width=True):
+                        logger.info(f"Botón Empezar (Repaso) pulsado. Config: {config_actual}")
+                        with st.spinner("Preparando tu cuestionario..."):
+                            try:
+                                with conexion_db() as conn_quiz:
+                                    temas_para_funcion = _temas_disponibles()
+                                    especialidad_usuario = st.session_state.user_info.get('especialidad')
+
+                                    preguntas_seleccionadas_raw = construir_cuestionario(conn_quiz, config_actual, temas_para_funcion, especialidad_usuario)
+
+                                    if preguntas_seleccionadas_raw:
+                                        st.session_state.cuestionario_actual = preguntas_seleccionadas_raw
+
+                                        st.session_state.pregunta_actual_idx = 0
+                                        st.session_state.respuestas_usuario = {}
+                                        st.session_state.intento_id = nuevo_intento_id()
+                                        st.session_state.estado_app = 'cuestionario'
+                                        logger.info("Cambiando a estado 'cuestionario' (Repaso).")
+                                        st.rerun()
+                                    else:
+                                        st.warning("No se encontraron preguntas pendientes de repaso.")
+                            except DatabaseConnectionError:
+                                st.error("Error de conexión. No se pudo iniciar el cuestionario.")
+                            except Exception as e:
+                                logger.error(f"Error al iniciar cuestionario Repaso: {e}", exc_info=True)
+                                st.error("Ocurrió un error al preparar el cuestionario.")
 
             elif st.session_state.entrenamiento_libre_submodo == "Personalizado":
                 st.markdown("")
@@ -138,14 +251,23 @@ def display_config_section():
                         if st.button(label=tipo_opt, key=f"btn_tipo_{tipo_opt}", use_container_width=True, type=('primary' if is_selected else 'secondary')):
                             if not is_selected: st.session_state.config_tipo_pregunta = tipo_opt; st.rerun()
                     config_tipo_pregunta_actual = st.session_state.config_tipo_pregunta
+                    config_proporcion_teoricas_actual = None
+                    if config_tipo_pregunta_actual == "Ambas":
+                        opciones_proporcion = {"Auto": None, "25 % teóricas": 0.25, "50 % teóricas": 0.5, "75 % teóricas": 0.75}
+                        etiqueta_proporcion = st.select_slider(
+                            "Proporción", options=list(opciones_proporcion), key="config_proporcion_teoricas",
+                            help="Auto mantiene la mezcla del banco; el resto fija cuántas teóricas completan el cuestionario.",
+                        )
+                        config_proporcion_teoricas_actual = opciones_proporcion[etiqueta_proporcion]
                 
                 st.markdown("Contenidos")
                 if 'tree_select_key_suffix' not in st.session_state:
                     st.session_state.tree_select_key_suffix = 0
 
                 if st.button("Marcar todo", key="btn_toggle_all_temas", help="Marca o desmarca TODOS los temas disponibles"):
-                    if st.session_state.get('temas_disponibles_lista'):
-                        all_theme_ids = [t['id'] for t in st.session_state.temas_disponibles_lista]
+                    temas_disponibles = _temas_disponibles()
+                    if temas_disponibles:
+                        all_theme_ids = [t['id'] for t in temas_disponibles]
                         current_selection_set = set(st.session_state.get('config_temas_seleccionados', []))
                         all_theme_ids_set = set(all_theme_ids)
                         if current_selection_set == all_theme_ids_set: 
@@ -158,8 +280,9 @@ def display_config_section():
                         st.warning("No hay temas disponibles para marcar/desmarcar.")
                 st.write("")
 
-                if tree_select and st.session_state.get('temas_disponibles_lista'):
-                    nodos_arbol = format_topics_for_tree(st.session_state.temas_disponibles_lista)
+                catalogo = _catalogo_temas()
+                if tree_select and catalogo.temas:
+                    nodos_arbol = catalogo.arbol
                     if nodos_arbol:
                         dynamic_tree_key = f"tema_tree_select_{st.session_state.tree_select_key_suffix}"
                         seleccion_arbol = tree_select(
@@ -190,7 +313,9 @@ def display_config_section():
                     "modo": "Libre-Personalizado", 
                     "numero_preguntas": config_num_preguntas_actual, 
                     "tipo_pregunta": config_tipo_pregunta_actual, 
-                    "temas_codigos": st.session_state.get('config_temas_seleccionados', [])
+                    "temas_codigos": st.session_state.get('config_temas_seleccionados', []),
+                    "proporcion_teoricas": config_proporcion_teoricas_actual,
+                    "usuario_id": st.session_state.user_info.get('id'),
                 }
                 
                 if st.button("🚀 Comenzar", key="start_button_personalizado", use_container_width=True):
@@ -199,66 +324,46 @@ def display_config_section():
                     else:
                         logger.info(f"Botón Empezar (Personalizado) pulsado. Config: {config_actual}")
                         with st.spinner("Preparando tu cuestionario..."):
-                            conn_quiz = None
                             try:
-                                conn_quiz = conectar_db()
-                                if conn_quiz:
-                                    temas_para_funcion = st.session_state.get('temas_disponibles_lista', [])
+                                with conexion_db() as conn_quiz:
+                                    temas_para_funcion = _temas_disponibles()
                                     especialidad_usuario = st.session_state.user_info.get('especialidad')
                                     
-                                    preguntas_seleccionadas_raw = obtener_preguntas_para_cuestionario(conn_quiz, config_actual, temas_para_funcion, especialidad_usuario)
+                                    preguntas_seleccionadas_raw = construir_cuestionario(conn_quiz, config_actual, temas_para_funcion, especialidad_usuario)
                                     
                                     if preguntas_seleccionadas_raw:
-                                        logger.info(f"Enriqueciendo {len(preguntas_seleccionadas_raw)} preguntas para modo Personalizado...")
-                                        enriched_preguntas = []
-                                        for preg_dict in preguntas_seleccionadas_raw:
-                                            enriched_preg = preg_dict.copy()
-                                            examen_id = preg_dict.get('examen_oficial_id')
-                                            escenario_id = preg_dict.get('escenario_id')
-                                            if examen_id:
-                                                enriched_preg['datos_examen_completos'] = obtener_datos_examen(conn_quiz, examen_id)
-                                            if escenario_id:
-                                                enriched_preg['texto_escenario_completo'] = obtener_texto_escenario(conn_quiz, escenario_id)
-                                            enriched_preguntas.append(enriched_preg)
-                                        st.session_state.cuestionario_actual = enriched_preguntas
+                                        st.session_state.cuestionario_actual = preguntas_seleccionadas_raw
 
                                         st.session_state.pregunta_actual_idx = 0
                                         st.session_state.respuestas_usuario = {}
+                                        st.session_state.intento_id = nuevo_intento_id()
                                         st.session_state.estado_app = 'cuestionario'
                                         logger.info("Cambiando al estado 'cuestionario' (Personalizado).")
                                         st.rerun()
                                     else:
                                         st.warning("No se encontraron preguntas que cumplan los criterios seleccionados.")
-                                else:
-                                    st.error("Error de conexión. No se pudo iniciar el cuestionario.")
+                            except DatabaseConnectionError:
+                                st.error("Error de conexión. No se pudo iniciar el cuestionario.")
                             except Exception as e:
                                 logger.error(f"Error al iniciar cuestionario Personalizado: {e}", exc_info=True)
                                 st.error("Ocurrió un error al preparar el cuestionario.")
-                            finally:
-                                if conn_quiz:
-                                    conn_quiz.close()
-                                    logger.debug("Conexión (Personalizado) cerrada.")
 
         elif st.session_state.modo_seleccionado == "Simular Examen Oficial":
             st.subheader("Modo Examen Oficial")
-            conn_exam_meta = None
+            conexion_ok = False
             try:
-                conn_exam_meta = conectar_db()
-                if conn_exam_meta:
-                    lista_examenes = obtener_examenes_disponibles(conn_exam_meta)
-                else:
-                    lista_examenes = []
-                    st.error("Error de conexión. No se pueden cargar los exámenes.")
+                # Catálogo cacheado en el proceso: los reruns de los selectbox no consultan la BD.
+                lista_examenes = obtener_catalogo_examenes()
+                conexion_ok = True
+            except DatabaseConnectionError:
+                lista_examenes = []
+                st.error("Error de conexión. No se pueden cargar los exámenes.")
             except Exception as e_meta:
                 logger.error(f"Error obteniendo lista de exámenes: {e_meta}", exc_info=True)
                 lista_examenes = []
                 st.error("Error al cargar la lista de exámenes.")
-            finally:
-                if conn_exam_meta:
-                    conn_exam_meta.close()
-                    logger.debug("Conexión para metadatos de examen cerrada.")
 
-            if not lista_examenes and conn_exam_meta :
+            if not lista_examenes and conexion_ok :
                 st.info("No hay exámenes oficiales disponibles en este momento.")
             elif lista_examenes :
                 opciones_esp = sorted(list(set(ex['especialidad'] for ex in lista_examenes)))
@@ -281,38 +386,28 @@ def display_config_section():
                         config_actual = {"modo": "Oficial", "ano": st.session_state.config_examen_ano, "ca": st.session_state.config_examen_ca, "esp": st.session_state.config_examen_esp}
                         logger.info(f"Botón Empezar (Oficial) pulsado. Config: {config_actual}")
                         with st.spinner("Cargando examen..."):
-                            conn_quiz = None
                             try:
-                                conn_quiz = conectar_db()
-                                if conn_quiz:
-                                    preguntas_seleccionadas_raw = obtener_preguntas_para_cuestionario(conn_quiz, config_actual, especialidad_usuario=st.session_state.user_info.get('especialidad')) 
+                                # El examen sale de la caché del proceso sin tocar la BD; solo si no está se consulta.
+                                preguntas_seleccionadas_raw = obtener_examen_oficial(config_actual['ano'], config_actual['ca'], config_actual['esp'])
+                                if not preguntas_seleccionadas_raw:
+                                    with conexion_db() as conn_quiz:
+                                        preguntas_seleccionadas_raw = construir_cuestionario(conn_quiz, config_actual, especialidad_usuario=st.session_state.user_info.get('especialidad')) 
+                                
+                                if preguntas_seleccionadas_raw:
+                                    st.session_state.cuestionario_actual = preguntas_seleccionadas_raw
                                     
-                                    if preguntas_seleccionadas_raw:
-                                        logger.info(f"Enriqueciendo {len(preguntas_seleccionadas_raw)} preguntas para modo Oficial...")
-                                        enriched_preguntas = []
-                                        for preg_dict in preguntas_seleccionadas_raw:
-                                            enriched_preg = preg_dict.copy()
-                                            escenario_id = preg_dict.get('escenario_id')
-                                            if escenario_id:
-                                                enriched_preg['texto_escenario_completo'] = obtener_texto_escenario(conn_quiz, escenario_id)
-                                            enriched_preguntas.append(enriched_preg)
-                                        st.session_state.cuestionario_actual = enriched_preguntas
-                                        
-                                        st.session_state.pregunta_actual_idx = 0
-                                        st.session_state.respuestas_usuario = {}
-                                        st.session_state.estado_app = 'cuestionario'
-                                        logger.info("Cambiando al estado 'cuestionario' (Oficial).")
-                                        st.rerun()
-                                    else:
-                                        st.warning("No se encontraron preguntas para el examen oficial seleccionado.")
+                                    st.session_state.pregunta_actual_idx = 0
+                                    st.session_state.respuestas_usuario = {}
+                                    st.session_state.intento_id = nuevo_intento_id()
+                                    st.session_state.estado_app = 'cuestionario'
+                                    logger.info("Cambiando al estado 'cuestionario' (Oficial).")
+                                    st.rerun()
                                 else:
-                                    st.error("Error de conexión. No se pudo iniciar el cuestionario.")
+                                    st.warning("No se encontraron preguntas para el examen oficial seleccionado.")
+                            except DatabaseConnectionError:
+                                st.error("Error de conexión. No se pudo iniciar el cuestionario.")
                             except Exception as e:
                                 logger.error(f"Error al iniciar cuestionario Oficial: {e}", exc_info=True)
                                 st.error("Ocurrió un error al preparar el cuestionario.")
-                            finally:
-                                if conn_quiz:
-                                    conn_quiz.close()
-                                    logger.debug("Conexión (Oficial) cerrada.")
                 else: 
                     st.info("Selecciona todos los campos del examen para comenzar.")
\ No newline at end of file
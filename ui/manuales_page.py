@@ -1,9 +1,10 @@
 import streamlit as st
 import os
-import base64
 import logging
 import glob
 
+from ui.visor_pdf import mostrar_pdf
+
 # Configurar un logger para esta página
 logger = logging.getLogger(__name__)
 
@@ -61,50 +62,7 @@ def mostrar_dialogo_pdf(pdf_path, title, session_key):
     """, unsafe_allow_html=True)
 
     try:
-        with open(pdf_path, "rb") as f:
-            base64_pdf = base64.b64encode(f.read()).decode('utf-8')
-        
-        html_content = f'''
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="UTF-8">
-                <script src="https://cdnjs.cloudflare.com/ajax/libs/pdf.js/2.11.338/pdf.min.js"></script>
-                <style>
-                    body {{ margin: 0; padding: 0; background-color: #f0f2f6; }}
-                    #pdf-container {{ display: flex; flex-direction: column; align-items: center; gap: 1rem; padding: 1rem; }}
-                    canvas {{ border: 1px solid #ccc; box-shadow: 0 4px 8px rgba(0,0,0,0.1); max-width: 100%; height: auto; }}
-                </style>
-            </head>
-            <body>
-                <div id="pdf-container"></div>
-                <script>
-                    const pdfData = atob('{base64_pdf}');
-                    const pdfjsLib = window['pdfjs-dist/build/pdf'];
-                    pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs/pdf.js/2.11.338/pdf.worker.min.js';
-
-                    const loadingTask = pdfjsLib.getDocument({{data: pdfData}});
-                    loadingTask.promise.then(function(pdf) {{
-                        const container = document.getElementById('pdf-container');
-                        for (let pageNum = 1; pageNum <= pdf.numPages; pageNum++) {{
-                            pdf.getPage(pageNum).then(function(page) {{
-                                const scale = 1.5;
-                                const viewport = page.getViewport({{scale: scale}});
-                                const canvas = document.createElement('canvas');
-                                const context = canvas.getContext('2d');
-                                canvas.height = viewport.height;
-                                canvas.width = viewport.width;
-                                container.appendChild(canvas);
-                                const renderContext = {{ canvasContext: context, viewport: viewport }};
-                                page.render(renderContext);
-                            }});
-                        }}
-                    }});
-                </script>
-            </body>
-            </html>
-        '''
-        st.components.v1.html(html_content, height=800, scrolling=True)
+        mostrar_pdf(pdf_path, height=800)
 
     except FileNotFoundError:
         st.error(f"Error: No se encontró el archivo en la ruta: {pdf_path}")
@@ -3,14 +3,13 @@ import os
 import time 
 import streamlit.components.v1 as components
 from datetime import datetime, timedelta 
-import threading
 import logging
 
 # Importaciones de tus módulos refactorizados
-from core.db_quiz_loader import conectar_db
+from core.db_quiz_loader import conexion_db
 from core.db_quiz_handler import obtener_datos_examen, obtener_texto_escenario, obtener_explicacion_pregunta
 from ui.dialogs import mostrar_dialogo_explicacion_ia_maqueta_v2 
-from core import stats_handler 
+from core import cola_stats
 
 logger = logging.getLogger(__name__)
 
@@ -162,17 +161,13 @@ def display_quiz_session_section():
                 explicacion_key = f"explicacion_data_{pregunta_id_actual}"
                 if explicacion_key not in st.session_state:
                     st.session_state[explicacion_key] = None
-                    conn = None
                     try:
-                        conn = conectar_db()
-                        explicacion_data = obtener_explicacion_pregunta(conn, pregunta_id_actual)
+                        with conexion_db() as conn:
+                            explicacion_data = obtener_explicacion_pregunta(conn, pregunta_id_actual)
                         st.session_state[explicacion_key] = explicacion_data
                     except Exception as e:
                         st.error("No se pudo cargar la explicación.")
                         logger.error(f"Fallo al obtener explicación para {pregunta_id_actual}: {e}", exc_info=True)
-                    finally:
-                        if conn:
-                            conn.close()
                 
                 explicacion_cargada = st.session_state[explicacion_key]
 
@@ -203,14 +198,9 @@ def display_quiz_session_section():
                             respuestas_a_procesar = st.session_state.respuestas_para_stats_finales[:]
                             if respuestas_a_procesar:
                                 try:
-                                    processing_thread = threading.Thread(
-                                        target=stats_handler.procesar_respuestas_del_quiz_finalizado,
-                                        args=(user_id_actual, respuestas_a_procesar),
-                                        daemon=True
-                                    )
-                                    processing_thread.start()
-                                except Exception as e_thread_start:
-                                    st.error(f"Error al iniciar el hilo de procesamiento de estadísticas: {e_thread_start}")
+                                    cola_stats.encolar_stats_quiz(user_id_actual, respuestas_a_procesar, st.session_state.get('intento_id'))
+                                except Exception as e_encolar:
+                                    st.error(f"Error al encolar el procesamiento de estadísticas: {e_encolar}")
                         else:
                             st.warning("USER ID no encontrado, no se pueden procesar stats finales.")
                         st.session_state.respuestas_para_stats_finales = [] 
@@ -239,15 +229,10 @@ def display_quiz_session_section():
                             respuestas_a_procesar_terminar = st.session_state.respuestas_para_stats_finales[:]
                             if respuestas_a_procesar_terminar:
                                 try:
-                                    print(f"DEBUG UI: Iniciando hilo para {len(respuestas_a_procesar_terminar)} respuestas (Terminar).")
-                                    processing_thread_terminar = threading.Thread(
-                                        target=stats_handler.procesar_respuestas_del_quiz_finalizado,
-                                        args=(user_id_actual, respuestas_a_procesar_terminar),
-                                        daemon=True
-                                    )
-                                    processing_thread_terminar.start()
-                                except Exception as e_thread_start_term:
-                                    st.error(f"Error al iniciar el hilo de procesamiento de estadísticas (Terminar): {e_thread_start_term}")
+                                    logger.debug(f"Encolando {len(respuestas_a_procesar_terminar)} respuestas (Terminar).")
+                                    cola_stats.encolar_stats_quiz(user_id_actual, respuestas_a_procesar_terminar, st.session_state.get('intento_id'))
+                                except Exception as e_encolar_term:
+                                    st.error(f"Error al encolar el procesamiento de estadísticas (Terminar): {e_encolar_term}")
                             
                         else:
                             st.warning("USER ID no encontrado, no se pueden procesar stats finales (Terminar).")
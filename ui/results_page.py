@@ -2,7 +2,7 @@ import streamlit as st
 import psycopg2 
 
 # Importaciones de tus módulos refactorizados
-from core.db_quiz_loader import conectar_db
+from core.db_quiz_loader import conexion_db
 from core.db_quiz_handler import obtener_texto_escenario 
 from ui.dialogs import mostrar_dialogo_revision 
 
@@ -133,24 +133,20 @@ def display_results_section():
         if idx_para_revisar is not None:
             pregunta_para_dialogo = cuestionario[idx_para_revisar] 
             id_escenario_para_dialogo = pregunta_para_dialogo.get('escenario_id')
-            texto_escenario_obtenido_para_dialogo = None
+            # El texto ya viene pre-cargado al iniciar el quiz (enriquecer_preguntas); solo se consulta si falta.
+            texto_escenario_obtenido_para_dialogo = pregunta_para_dialogo.get('texto_escenario_completo')
 
-            if id_escenario_para_dialogo:
-                conn_dialog_rev_esc = None
+            if id_escenario_para_dialogo and not texto_escenario_obtenido_para_dialogo:
                 try:
-                    conn_dialog_rev_esc = conectar_db()
-                    if conn_dialog_rev_esc:
+                    with conexion_db() as conn_dialog_rev_esc:
                         texto_escenario_obtenido_para_dialogo = obtener_texto_escenario(
                             conn_dialog_rev_esc, 
                             id_escenario_para_dialogo
                         )
-                        if not texto_escenario_obtenido_para_dialogo:
-                            print(f"WARN RESULTS_PAGE: No se encontró texto para escenario ID {id_escenario_para_dialogo} en revisión.")
+                    if not texto_escenario_obtenido_para_dialogo:
+                        print(f"WARN RESULTS_PAGE: No se encontró texto para escenario ID {id_escenario_para_dialogo} en revisión.")
                 except Exception as e_dlg_esc:
                     print(f"Error obteniendo escenario para diálogo de revisión: {e_dlg_esc}")
-                finally:
-                    if conn_dialog_rev_esc and not conn_dialog_rev_esc.closed:
-                        conn_dialog_rev_esc.close()
             
             mostrar_dialogo_revision(
                 idx_para_revisar,
@@ -0,0 +1,262 @@
+# ui/visor_pdf.py
+# Visor de PDF compartido por la biblioteca de manuales y la página de análisis.
+#
+# Los PDF ya no se incrustan en base64 en el HTML: se sirven por URL con el servidor de
+# ficheros estáticos de Streamlit (server.enableStaticServing en .streamlit/config.toml),
+# que es un StaticFileHandler de Tornado con soporte de ETag, Last-Modified y peticiones Range.
+# PDF.js descarga el documento por rangos y solo renderiza las páginas que se van viendo.
+#
+# Streamlit sirve <raíz>/static en /app/static/ sin pasar por el login. Por eso solo se publican
+# los manuales (data/manuales), y en una ruta no adivinable: static/pdf/<hash del contenido>/<nombre>,
+# igual que las páginas de core/paginas_pdf.py. Los informes (data/informes) y cualquier otro PDF
+# no se publican nunca: se incrustan en base64 dentro de la sesión autenticada, como antes.
+# Cada manual se publica la primera vez que se abre, como enlace duro (mismo inodo, sin copiar
+# datos) o, si el sistema de ficheros no lo permite, como copia. No se usan enlaces simbólicos
+# porque Tornado rechaza los que apuntan fuera de static/. Si no se puede publicar, base64.
+#
+# Si PyMuPDF está disponible, en lugar de PDF.js los manuales se muestran con las páginas
+# pre-renderizadas en servidor (core/paginas_pdf.py) como <img loading="lazy">: abrir un capítulo
+# solo descarga las imágenes de la primera pantalla.
+import os
+import base64
+import shutil
+import logging
+import threading
+from urllib.parse import quote
+
+import streamlit as st
+
+from core.paginas_pdf import obtener_paginas, url_pagina, huella_contenido
+
+logger = logging.getLogger(__name__)
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRECTORIO_STATIC = os.path.join(project_root, 'static')
+# Carpetas cuyos PDF se pueden publicar (por hash) en /app/static/pdf/. Los informes no.
+CARPETAS_PUBLICAS = [os.path.join(project_root, 'data', 'manuales')]
+ALIAS_PDF = 'pdf'
+# Publicaciones con rutas adivinables de versiones anteriores; se retiran al publicar.
+ALIAS_RETIRADOS = ('manuales', 'informes')
+PDFJS_VERSION = '2.11.338'
+PDFJS_CDN = f"https://cdnjs.cloudflare.com/ajax/libs/pdf.js/{PDFJS_VERSION}"
+# Tamaño de cada petición Range de PDF.js.
+PDF_RANGE_CHUNK_BYTES = 64 * 1024
+
+_publicar_lock = threading.Lock()
+_retirados = False
+
+
+def _esta_actualizado(origen, publicado):
+    try:
+        st_origen, st_publicado = os.stat(origen), os.stat(publicado)
+    except FileNotFoundError:
+        return False
+    if (st_origen.st_dev, st_origen.st_ino) == (st_publicado.st_dev, st_publicado.st_ino):
+        return True
+    return st_origen.st_size == st_publicado.st_size and st_origen.st_mtime <= st_publicado.st_mtime
+
+
+def _retirar_publicaciones_antiguas():
+    """Borra static/manuales y static/informes (rutas por nombre, accesibles sin login). Una vez por proceso."""
+    global _retirados
+    if _retirados:
+        return
+    with _publicar_lock:
+        if _retirados:
+            return
+        for alias in ALIAS_RETIRADOS:
+            carpeta = os.path.join(DIRECTORIO_STATIC, alias)
+            if os.path.isdir(carpeta):
+                shutil.rmtree(carpeta, ignore_errors=True)
+                logger.info(f"Publicación antigua retirada: {carpeta}")
+        _retirados = True
+
+
+def publicar_fichero_estatico(ruta_fichero, alias, relativa):
+    """Deja el fichero en static/<alias>/<relativa> (enlace duro o copia). Devuelve si lo consiguió."""
+    _retirar_publicaciones_antiguas()
+    destino = os.path.join(DIRECTORIO_STATIC, alias, *relativa.split('/'))
+    if _esta_actualizado(ruta_fichero, destino):
+        return True
+    with _publicar_lock:
+        if _esta_actualizado(ruta_fichero, destino):
+            return True
+        temporal = f"{destino}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            try:
+                os.link(ruta_fichero, temporal)
+            except OSError:
+                shutil.copy2(ruta_fichero, temporal)
+            os.replace(temporal, destino)
+            logger.info(f"PDF publicado como estático: {destino}")
+            return True
+        except OSError as e:
+            logger.warning(f"No se pudo publicar '{ruta_fichero}' como estático; se incrustará en base64: {e}")
+            try:
+                os.remove(temporal)
+            except OSError:
+                pass
+            return False
+
+
+def _static_habilitado():
+    try:
+        return bool(st.get_option("server.enableStaticServing"))
+    except Exception:
+        return False
+
+
+def url_estatica(ruta_fichero):
+    """URL relativa (app/static/pdf/<hash>/<nombre>) si el fichero es de una carpeta publicable; si no, None."""
+    if not _static_habilitado():
+        return None
+    ruta_real = os.path.realpath(ruta_fichero)
+    for carpeta in CARPETAS_PUBLICAS:
+        carpeta_real = os.path.realpath(carpeta)
+        if os.path.commonpath([ruta_real, carpeta_real]) == carpeta_real:
+            try:
+                relativa = f"{huella_contenido(ruta_real)}/{os.path.basename(ruta_real)}"
+            except OSError:
+                return None
+            if not publicar_fichero_estatico(ruta_real, ALIAS_PDF, relativa):
+                return None
+            return f"app/static/{ALIAS_PDF}/{quote(relativa)}"
+    return None
+
+
+def _html_visor(origen_js):
+    """HTML del visor. 'origen_js' es la expresión JS que se pasa a pdfjsLib.getDocument()."""
+    return f'''
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="UTF-8">
+            <script src="{PDFJS_CDN}/pdf.min.js"></script>
+            <style>
+                body {{ margin: 0; padding: 0; background-color: #f0f2f6; }}
+                #pdf-container {{ display: flex; flex-direction: column; align-items: center; gap: 1rem; padding: 1rem; }}
+                .pagina {{ background: #fff; border: 1px solid #ccc; box-shadow: 0 4px 8px rgba(0,0,0,0.1); max-width: 100%; }}
+                canvas {{ display: block; max-width: 100%; height: auto; }}
+            </style>
+        </head>
+        <body>
+            <div id="pdf-container"></div>
+            <script>
+                const pdfjsLib = window['pdfjs-dist/build/pdf'];
+                pdfjsLib.GlobalWorkerOptions.workerSrc = '{PDFJS_CDN}/pdf.worker.min.js';
+                const scale = 1.5;
+                const container = document.getElementById('pdf-container');
+
+                pdfjsLib.getDocument({origen_js}).promise.then(function(pdf) {{
+                    // La primera página da el tamaño de los huecos; el resto se renderiza al acercarse a la vista.
+                    pdf.getPage(1).then(function(primera) {{
+                        const vp = primera.getViewport({{scale: scale}});
+                        const observer = new IntersectionObserver(function(entries) {{
+                            entries.forEach(function(entry) {{
+                                if (!entry.isIntersecting) return;
+                                const hueco = entry.target;
+                                observer.unobserve(hueco);
+                                pdf.getPage(Number(hueco.dataset.pagina)).then(function(page) {{
+                                    const viewport = page.getViewport({{scale: scale}});
+                                    const canvas = document.createElement('canvas');
+                                    canvas.width = viewport.width;
+                                    canvas.height = viewport.height;
+                                    hueco.style.width = ''; hueco.style.height = '';
+                                    hueco.appendChild(canvas);
+                                    page.render({{ canvasContext: canvas.getContext('2d'), viewport: viewport }});
+                                }});
+                            }});
+                        }}, {{ rootMargin: '800px 0px' }});
+                        for (let pageNum = 1; pageNum <= pdf.numPages; pageNum++) {{
+                            const hueco = document.createElement('div');
+                            hueco.className = 'pagina';
+                            hueco.dataset.pagina = pageNum;
+                            hueco.style.width = vp.width + 'px';
+                            hueco.style.height = vp.height + 'px';
+                            container.appendChild(hueco);
+                            observer.observe(hueco);
+                        }}
+                    }});
+                }});
+            </script>
+        </body>
+        </html>
+    '''
+
+
+def _html_paginas(manifiesto):
+    """HTML con las páginas como imágenes de carga diferida y un índice de miniaturas."""
+    miniaturas, paginas = [], []
+    for numero, (ancho, alto) in enumerate(manifiesto['tamanos'], start=1):
+        miniaturas.append(
+            f'<a href="#" onclick="return irA({numero})"><img loading="lazy" src="{url_pagina(manifiesto, numero, miniatura=True)}" '
+            f'alt="{numero}" onerror="reintentar(this)"><span>{numero}</span></a>'
+        )
+        paginas.append(
+            f'<img id="p{numero}" class="pagina" loading="lazy" width="{ancho}" height="{alto}" '
+            f'src="{url_pagina(manifiesto, numero)}" alt="Página {numero}" onerror="reintentar(this)">'
+        )
+    return f'''
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="UTF-8">
+            <style>
+                body {{ margin: 0; padding: 0; background-color: #f0f2f6; font-family: sans-serif; }}
+                #indice summary {{ cursor: pointer; padding: 0.5rem 1rem; }}
+                #miniaturas {{ display: flex; flex-wrap: wrap; gap: 0.5rem; padding: 0 1rem 1rem; }}
+                #miniaturas a {{ display: flex; flex-direction: column; align-items: center; font-size: 0.7rem; color: #555; text-decoration: none; }}
+                #miniaturas img {{ width: 80px; border: 1px solid #ccc; }}
+                #pdf-container {{ display: flex; flex-direction: column; align-items: center; gap: 1rem; padding: 1rem; }}
+                .pagina {{ background: #fff; border: 1px solid #ccc; box-shadow: 0 4px 8px rgba(0,0,0,0.1); max-width: 100%; height: auto; }}
+            </style>
+            <script>
+                // En el iframe srcdoc un href="#pN" se resuelve contra la URL de la app: se desplaza a mano.
+                function irA(numero) {{
+                    document.getElementById('p' + numero).scrollIntoView();
+                    return false;
+                }}
+                // Las páginas que aún se están renderizando en segundo plano devuelven 404: se reintentan.
+                function reintentar(img) {{
+                    const intentos = Number(img.dataset.intentos || 0);
+                    if (intentos >= 20) return;
+                    img.dataset.intentos = intentos + 1;
+                    setTimeout(function() {{ img.src = img.src.split('?')[0] + '?r=' + Date.now(); }}, 1500);
+                }}
+            </script>
+        </head>
+        <body>
+            <details id="indice"><summary>Índice de páginas ({manifiesto['paginas']})</summary>
+                <div id="miniaturas">{''.join(miniaturas)}</div>
+            </details>
+            <div id="pdf-container">{''.join(paginas)}</div>
+        </body>
+        </html>
+    '''
+
+
+def mostrar_pdf(pdf_path, height=800):
+    """Muestra el PDF. Lanza FileNotFoundError si no existe (los diálogos ya tratan ese caso)."""
+    if not os.path.isfile(pdf_path):
+        raise FileNotFoundError(pdf_path)
+
+    if _static_habilitado():
+        manifiesto = obtener_paginas(pdf_path)
+        if manifiesto is not None:
+            st.components.v1.html(_html_paginas(manifiesto), height=height, scrolling=True)
+            return
+
+    url = url_estatica(pdf_path)
+    if url is not None:
+        # La URL se resuelve contra la de la app (document.baseURI del iframe), respetando baseUrlPath.
+        origen_js = (
+            f"{{url: new URL('{url}', document.baseURI).href, rangeChunkSize: {PDF_RANGE_CHUNK_BYTES}, "
+            f"disableAutoFetch: true}}"
+        )
+    else:
+        with open(pdf_path, "rb") as f:
+            base64_pdf = base64.b64encode(f.read()).decode('utf-8')
+        origen_js = f"{{data: atob('{base64_pdf}')}}"
+
+    st.components.v1.html(_html_visor(origen_js), height=height, scrolling=True)